@@ -4,6 +4,7 @@
 , uuid
 , deploymentName
 , args
+, evalNames ? null # if set, evaluate ‘info’ only for these machines
 }:
 
 with import <nixpkgs/nixos/lib/testing.nix> { inherit system; };
@@ -63,7 +64,9 @@ rec {
           extraArgs = { inherit nodes resources uuid deploymentName; name = machineName; };
         };
       }
-    ) (attrNames (removeAttrs network [ "network" "defaults" "resources" "require" "_file" ])));
+    ) machineNames);
+
+  machineNames = attrNames (removeAttrs network [ "network" "defaults" "resources" "require" "_file" ]);
 
   # Compute the definitions of the non-machine resources.
   resourcesByType = zipAttrs (network.resources or []);
@@ -80,7 +83,7 @@ rec {
     mapAttrs (name: defs:
       (builtins.removeAttrs (fixMergeModules
         ([ mainModule deploymentInfoModule ./resource.nix ] ++ defs)
-        { inherit pkgs uuid name resources; nodes = info.machines; }
+        { inherit pkgs uuid name resources; nodes = allMachineInfo; }
       ).config) ["_module"]) _resources;
 
   resources.sshKeyPairs = evalResources ./ssh-keypair.nix (zipAttrs resourcesByType.sshKeyPairs or []);
@@ -170,7 +173,7 @@ rec {
     in assert (noDups (resourceNames resources')); resources';
 
 
-  azure_deployments = filterAttrs ( n: v: (scrubOptionValue v).config.deployment.targetEnv == "azure") nodes;
+  azure_deployments = filterAttrs ( n: v: (scrubOptionValue v).config.deployment.targetEnv == "azure") selectedNodes;
 
   azure_default_group = flip mapAttrs' azure_deployments (name: depl:
     let azure = (scrubOptionValue depl).config.deployment.azure; in (
@@ -236,7 +239,7 @@ rec {
   resources.gseBuckets = evalResources ./gse-bucket.nix (zipAttrs resourcesByType.gseBuckets or []);
   resources.gceImages = evalResources ./gce-image.nix (gce_default_bootstrap_images // ( zipAttrs resourcesByType.gceImages  or []) );
 
-  gce_deployments = flip filterAttrs nodes
+  gce_deployments = flip filterAttrs selectedNodes
                       ( n: v: let dc = (scrubOptionValue v).config.deployment; in dc.targetEnv == "gce" );
 
   gce_default_bootstrap_images = flip mapAttrs' gce_deployments (name: depl:
@@ -256,14 +259,25 @@ rec {
     )
   );
 
-  # Phase 1: evaluate only the deployment attributes.
-  info =
+  # The machines selected by ‘evalNames’, plus the machines they
+  # refer to through ‘deployment.encryptedLinksTo’ and
+  # ‘deployment.container.host’, transitively.
+  selectedNodes =
+    if evalNames == null then nodes else
     let
-      network' = network;
-      resources' = resources;
-    in rec {
+      refs = name:
+        let m = allMachineInfo.${name}; in
+        filter (n: hasAttr n nodes)
+          (m.encryptedLinksTo
+           ++ optional (m.targetEnv == "container") (removePrefix "__machine-" m.container.host));
+      closure = builtins.genericClosure {
+        startSet = map (n: { key = n; }) (filter (n: hasAttr n nodes) evalNames);
+        operator = { key }: map (n: { key = n; }) (refs key);
+      };
+      selected = listToAttrs (map ({ key }: nameValuePair key true) closure);
+    in filterAttrs (n: v: hasAttr n selected) nodes;
 
-    machines =
+  allMachineInfo =
       flip mapAttrs nodes (n: v': let v = scrubOptionValue v'; in
         { inherit (v.config.deployment) targetEnv targetPort targetHost encryptedLinksTo storeKeysOnMachine alwaysActivate owners keys hasFastConnection;
           nixosRelease = v.config.system.nixosRelease or (removeSuffix v.config.system.nixosVersionSuffix v.config.system.nixosVersion);
@@ -284,6 +298,15 @@ rec {
         }
       );
 
+  # Phase 1: evaluate only the deployment attributes.
+  info =
+    let
+      network' = network;
+      resources' = resources;
+    in rec {
+
+    machines = intersectAttrs selectedNodes allMachineInfo;
+
     network = fold (as: bs: as // bs) {} (network'.network or []);
 
     resources =
@@ -321,6 +344,23 @@ rec {
 
   };
 
+  # Everything NixOps needs from the network expressions, to be
+  # evaluated in one go with ‘nix-instantiate --json’.  Paths are
+  # turned into strings, since they would otherwise be copied to the
+  # Nix store (and may refer to private keys).
+  evaluation = pathsToStrings {
+    inherit info;
+    arguments = nixopsArguments;
+    nixpkgs.path = toString <nixpkgs>;
+  };
+
+  pathsToStrings = v:
+    let type = builtins.typeOf v; in
+    if type == "path" then toString v
+    else if type == "list" then map pathsToStrings v
+    else if type == "set" && !isDerivation v then mapAttrs (n: pathsToStrings) v
+    else v;
+
   # Phase 2: build complete machine configurations.
   machines = { names }:
     let nodes' = filterAttrs (n: v: elem n names) nodes; in
@@ -334,6 +374,50 @@ rec {
       '';
 
 
+  # Combine the outputs of several ‘machines’ calls (see
+  # Deployment.build_configs()).
+  combineMachines = { paths }:
+    runCommand "nixops-machines"
+      { preferLocalBuild = true; }
+      ''
+        mkdir -p $out
+        ${concatMapStrings (p: ''
+          ln -s ${builtins.storePath p}/* $out/
+        '') paths}
+      '';
+
+
+  # The derivations of the configurations of the machines ‘names’,
+  # so that they can be built separately (see
+  # Deployment.build_and_copy()).
+  toplevelDrvs = { names }:
+    mapAttrs (n: v: v.config.system.build.toplevel.drvPath)
+      (filterAttrs (n: v: elem n names) nodes);
+
+
+  # Link the separately built configurations ‘toplevels’ (a set
+  # mapping machine names to store paths) like ‘machines’ does.
+  linkMachines = { toplevels }:
+    runCommand "nixops-machines"
+      { preferLocalBuild = true; }
+      ''
+        mkdir -p $out
+        ${concatStrings (mapAttrsToList (n: p: ''
+          ln -s ${builtins.storePath p} $out/${n}
+        '') toplevels)}
+      '';
+
+
+  # Evaluate several configuration options of several machines at
+  # once (see Deployment.evaluate_option_values()).  ‘options’ maps
+  # each machine name to a set mapping option names to their
+  # attribute paths.
+  optionValues = { options }:
+    pathsToStrings (mapAttrs (machineName:
+      mapAttrs (optionName: path: getAttrFromPath path nodes.${machineName}.config)
+    ) options);
+
+
   # Function needed to calculate the nixops arguments. This should work even when arguments
   # are not set yet, so we fake arguments to be able to evaluate the require attribute of
   # the nixops network expressions.
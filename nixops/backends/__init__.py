@@ -13,23 +13,18 @@ class MachineDefinition(nixops.resources.ResourceDefinition):
 
     def __init__(self, xml, config={}):
         nixops.resources.ResourceDefinition.__init__(self, xml, config)
-        self.encrypted_links_to = set([e.get("value") for e in xml.findall("attrs/attr[@name='encryptedLinksTo']/list/string")])
-        self.store_keys_on_machine = xml.find("attrs/attr[@name='storeKeysOnMachine']/bool").get("value") == "true"
-        self.ssh_port = int(xml.find("attrs/attr[@name='targetPort']/int").get("value"))
-        self.always_activate = xml.find("attrs/attr[@name='alwaysActivate']/bool").get("value") == "true"
-        self.owners = [e.get("value") for e in xml.findall("attrs/attr[@name='owners']/list/string")]
-        self.has_fast_connection = xml.find("attrs/attr[@name='hasFastConnection']/bool").get("value") == "true"
+        self.encrypted_links_to = set(config["encryptedLinksTo"])
+        self.store_keys_on_machine = config["storeKeysOnMachine"]
+        self.ssh_port = int(config["targetPort"])
+        self.always_activate = config["alwaysActivate"]
+        self.owners = config["owners"]
+        self.has_fast_connection = config["hasFastConnection"]
 
         def _extract_key_options(x):
-            opts = {}
-            for key in ('text', 'user', 'group', 'permissions'):
-                elem = x.find("attrs/attr[@name='{0}']/string".format(key))
-                if elem is not None:
-                    opts[key] = elem.get("value")
-            return opts
+            return {key: x[key] for key in ('text', 'user', 'group', 'permissions')
+                    if isinstance(x.get(key), basestring)}
 
-        self.keys = {k.get("name"): _extract_key_options(k) for k in
-                     xml.findall("attrs/attr[@name='keys']/attrs/attr")}
+        self.keys = {k: _extract_key_options(v) for k, v in config["keys"].iteritems()}
 
 
 class MachineState(nixops.resources.ResourceState):
@@ -270,6 +265,13 @@ class MachineState(nixops.resources.ResourceState):
         """Return the IP address to be used to access resource "r" from this machine."""
         return r.public_ipv4
 
+    def copy_group(self):
+        """Return a key shared by the machines that can copy closures
+        to each other directly, using the addresses returned by
+        address_to(), or None if closures can only be copied to this
+        machine from the deployer."""
+        return None
+
     def wait_for_ssh(self, check=False):
         """Wait until the SSH port is open on this machine."""
         if self.ssh_pinged and (not check or self._ssh_pinged_this_time): return
@@ -321,11 +323,8 @@ class MachineState(nixops.resources.ResourceState):
         cmd += " " + method
         return self.run_command(cmd, check=False)
 
-    def copy_closure_to(self, path):
-        """Copy a closure to this machine."""
-
-        # !!! Implement copying between cloud machines, as in the Perl
-        # version.
+    def copy_closure_to(self, *paths):
+        """Copy the closures of ‘paths’ to this machine."""
 
         ssh = self.get_ssh_for_copy_closure()
 
@@ -333,10 +332,34 @@ class MachineState(nixops.resources.ResourceState):
         env = dict(os.environ)
         env['NIX_SSHOPTS'] = ' '.join(ssh._get_flags() + ssh.get_master().opts)
         self._logged_exec(
-            ["nix-copy-closure", "--to", ssh._get_target(), path]
+            ["nix-copy-closure", "--to", ssh._get_target()] + list(paths)
             + ([] if self.has_fast_connection else ["--gzip", "--use-substitutes"]),
             env=env)
 
+    def get_invalid_paths(self, paths):
+        """Return the paths in ‘paths’ that are not valid in the Nix
+        store that copy_closure_to() copies to."""
+        paths_file = "{0}/paths-{1}".format(self.depl.tempdir, self.name)
+        try:
+            with open(paths_file, "w+") as f:
+                f.write("".join(p + "\n" for p in paths))
+                f.seek(0)
+                out = self.get_ssh_for_copy_closure().run_command(
+                    "xargs -r nix-store --check-validity --print-invalid", capture_stdout=True, stdin=f)
+        finally:
+            os.remove(paths_file)
+        return out.split()
+
+    def copy_closure_from(self, peer, paths, key_file, known_hosts_file):
+        """Copy the closures of ‘paths’ to this machine from the
+        machine ‘peer’, which must already have them, using the SSH
+        private key ‘key_file’ on ‘peer’.  ‘known_hosts_file’ on ‘peer’
+        must contain the host key of this machine."""
+        ssh_opts = "-i {0} -p {1} -o StrictHostKeyChecking=yes -o UserKnownHostsFile={2}" \
+            .format(key_file, self.ssh_port, known_hosts_file)
+        peer.run_command("NIX_SSHOPTS='{0}' nix-copy-closure --to root@{1} {2}"
+                         .format(ssh_opts, peer.address_to(self), " ".join(paths)))
+
     def generate_vpn_key(self, check=False):
         key_missing = False
         try:
@@ -369,20 +369,10 @@ class AzureState(MachineState, ResourceState):
                    self.resource_group, self.network_interface).network_interface.ip_configurations[0].private_ip_address
 
     def update_block_device_mapping(self, k, v):
-        x = self.block_device_mapping
-        if v == None:
-            x.pop(k, None)
-        else:
-            x[k] = v
-        self.block_device_mapping = x
+        nixops.util.update_json_attr(self, "azure.blockDeviceMapping", k, v)
 
     def update_generated_encryption_keys(self, k, v):
-        x = self.generated_encryption_keys
-        if v == None:
-            x.pop(k, None)
-        else:
-            x[k] = v
-        self.generated_encryption_keys = x
+        nixops.util.update_json_attr(self, "azure.generatedEncryptionKeys", k, v)
 
 
     def check_network_iface(self):
@@ -14,9 +14,7 @@ class ContainerDefinition(MachineDefinition):
 
     def __init__(self, xml, config):
         MachineDefinition.__init__(self, xml, config)
-        x = xml.find("attrs/attr[@name='container']/attrs")
-        assert x is not None
-        self.host = x.find("attr[@name='host']/string").get("value")
+        self.host = config["container"]["host"]
 
 class ContainerState(MachineState):
     """State of a NixOS container."""
@@ -74,9 +72,13 @@ class ContainerState(MachineState):
         # should copy closures to the host.
         return self.host_ssh
 
-    def copy_closure_to(self, path):
+    def copy_closure_to(self, *paths):
         if self.host == "localhost": return
-        MachineState.copy_closure_to(self, path)
+        MachineState.copy_closure_to(self, *paths)
+
+    def get_invalid_paths(self, paths):
+        if self.host == "localhost": return []
+        return MachineState.get_invalid_paths(self, paths)
 
     def get_host_ssh(self):
         if self.host.startswith("__machine-"):
@@ -245,6 +245,9 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
             return m.private_ipv4
         return MachineState.address_to(self, m)
 
+    def copy_group(self):
+        return ("ec2", self.region, self.subnet_id)
+
 
     def connect(self):
         if self._conn: return self._conn
@@ -362,12 +365,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
 
 
     def update_block_device_mapping(self, k, v):
-        x = self.block_device_mapping
-        if v == None:
-            x.pop(k, None)
-        else:
-            x[k] = v
-        self.block_device_mapping = x
+        nixops.util.update_json_attr(self, "ec2.blockDeviceMapping", k, v)
 
 
     def get_backups(self):
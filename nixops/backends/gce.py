@@ -158,6 +158,9 @@ class GCEState(MachineState, ResourceState):
         else:
             return MachineState.address_to(self, resource)
 
+    def copy_group(self):
+        return ("gce", self.network)
+
     def full_metadata(self, metadata):
         result = metadata.copy()
         result.update({
@@ -174,12 +177,7 @@ class GCEState(MachineState, ResourceState):
         }
 
     def update_block_device_mapping(self, k, v):
-        x = self.block_device_mapping
-        if v == None:
-            x.pop(k, None)
-        else:
-            x[k] = v
-        self.block_device_mapping = x
+        nixops.util.update_json_attr(self, "gce.blockDeviceMapping", k, v)
 
     def _delete_volume(self, volume_id, region, allow_keep=False):
         if not self.depl.logger.confirm("are you sure you want to destroy GCE disk '{0}'?".format(volume_id)):
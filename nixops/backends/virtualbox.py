@@ -74,6 +74,9 @@ class VirtualBoxState(MachineState):
             return m.private_ipv4
         return MachineState.address_to(self, m)
 
+    def copy_group(self):
+        return ("virtualbox",)
+
     @property
     def _vbox_version(self):
         v = getattr(self, '_vbox_version_obj', None)
@@ -146,21 +149,11 @@ class VirtualBoxState(MachineState):
 
 
     def _update_disk(self, name, state):
-        disks = self.disks
-        if state == None:
-            disks.pop(name, None)
-        else:
-            disks[name] = state
-        self.disks = disks
+        nixops.util.update_json_attr(self, "virtualbox.disks", name, state)
 
 
     def _update_shared_folder(self, name, state):
-        shared_folders = self.shared_folders
-        if state == None:
-            shared_folders.pop(name, None)
-        else:
-            shared_folders[name] = state
-        self.shared_folders = shared_folders
+        nixops.util.update_json_attr(self, "virtualbox.sharedFolders", name, state)
 
 
     def _wait_for_ip(self):
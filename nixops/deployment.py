@@ -8,15 +8,17 @@ import string
 import tempfile
 import shutil
 import threading
+import contextlib
 import exceptions
 import errno
 from collections import defaultdict
-from xml.etree import ElementTree
 import nixops.statefile
 import nixops.backends
 import nixops.logger
 import nixops.parallel
-from nixops.nix_expr import RawValue, Function, Call, nixmerge, py2nix
+import nixops.ssh_util
+import nixops.eval_cache
+from nixops.nix_expr import RawValue, Function, Call, NixMergeBuilder, py2nix, py2nix_to_file
 import re
 from datetime import datetime, timedelta
 import getpass
@@ -28,6 +30,8 @@ import platform
 from nixops.util import ansi_success
 import inspect
 import time
+import StringIO
+import hashlib
 
 class NixEvalError(Exception):
     pass
@@ -37,6 +41,63 @@ class UnknownBackend(Exception):
 
 debug = False
 
+class DeploymentLock(object):
+    """An flock(2)-based lock on a deployment that can be held in
+    shared or exclusive mode."""
+
+    def __init__(self, path, logger, on_acquire=None):
+        self._path = path
+        self._logger = logger
+        # Called whenever the lock is taken, or promoted to exclusive,
+        # since other processes may have changed the deployment before.
+        self._on_acquire = on_acquire
+        self._lock_file = None
+        self._exclusive = False
+        self.wait_time = 0.0
+
+    def _flock(self, exclusive):
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        kind = "exclusive" if exclusive else "shared"
+        try:
+            fcntl.flock(self._lock_file, mode | fcntl.LOCK_NB)
+        except IOError:
+            self._logger.log("waiting for {0} deployment lock...".format(kind))
+            start = time.time()
+            fcntl.flock(self._lock_file, mode)
+            waited = time.time() - start
+            self.wait_time += waited
+            self._logger.log("acquired {0} deployment lock after {1:.1f}s".format(kind, waited))
+        self._exclusive = exclusive
+
+    def upgrade(self):
+        # Note that flock() doesn't convert locks atomically: the
+        # shared lock is dropped before the exclusive one is taken.
+        if self._lock_file is not None and not self._exclusive:
+            self._flock(True)
+            if self._on_acquire: self._on_acquire()
+
+    def downgrade(self):
+        if self._lock_file is not None and self._exclusive:
+            self._flock(False)
+
+    @contextlib.contextmanager
+    def hold(self, exclusive=True):
+        if self._lock_file is not None:
+            if exclusive: self.upgrade()
+            yield
+            return
+        self._lock_file = open(self._path, "w")
+        fcntl.fcntl(self._lock_file, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            self._flock(exclusive)
+            if self._on_acquire: self._on_acquire()
+            yield
+        finally:
+            self._lock_file.close()
+            self._lock_file = None
+            self._exclusive = False
+
+
 class Deployment(object):
     """NixOps top-level deployment manager."""
 
@@ -48,6 +109,7 @@ class Deployment(object):
     args = nixops.util.attr_property("args", {}, 'json')
     description = nixops.util.attr_property("description", default_description)
     configs_path = nixops.util.attr_property("configsPath", None)
+    configs_digest = nixops.util.attr_property("configsDigest", None)
     rollback_enabled = nixops.util.attr_property("rollbackEnabled", False)
 
     def __init__(self, statefile, uuid, log_file=sys.stderr):
@@ -65,6 +127,17 @@ class Deployment(object):
         self.logger = nixops.logger.Logger(log_file)
 
         self._lock_file_path = None
+        self._deployment_lock = None
+
+        # Cache of evaluation results; None disables caching.
+        self.eval_cache = nixops.eval_cache.EvalCache.default()
+        self._evaluation = None
+        # NixOS version suffixes by Nixpkgs path.
+        self._version_suffixes = {}
+
+        # Number of parallel nix-instantiate processes used to evaluate
+        # and instantiate the machines.
+        self.eval_shards = 1
 
         self.expr_path = os.path.realpath(os.path.dirname(__file__) + "/../../../../share/nix/nixops")
         if not os.path.exists(self.expr_path):
@@ -72,14 +145,14 @@ class Deployment(object):
         if not os.path.exists(self.expr_path):
             self.expr_path = os.path.dirname(__file__) + "/../nix"
 
+        # Number of attribute reads served from the attribute cache
+        # rather than the state file.
+        self.attr_cache_hits = 0
+        self._load_attrs()
+        self._json_cache = nixops.util.JsonCache()
+
         self.resources = {}
-        with self._db:
-            c = self._db.cursor()
-            c.execute("select id, name, type from Resources where deployment = ?", (self.uuid,))
-            for (id, name, type) in c.fetchall():
-                r = _create_state(self, type, name, id)
-                self.resources[name] = r
-        self.logger.update_log_prefixes()
+        self._load_resources()
 
         self.definitions = None
 
@@ -121,16 +194,56 @@ class Deployment(object):
         return res
 
 
+    def _load_attrs(self):
+        """Read the attributes of this deployment and all its resources
+        into the attribute cache, so that attribute reads don't have
+        to query the state file."""
+        c = self._statefile._read_cursor()
+        c.execute("select name, value from DeploymentAttrs where deployment = ?", (self.uuid,))
+        self._attrs = dict(c.fetchall())
+        c.execute("select a.machine, a.name, a.value from ResourceAttrs a join Resources r on r.id = a.machine "
+                  "where r.deployment = ?", (self.uuid,))
+        self._resource_attrs = defaultdict(dict)
+        for (id, name, value) in c.fetchall():
+            self._resource_attrs[id][name] = value
+
+
+    def _load_resources(self):
+        """Read the list of resources of this deployment, keeping the
+        state objects of those that are already known."""
+        c = self._statefile._read_cursor()
+        c.execute("select id, name, type from Resources where deployment = ?", (self.uuid,))
+        resources = {}
+        for (id, name, type) in c.fetchall():
+            r = self.resources.get(name)
+            if r is None or r.id != id:
+                r = _create_state(self, type, name, id)
+            else:
+                r.logger.register_index(r.index)
+            resources[name] = r
+        self.resources = resources
+        self.logger.update_log_prefixes()
+
+
+    def _reload(self):
+        """Re-read the state of this deployment, which another process
+        may have changed while this one was waiting for the lock."""
+        self._load_attrs()
+        self._load_resources()
+
+
     def _set_attrs(self, attrs):
         """Update deployment attributes in the state file."""
-        with self._db:
-            c = self._db.cursor()
-            for n, v in attrs.iteritems():
-                if v == None:
-                    c.execute("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, n))
-                else:
-                    c.execute("insert or replace into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
-                              (self.uuid, n, v))
+        statements = []
+        for n, v in attrs.iteritems():
+            if v == None:
+                statements.append(("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, n)))
+                self._attrs.pop(n, None)
+            else:
+                statements.append(("insert or replace into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
+                                   (self.uuid, n, v)))
+                self._attrs[n] = nixops.util.text_value(v)
+        self._db.write(statements)
 
 
     def _set_attr(self, name, value):
@@ -140,18 +253,14 @@ class Deployment(object):
 
     def _del_attr(self, name):
         """Delete a deployment attribute from the state file."""
-        with self._db:
-            self._db.execute("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, name))
+        self._db.write([("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, name))])
+        self._attrs.pop(name, None)
 
 
     def _get_attr(self, name, default=nixops.util.undefined):
-        """Get a deployment attribute from the state file."""
-        with self._db:
-            c = self._db.cursor()
-            c.execute("select value from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, name))
-            row = c.fetchone()
-            if row != None: return row[0]
-            return nixops.util.undefined
+        """Get a deployment attribute from the attribute cache."""
+        self.attr_cache_hits += 1
+        return self._attrs.get(name, nixops.util.undefined)
 
 
     def _create_resource(self, name, type):
@@ -162,19 +271,16 @@ class Deployment(object):
         c.execute("insert into Resources(deployment, name, type) values (?, ?, ?)",
                   (self.uuid, name, type))
         id = c.lastrowid
+        self._resource_attrs[id] = {}
         r = _create_state(self, type, name, id)
         self.resources[name] = r
         return r
 
 
     def export(self):
-        with self._db:
-            c = self._db.cursor()
-            c.execute("select name, value from DeploymentAttrs where deployment = ?", (self.uuid,))
-            rows = c.fetchall()
-            res = {row[0]: row[1] for row in rows}
-            res['resources'] = {r.name: r.export() for r in self.resources.itervalues()}
-            return res
+        res = {k: v for k, v in self._attrs.iteritems() if k != "evaluatedInfo"}
+        res['resources'] = {r.name: r.export() for r in self.resources.itervalues()}
+        return res
 
 
     def import_(self, attrs):
@@ -194,39 +300,49 @@ class Deployment(object):
             self._db.execute("insert into DeploymentAttrs (deployment, name, value) " +
                              "select ?, name, value from DeploymentAttrs where deployment = ?",
                              (new.uuid, self.uuid))
+            new._load_attrs()
             new.configs_path = None
+            new.configs_digest = None
             return new
 
 
-    def _get_deployment_lock(self):
-        if self._lock_file_path is None:
+    def _get_deployment_lock(self, exclusive=True):
+        """Return a context manager that holds the deployment lock in
+        exclusive mode (for operations that change the deployment) or
+        in shared mode (for operations that only read it, such as
+        evaluation and building).  Nested uses share the lock taken by
+        the outermost one, promoting it to exclusive if necessary."""
+        if self._deployment_lock is None:
             lock_dir = os.environ.get("HOME", "") + "/.nixops/locks"
             if not os.path.exists(lock_dir): os.makedirs(lock_dir, 0700)
             self._lock_file_path = lock_dir + "/" + self.uuid
-        class DeploymentLock(object):
-            def __init__(self, depl):
-                self._lock_file_path = depl._lock_file_path
-                self._logger = depl.logger
-                self._lock_file = None
-            def __enter__(self):
-                self._lock_file = open(self._lock_file_path, "w")
-                fcntl.fcntl(self._lock_file, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
-                try:
-                    fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                except IOError:
-                    self._logger.log(
-                        "waiting for exclusive deployment lock..."
-                    )
-                    fcntl.flock(self._lock_file, fcntl.LOCK_EX)
-            def __exit__(self, exception_type, exception_value, exception_traceback):
-                self._lock_file.close()
-        return DeploymentLock(self)
+            self._deployment_lock = DeploymentLock(self._lock_file_path, self.logger, on_acquire=self._reload)
+        return self._deployment_lock.hold(exclusive)
+
+    def _upgrade_deployment_lock(self):
+        """Promote a shared deployment lock held by this process to an
+        exclusive one for the rest of the operation."""
+        if self._deployment_lock is not None:
+            self._deployment_lock.upgrade()
+
+    def _downgrade_deployment_lock(self):
+        """Let other processes read the deployment again while this one
+        does work that doesn't change it."""
+        if self._deployment_lock is not None:
+            self._db.flush()
+            self._deployment_lock.downgrade()
+
+    @property
+    def lock_wait_time(self):
+        """Seconds spent waiting for the deployment lock."""
+        return self._deployment_lock.wait_time if self._deployment_lock else 0.0
 
 
     def delete_resource(self, m):
         del self.resources[m.name]
         with self._db:
             self._db.execute("delete from Resources where deployment = ? and id = ?", (self.uuid, m.id))
+            self._resource_attrs.pop(m.id, None)
 
 
     def delete(self, force=False):
@@ -241,6 +357,8 @@ class Deployment(object):
             for p in glob.glob(profile + "*"):
                 if os.path.islink(p): os.remove(p)
 
+            self._delete_evaluated_info()
+
             # Delete the deployment from the database.
             self._db.execute("delete from Deployments where uuid = ?", (self.uuid,))
 
@@ -288,6 +406,10 @@ class Deployment(object):
 
     def evaluate_args(self):
         """Evaluate the NixOps network expression's arguments."""
+        evaluation = self._memoized_evaluation()
+        if evaluation: return evaluation["arguments"]
+        # Don't do a full evaluation here, since it may fail precisely
+        # because of missing arguments.
         try:
             out = subprocess.check_output(
                 ["nix-instantiate"]
@@ -295,7 +417,7 @@ class Deployment(object):
                 + self._eval_flags(self.nix_exprs) +
                 ["--eval-only", "--json", "--strict",
                  "-A", "nixopsArguments"], stderr=self.logger.log_file)
-            if debug: print >> sys.stderr, "JSON output of nix-instantiate:\n" + xml
+            if debug: print >> sys.stderr, "JSON output of nix-instantiate:\n" + out
             return json.loads(out)
         except OSError as e:
             raise Exception("unable to run ‘nix-instantiate’: {0}".format(e))
@@ -303,68 +425,250 @@ class Deployment(object):
             raise NixEvalError
 
 
-    def evaluate(self):
-        """Evaluate the Nix expressions belonging to this deployment into a deployment specification."""
+    def _evaluation_flags(self, names=None):
+        return (self.extra_nix_eval_flags
+                + self._eval_flags(self.nix_exprs) +
+                ["--eval-only", "--json", "--strict",
+                 "--arg", "checkConfigurationOptions", "false",
+                 "-A", "evaluation"]
+                + (["--arg", "evalNames", py2nix(names, inline=True)] if names is not None else []))
+
+
+    def _memoized_evaluation(self, names=None):
+        """Return the result of _evaluate() if it has already been
+        computed with the current arguments, and None otherwise."""
+        if self._evaluation and self._evaluation[0] == self._evaluation_flags(names):
+            return self._evaluation[1]
+        return None
+
+
+    def _evaluate(self, names=None):
+        """Evaluate the ‘evaluation’ attribute of eval-machine-info.nix,
+        which returns everything NixOps needs from the network
+        expressions (the deployment info, the arguments and the Nixpkgs
+        path) in a single nix-instantiate call, together with the NixOS
+        version suffix (see _version_suffix()).  The
+        result is memoized for the rest of the command.  If ‘names’
+        is given, the deployment info only covers those machines and
+        the machines they refer to.  Otherwise, the machines are split
+        over ‘eval_shards’ nix-instantiate processes."""
+
+        evaluation = self._memoized_evaluation(names)
+        if evaluation: return evaluation
+
+        flags = self._evaluation_flags(names)
+        if names is None and self.eval_shards > 1:
+            evaluation = self._evaluate_sharded()
+        else:
+            evaluation = self._run_evaluation(flags)
+        self._evaluation = (flags, evaluation)
+        return evaluation
+
+
+    def _run_evaluation(self, flags):
+        """Run nix-instantiate with ‘flags’ and return its JSON output,
+        using the evaluation cache if possible."""
+        key = None
+        out = None
+        if self.eval_cache:
+            key = nixops.eval_cache.compute_key(
+                flags, self.nix_exprs, "<nixops/eval-machine-info.nix>", self._nix_path_flags())
+            if key: out = self.eval_cache.get(key)
+
+        if out is None:
+            try:
+                out = subprocess.check_output(["nix-instantiate"] + flags, stderr=self.logger.log_file)
+                if debug: print >> sys.stderr, "JSON output of nix-instantiate:\n" + out
+            except OSError as e:
+                raise Exception("unable to run ‘nix-instantiate’: {0}".format(e))
+            except subprocess.CalledProcessError:
+                raise NixEvalError
+            evaluation = json.loads(out)
+            # The key covers the revision of Nixpkgs, so the version
+            # suffix can be cached along with the evaluation.
+            if isinstance(evaluation, dict) and "nixpkgs" in evaluation:
+                evaluation["nixpkgs"]["versionSuffix"] = self._version_suffix(evaluation["nixpkgs"]["path"])
+                out = json.dumps(evaluation)
+            if key: self.eval_cache.put(key, out)
+            return evaluation
+
+        return json.loads(out)
+
+
+    def _version_suffix(self, nixpkgs_path):
+        """Return the NixOS version suffix if we're building from Git,
+        and None otherwise.  That way ‘nixos-version’ will show
+        something useful on the target machines."""
+        if nixpkgs_path not in self._version_suffixes:
+            nixos_path = nixpkgs_path + "/nixos"
+            get_version_script = nixos_path + "/modules/installer/tools/get-version-suffix"
+            suffix = None
+            if os.path.exists(nixos_path + "/.git") and os.path.exists(get_version_script):
+                suffix = subprocess.check_output(["/bin/sh", get_version_script] + self._nix_path_flags()).rstrip()
+            self._version_suffixes[nixpkgs_path] = suffix
+        return self._version_suffixes[nixpkgs_path]
+
+
+    def _machine_names(self):
+        """Return the names of the machines in the network."""
+        return self._run_evaluation(
+            self.extra_nix_eval_flags
+            + self._eval_flags(self.nix_exprs) +
+            ["--eval-only", "--json", "--strict", "-A", "machineNames"])
+
+
+    def _shards(self, names):
+        """Split ‘names’ into at most ‘eval_shards’ non-empty lists."""
+        names = sorted(names)
+        return [names[n::self.eval_shards] for n in range(min(self.eval_shards, len(names)))]
+
+
+    def _evaluate_sharded(self):
+        """Evaluate the network in parallel processes that each cover
+        a subset of the machines, and merge the results."""
+        shards = self._shards(self._machine_names())
+        if len(shards) <= 1: return self._run_evaluation(self._evaluation_flags())
+
+        def worker((n, shard)):
+            start = time.time()
+            evaluation = self._run_evaluation(self._evaluation_flags(shard))
+            self.logger.log("evaluated shard {0}/{1} ({2} machines) in {3:.1f}s"
+                            .format(n + 1, len(shards), len(shard), time.time() - start))
+            return evaluation
+
+        results = nixops.parallel.run_tasks(nr_workers=len(shards), tasks=enumerate(shards), worker_fun=worker)
+
+        # Shards also contain the machines their machines refer to, and
+        # all resources, so the union is the full network.
+        evaluation = results[0]
+        info = evaluation["info"]
+        for res in results[1:]:
+            info["machines"].update(res["info"]["machines"])
+            for res_type, defs in res["info"]["resources"].iteritems():
+                info["resources"].setdefault(res_type, {}).update(defs)
+        return evaluation
+
+
+    def _evaluation_inputs(self):
+        """Return a hash of the arguments of the evaluation, which
+        change with e.g. ‘nixops modify’ and ‘nixops set-args’."""
+        return hashlib.sha256(json.dumps([self._evaluation_flags(), os.environ.get("NIX_PATH", "")])).hexdigest()
+
+
+    def _evaluate_info(self, names=None):
+        """Return the ‘info’ attribute of eval-machine-info.nix and the
+        JSON of the previous one, without changing the deployment.  If
+        ‘names’ is given, only those machines, the machines they refer
+        to and the resources are evaluated.  The definitions of the
+        other machines are those of the previous evaluation, as are
+        those of resources that are only referenced by them, unless
+        that evaluation had different arguments; then all machines are
+        evaluated."""
+        stored = self._read_evaluated_info()
+        previous = json.loads(stored) if stored else None
+        if previous and previous.get("inputs") != self._evaluation_inputs():
+            previous = None
+        if names is None or previous is None:
+            info = self._evaluate()["info"]
+        else:
+            info = self._evaluate(names)["info"]
+            previous = previous["info"]
+            machines = previous["machines"]
+            # Requested machines that weren't evaluated no longer exist.
+            for name in names: machines.pop(name, None)
+            machines.update(info["machines"])
+            resources = previous["resources"]
+            for res_type, defs in info["resources"].iteritems():
+                resources.setdefault(res_type, {}).update(defs)
+            info = {"network": info["network"], "machines": machines, "resources": resources}
+        return (info, stored)
+
+
+    def evaluate(self, names=None):
+        """Evaluate the Nix expressions belonging to this deployment
+        into a deployment specification (see _evaluate_info())."""
 
         self.definitions = {}
 
+        (info, stored) = self._evaluate_info(names)
+
+        out = json.dumps({"inputs": self._evaluation_inputs(), "info": info}, sort_keys=True)
+        if out != stored: self._write_evaluated_info(out)
+
+        self._set_definitions(info)
+
+
+    # The JSON of the ‘info’ attribute of the last evaluation is kept
+    # in a file, together with the hash of its arguments, used to fill
+    # in the machines that a partial evaluation leaves out.  It isn't part of the state file, since it can be
+    # large and contains the text of keys.
+
+    def _evaluated_info_path(self):
+        return "{0}/.nixops/evaluations/{1}.json".format(os.environ.get("HOME", ""), self.uuid)
+
+    def _read_evaluated_info(self):
         try:
-            # FIXME: use --json
-            xml = subprocess.check_output(
-                ["nix-instantiate"]
-                + self.extra_nix_eval_flags
-                + self._eval_flags(self.nix_exprs) +
-                ["--eval-only", "--xml", "--strict",
-                 "--arg", "checkConfigurationOptions", "false",
-                 "-A", "info"], stderr=self.logger.log_file)
-            if debug: print >> sys.stderr, "XML output of nix-instantiate:\n" + xml
+            with open(self._evaluated_info_path()) as f: return f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT: raise
+            return None
+
+    def _write_evaluated_info(self, out):
+        path = self._evaluated_info_path()
+        if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path), 0700)
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        with os.fdopen(fd, "w") as f: f.write(out)
+        os.rename(tmp, path)
+        # Older versions kept it in the state file.
+        if "evaluatedInfo" in self._attrs: self._del_attr("evaluatedInfo")
+
+    def _delete_evaluated_info(self):
+        try:
+            os.remove(self._evaluated_info_path())
         except OSError as e:
-            raise Exception("unable to run ‘nix-instantiate’: {0}".format(e))
-        except subprocess.CalledProcessError:
-            raise NixEvalError
+            if e.errno != errno.ENOENT: raise
 
-        tree = ElementTree.fromstring(xml)
 
-        # Convert the XML to a more Pythonic representation. This is
-        # in fact the same as what json.loads() on the output of
-        # "nix-instantiate --json" would yield.
-        config = nixops.util.xml_expr_to_python(tree.find("*"))
+    def _set_definitions(self, config):
+        """Create the resource definitions from the JSON representation
+        of the ‘info’ attribute of eval-machine-info.nix."""
+
+        self.definitions = {}
 
         # Extract global deployment attributes.
         self.description = config["network"].get("description", self.default_description)
         self.rollback_enabled = config["network"].get("enableRollback", False)
 
         # Extract machine information.
-        for x in tree.findall("attrs/attr[@name='machines']/attrs/attr"):
-            name = x.get("name")
-            cfg = config["machines"][name]
-            defn = _create_definition(x, cfg, cfg["targetEnv"])
-            self.definitions[name] = defn
+        for name, cfg in config["machines"].iteritems():
+            xml = nixops.util.LazyXmlAttr(name, cfg)
+            self.definitions[name] = _create_definition(xml, cfg, cfg["targetEnv"])
 
         # Extract info about other kinds of resources.
-        for x in tree.findall("attrs/attr[@name='resources']/attrs/attr"):
-            res_type = x.get("name")
-            for y in x.findall("attrs/attr"):
-                name = y.get("name")
-                defn = _create_definition(y, config["resources"][res_type][name], res_type)
-                self.definitions[name] = defn
+        for res_type, defs in config["resources"].iteritems():
+            for name, cfg in defs.iteritems():
+                xml = nixops.util.LazyXmlAttr(name, cfg)
+                self.definitions[name] = _create_definition(xml, cfg, res_type)
 
 
-    def evaluate_option_value(self, machine_name, option_name, xml=False, include_physical=False):
-        """Evaluate a single option of a single machine in the deployment specification."""
-
-        exprs = self.nix_exprs
+    def _option_exprs(self, include_physical):
+        exprs = list(self.nix_exprs)
         if include_physical:
             phys_expr = self.tempdir + "/physical.nix"
             with open(phys_expr, 'w') as f:
-                f.write(self.get_physical_spec())
+                self.write_physical_spec(f)
             exprs.append(phys_expr)
+        return exprs
+
+
+    def evaluate_option_value(self, machine_name, option_name, xml=False, include_physical=False):
+        """Evaluate a single option of a single machine in the deployment specification."""
 
         try:
             return subprocess.check_output(
                 ["nix-instantiate"]
                 + self.extra_nix_eval_flags
-                + self._eval_flags(exprs) +
+                + self._eval_flags(self._option_exprs(include_physical)) +
                 ["--eval-only", "--strict",
                  "--arg", "checkConfigurationOptions", "false",
                  "-A", "nodes.{0}.config.{1}".format(machine_name, option_name)]
@@ -374,6 +678,33 @@ class Deployment(object):
             raise NixEvalError
 
 
+    def evaluate_option_values(self, pairs, include_physical=False):
+        """Evaluate the options of the machines given by the list of
+        (machine name, option name) tuples ‘pairs’ in a single
+        nix-instantiate call.  Return a dictionary mapping machine
+        names to dictionaries mapping option names to their values."""
+
+        options = {}
+        for (machine_name, option_name) in pairs:
+            options.setdefault(machine_name, {})[option_name] = _option_path(option_name)
+        if not options: return {}
+
+        try:
+            return json.loads(subprocess.check_output(
+                ["nix-instantiate"]
+                + self.extra_nix_eval_flags
+                + self._eval_flags(self._option_exprs(include_physical)) +
+                ["--eval-only", "--strict", "--json",
+                 "--arg", "checkConfigurationOptions", "false",
+                 "--arg", "options", py2nix(options, inline=True),
+                 "-A", "optionValues"],
+                stderr=self.logger.log_file))
+        except OSError as e:
+            raise Exception("unable to run ‘nix-instantiate’: {0}".format(e))
+        except subprocess.CalledProcessError:
+            raise NixEvalError
+
+
     def get_arguments(self):
         try:
             return self.evaluate_args()
@@ -383,10 +714,23 @@ class Deployment(object):
 
     def get_physical_spec(self):
         """Compute the contents of the Nix expression specifying the computed physical deployment attributes"""
+        f = StringIO.StringIO()
+        self.write_physical_spec(f)
+        return f.getvalue()
+
+
+    def write_physical_spec(self, f):
+        """Write the Nix expression specifying the computed physical
+        deployment attributes to the file object ‘f’."""
 
         active_machines = self.active
         active_resources = self.active_resources
 
+        # Visit everything in a fixed order, so that the output only
+        # changes if the deployment does (see build_configs()).
+        sorted_machines = sorted(active_machines.itervalues(), key=lambda m: m.name)
+        sorted_resources = sorted(active_resources.itervalues(), key=lambda r: r.name)
+
         attrs_per_resource = {m.name: [] for m in active_resources.itervalues()}
         authorized_keys = {m.name: [] for m in active_machines.itervalues()}
         kernel_modules = {m.name: set() for m in active_machines.itervalues()}
@@ -406,6 +750,19 @@ class Deployment(object):
         # lookups.
         hosts = defaultdict(lambda: defaultdict(list))
 
+        # The addresses of all resources as seen from each machine.
+        # These are the same for most machines, so each distinct table
+        # is emitted once as a module shared by the machines using it,
+        # rather than once per machine.
+        network_hosts = {}
+
+        def format_hosts(hosts):
+            # Sort the hosts by its canonical host names.
+            sorted_hosts = sorted(hosts.iteritems(), key=lambda item: (item[1][0], item[0]))
+            # Just to remember the format:
+            #   ip_address canonical_hostname [aliases...]
+            return "".join("{0} {1}\n".format(ip, ' '.join(names)) for ip, names in sorted_hosts)
+
         def index_to_private_ip(index):
             n = 105 + index / 256
             assert n <= 255
@@ -416,10 +773,12 @@ class Deployment(object):
             attrs_list = attrs_per_resource[m.name]
 
             # Emit configuration to realise encrypted peer-to-peer links.
-            for m2 in active_resources.itervalues():
+            addresses = defaultdict(list)
+            for m2 in sorted_resources:
                 ip = m.address_to(m2)
                 if ip:
-                    hosts[m.name][ip] += [m2.name, m2.name + "-unencrypted"]
+                    addresses[ip] += [m2.name, m2.name + "-unencrypted"]
+            network_hosts[m.name] = format_hosts(addresses)
 
             # Always use the encrypted/unencrypted suffixes for aliases rather
             # than for the canonical name!
@@ -488,20 +847,46 @@ class Deployment(object):
                     ('system', 'nixosVersionSuffix'): self.nixos_version_suffix
                 })
 
-        for m in active_machines.itervalues():
+        for m in sorted_machines:
             do_machine(m)
 
+        # Modules shared between machines, as (name, module) pairs.
+        shared_modules = []
+
+        # Add SSH public host keys for all machines in network.
+        known_hosts = {}
+        for m2 in sorted_machines:
+            if hasattr(m2, 'public_host_key') and m2.public_host_key:
+                # Using references to files in same tempdir for now, until NixOS has support
+                # for adding the keys directly as string. This way at least it is compatible
+                # with older versions of NixOS as well.
+                # TODO: after reasonable amount of time replace with string option
+                known_hosts[m2.name] = {
+                    'hostNames': [m2.name + "-unencrypted",
+                                  m2.name + "-encrypted",
+                                  m2.name],
+                    'publicKey': m2.public_host_key,
+                }
+        if known_hosts:
+            shared_modules.append(("knownHosts", Function("{ config, lib, pkgs, ... }", {
+                'config': {('services', 'openssh', 'knownHosts'): known_hosts},
+            })))
+
+        hosts_modules = {}
+        for name in sorted(network_hosts):
+            if network_hosts[name] and network_hosts[name] not in hosts_modules:
+                hosts_modules[network_hosts[name]] = "hosts{0}".format(len(hosts_modules))
+                shared_modules.append((hosts_modules[network_hosts[name]], Function("{ config, lib, pkgs, ... }", {
+                    'config': {('networking', 'extraHosts'): network_hosts[name]},
+                })))
+
         def emit_resource(r):
             config = []
             config.extend(attrs_per_resource[r.name])
+            imports = []
             if is_machine(r):
-                # Sort the hosts by its canonical host names.
-                sorted_hosts = sorted(hosts[r.name].iteritems(),
-                                      key=lambda item: item[1][0])
-                # Just to remember the format:
-                #   ip_address canonical_hostname [aliases...]
-                extra_hosts = ["{0} {1}".format(ip, ' '.join(names))
-                               for ip, names in sorted_hosts]
+                if known_hosts: imports.append(RawValue("knownHosts"))
+                if network_hosts[r.name]: imports.append(RawValue(hosts_modules[network_hosts[r.name]]))
 
                 if authorized_keys[r.name]:
                     config.append({
@@ -514,46 +899,38 @@ class Deployment(object):
                     })
 
                 config.append({
-                    ('boot', 'kernelModules'): list(kernel_modules[r.name]),
+                    ('boot', 'kernelModules'): sorted(kernel_modules[r.name]),
                     ('networking', 'firewall'): {
-                        'trustedInterfaces': list(trusted_interfaces[r.name])
+                        'trustedInterfaces': sorted(trusted_interfaces[r.name])
                     },
-                    ('networking', 'extraHosts'): '\n'.join(extra_hosts) + "\n"
+                    ('networking', 'extraHosts'): format_hosts(hosts[r.name])
                 })
 
-
-                # Add SSH public host keys for all machines in network.
-                for m2 in active_machines.itervalues():
-                    if hasattr(m2, 'public_host_key') and m2.public_host_key:
-                        # Using references to files in same tempdir for now, until NixOS has support
-                        # for adding the keys directly as string. This way at least it is compatible
-                        # with older versions of NixOS as well.
-                        # TODO: after reasonable amount of time replace with string option
-                        config.append({
-                            ('services', 'openssh', 'knownHosts', m2.name): {
-                                 'hostNames': [m2.name + "-unencrypted",
-                                               m2.name + "-encrypted",
-                                               m2.name],
-                                 'publicKey': m2.public_host_key,
-                            }
-                        })
-
-            merged = reduce(nixmerge, config) if len(config) > 0 else {}
+            merged = NixMergeBuilder()
+            for c in config: merged.add(c)
             physical = r.get_physical_spec()
 
-            if len(merged) == 0 and len(physical) == 0:
+            if len(merged.value) == 0 and len(physical) == 0:
                 return {}
             else:
                 return r.prefix_definition({
                     r.name: Function("{ config, lib, pkgs, ... }", {
-                        'config': merged,
-                        'imports': [physical],
+                        'config': merged.value,
+                        'imports': imports + [physical],
                     })
                 })
 
-        return py2nix(reduce(nixmerge, [
-            emit_resource(r) for r in active_resources.itervalues()
-        ], {})) + "\n"
+        if shared_modules:
+            f.write("let\n")
+            for name, module in shared_modules:
+                f.write("  {0} = {1};\n".format(name, py2nix(module, initial_indentation=1).lstrip()))
+            f.write("in\n")
+
+        network = NixMergeBuilder()
+        for r in sorted_resources:
+            network.add(emit_resource(r))
+        py2nix_to_file(network.value, f)
+        f.write("\n")
 
     def get_profile(self):
         profile_dir = "/nix/var/nix/profiles/per-user/" + getpass.getuser()
@@ -569,28 +946,72 @@ class Deployment(object):
         return profile
 
 
-    def build_configs(self, include, exclude, dry_run=False, repair=False):
-        """Build the machine configurations in the Nix store."""
-
-        self.logger.log("building all machine configurations...")
+    def _build_sharded(self, phys_expr, shards, dry_run, repair):
+        """Instantiate the configurations of each shard of machines in
+        a separate nix-instantiate process, build them together and
+        return a store path combining them."""
 
-        # Set the NixOS version suffix, if we're building from Git.
-        # That way ‘nixos-version’ will show something useful on the
-        # target machines.
-        nixos_path = subprocess.check_output(
-            ["nix-instantiate", "--find-file", "nixpkgs/nixos"] + self._nix_path_flags()).rstrip()
-        get_version_script = nixos_path + "/modules/installer/tools/get-version-suffix"
-        if os.path.exists(nixos_path + "/.git") and os.path.exists(get_version_script):
-            self.nixos_version_suffix = subprocess.check_output(["/bin/sh", get_version_script] + self._nix_path_flags()).rstrip()
+        def instantiate((n, shard)):
+            start = time.time()
+            drv = subprocess.check_output(
+                ["nix-instantiate"]
+                + self._eval_flags(self.nix_exprs + [phys_expr]) +
+                ["--arg", "names", py2nix(shard, inline=True), "-A", "machines",
+                 "--add-root", "{0}/shard-{1}.drv".format(self.tempdir, n), "--indirect"],
+                stderr=self.logger.log_file).rstrip()
+            self.logger.log("instantiated shard {0}/{1} ({2} machines) in {3:.1f}s"
+                            .format(n + 1, len(shards), len(shard), time.time() - start))
+            return drv
+
+        drvs = nixops.parallel.run_tasks(nr_workers=len(shards), tasks=enumerate(shards), worker_fun=instantiate)
+
+        paths = subprocess.check_output(
+            ["nix-store", "-r"] + self.extra_nix_flags + drvs
+            + (["--dry-run"] if dry_run else [])
+            + (["--repair"] if repair else []),
+            stderr=self.logger.log_file).split()
+        if dry_run: return None
+
+        return subprocess.check_output(
+            ["nix-build"]
+            + self._eval_flags(self.nix_exprs) +
+            ["--arg", "paths", py2nix(paths, inline=True),
+             "-A", "combineMachines", "-o", self.tempdir + "/configs"],
+            stderr=self.logger.log_file).rstrip()
+
+
+    def _configs_digest(self, phys_expr, names):
+        """Return a hash of everything the build of the configurations
+        of the machines ‘names’ depends on, or None if that can't be
+        determined.  The key of the evaluation cache is None if the
+        network expressions read anything it doesn't cover, so the
+        build is only skipped if the digest is complete."""
+        if not self.eval_cache: return None
+        key = nixops.eval_cache.compute_key(
+            self._eval_flags(self.nix_exprs), self.nix_exprs,
+            "<nixops/eval-machine-info.nix>", self._nix_path_flags())
+        if not key: return None
+        digest = hashlib.sha256()
+        digest.update(key + "\0" + " ".join(sorted(names)) + "\0")
+        with open(phys_expr) as f: digest.update(f.read())
+        return digest.hexdigest()
+
+
+    def _prepare_build(self, selected):
+        """Write the physical specification and set up remote builds
+        if needed for building the configurations of the machines
+        ‘selected’.  Return the path of the physical specification."""
+
+        # Set the NixOS version suffix that came with the evaluation.
+        # Any evaluation will do, since Nixpkgs doesn't depend on which
+        # machines were evaluated.
+        evaluation = self._evaluation[1] if self._evaluation else self._evaluate()
+        self.nixos_version_suffix = evaluation["nixpkgs"].get("versionSuffix")
 
         phys_expr = self.tempdir + "/physical.nix"
-        p = self.get_physical_spec()
-        nixops.util.write_file(phys_expr, p)
-        if debug: print >> sys.stderr, "generated physical spec:\n" + p
-
-        selected = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
-
-        names = map(lambda m: m.name, selected)
+        with open(phys_expr, "w") as f:
+            self.write_physical_spec(f)
+        if debug: print >> sys.stderr, "generated physical spec:\n" + open(phys_expr).read()
 
         # If we're not running on Linux, then perform the build on the
         # target machines.  FIXME: Also enable this if we're on 32-bit
@@ -620,123 +1041,430 @@ class Deployment(object):
             if not os.path.exists(load_dir): os.makedirs(load_dir, 0700)
             os.environ['NIX_CURRENT_LOAD'] = load_dir
 
-        try:
-            configs_path = subprocess.check_output(
-                ["nix-build"]
-                + self._eval_flags(self.nix_exprs + [phys_expr]) +
-                ["--arg", "names", py2nix(names, inline=True),
-                 "-A", "machines", "-o", self.tempdir + "/configs"]
-                + (["--dry-run"] if dry_run else [])
-                + (["--repair"] if repair else []),
-                stderr=self.logger.log_file).rstrip()
-        except subprocess.CalledProcessError:
-            raise Exception("unable to build all machine configurations")
+        return phys_expr
+
+
+    def _configs_up_to_date(self, digest):
+        return digest is not None and digest == self.configs_digest and self.configs_path is not None and \
+            subprocess.call(["nix-store", "--check-validity", self.configs_path],
+                            stderr=self.logger.log_file) == 0
 
-        if self.rollback_enabled and not dry_run:
+
+    def _update_profile(self, configs_path):
+        if self.rollback_enabled:
             profile = self.create_profile()
             if subprocess.call(["nix-env", "-p", profile, "--set", configs_path]) != 0:
                 raise Exception("cannot update profile ‘{0}’".format(profile))
 
+
+    def build_configs(self, include, exclude, dry_run=False, repair=False):
+        """Build the machine configurations in the Nix store."""
+
+        self.logger.log("building all machine configurations...")
+
+        selected = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+
+        names = map(lambda m: m.name, selected)
+
+        phys_expr = self._prepare_build(selected)
+
+        # Skip the build if nothing that goes into it has changed since
+        # the previous one, and its result still exists.
+        digest = None if repair else self._configs_digest(phys_expr, names)
+        if self._configs_up_to_date(digest):
+            self.logger.log("machine configurations are up to date")
+            return self.configs_path
+
+        try:
+            shards = self._shards(names)
+            if len(shards) > 1:
+                configs_path = self._build_sharded(phys_expr, shards, dry_run, repair)
+            else:
+                configs_path = subprocess.check_output(
+                    ["nix-build"]
+                    + self._eval_flags(self.nix_exprs + [phys_expr]) +
+                    ["--arg", "names", py2nix(names, inline=True),
+                     "-A", "machines", "-o", self.tempdir + "/configs"]
+                    + (["--dry-run"] if dry_run else [])
+                    + (["--repair"] if repair else []),
+                    stderr=self.logger.log_file).rstrip()
+        except subprocess.CalledProcessError:
+            raise Exception("unable to build all machine configurations")
+
+        if not dry_run:
+            self._upgrade_deployment_lock()
+            self._update_profile(configs_path)
+            # The caller records ‘configs_path’.
+            self.configs_digest = digest
+
         return configs_path
 
 
-    def copy_closures(self, configs_path, include, exclude, max_concurrent_copy):
-        """Copy the closure of each machine configuration to the corresponding machine."""
+    def _new_toplevel(self, m, configs_path):
+        m.new_toplevel = os.path.realpath(configs_path + "/" + m.name)
+        if not os.path.exists(m.new_toplevel):
+            raise Exception("can't find closure of machine ‘{0}’".format(m.name))
+        return m.new_toplevel
+
+
+    def _copy_closure(self, m, configs_path, missing=None):
+        """Copy the closure of the new configuration of machine ‘m’,
+        unless ‘missing’, the list of paths in it that the machine
+        doesn't have yet (see _probe_closures()), is empty."""
+        toplevel = self._new_toplevel(m, configs_path)
+        if missing == []:
+            m.logger.log("closure already present")
+            return
+        m.logger.log("copying closure...")
+        m.copy_closure_to(toplevel)
+
+
+    def _probe_closures(self, machines, configs_path):
+        """Ask all machines in ‘machines’ at the same time which paths
+        in the closure of their new configuration they don't have yet,
+        and log how much needs to be copied to each of them.  Return a
+        dictionary mapping the name of each machine to the missing
+        paths, or to None if that couldn't be determined."""
 
         def worker(m):
-            if not should_do(m, include, exclude): return
-            m.logger.log("copying closure...")
-            m.new_toplevel = os.path.realpath(configs_path + "/" + m.name)
-            if not os.path.exists(m.new_toplevel):
-                raise Exception("can't find closure of machine ‘{0}’".format(m.name))
-            m.copy_closure_to(m.new_toplevel)
-
-        nixops.parallel.run_tasks(
-            nr_workers=max_concurrent_copy,
-            tasks=self.active.itervalues(), worker_fun=worker)
+            closure = subprocess.check_output(
+                ["nix-store", "-qR", self._new_toplevel(m, configs_path)]).split()
+            try:
+                return (m, closure, m.get_invalid_paths(closure))
+            except nixops.ssh_util.SSHCommandFailed as e:
+                m.warn("cannot determine which paths are missing: {0}".format(e))
+                return (m, closure, None)
+
+        res = nixops.parallel.run_tasks(nr_workers=-1, tasks=machines, worker_fun=worker)
+
+        # Get the sizes of all missing paths in one go.
+        paths = sorted(set(p for (m, closure, missing) in res
+                           for p in (closure if missing is None else missing)))
+        process = subprocess.Popen(["xargs", "-r", "nix-store", "-q", "--size"],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out = process.communicate("".join(p + "\n" for p in paths))[0]
+        if process.returncode != 0:
+            raise Exception("unable to determine the sizes of the closures")
+        sizes = dict(zip(paths, map(int, out.split())))
+
+        total = 0
+        for (m, closure, missing) in sorted(res, key=lambda x: x[0].name):
+            size = sum(sizes[p] for p in (closure if missing is None else missing))
+            total += size
+            if missing is None:
+                m.logger.log("up to {0:.1f} MiB to copy".format(size / 1048576.0))
+            else:
+                m.logger.log("{0} of {1} paths missing ({2:.1f} MiB)"
+                             .format(len(missing), len(closure), size / 1048576.0))
+        self.logger.log("{0:.1f} MiB to copy to {1} machines"
+                        .format(total / 1048576.0, len([x for x in res if x[2] != []])))
+
+        return {m.name: missing for (m, closure, missing) in res}
+
+
+    def copy_closures(self, configs_path, include, exclude, max_concurrent_copy, copy_fanout=None):
+        """Copy the closure of each machine configuration to the corresponding machine."""
+
+        if copy_fanout:
+            self._copy_closures_fanout(configs_path, include, exclude, max_concurrent_copy, copy_fanout)
+        else:
+            machines = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+            missing = self._probe_closures(machines, configs_path)
+
+            def worker(m):
+                self._copy_closure(m, configs_path, missing[m.name])
+
+            nixops.parallel.run_tasks(
+                nr_workers=max_concurrent_copy,
+                tasks=machines, worker_fun=worker)
         self.logger.log(ansi_success("{0}> closures copied successfully".format(self.name), outfile=self.logger._log_file))
 
 
-    def activate_configs(self, configs_path, include, exclude, allow_reboot,
-                         force_reboot, check, sync, always_activate, dry_activate):
-        """Activate the new configuration on a machine."""
+    def _copy_closures_fanout(self, configs_path, include, exclude, max_concurrent_copy, copy_fanout):
+        """Copy the closures of the machine configurations from the
+        deployer to one machine in each copy group, and from there
+        along a tree of machines (see _copy_tree()).  Each machine
+        receives the closures of all machines below it in the tree.
+        Each machine that sends closures gets a temporary SSH key,
+        which its children only accept from its address for receiving
+        store paths.  The key is removed from the sender once its
+        children are done, and from the children after each copy."""
+
+        machines = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        for m in machines: self._new_toplevel(m, configs_path)
+
+        parent = _copy_tree(machines, copy_fanout)
+        children = defaultdict(list)
+        for m in machines:
+            if parent[m.name]: children[parent[m.name].name].append(m)
+
+        def subtree_paths(m):
+            return [m.new_toplevel] + [p for c in children[m.name] for p in subtree_paths(c)]
+
+        key_dir = "/run/nixops-copy-{0}".format(self.uuid)
+        public_keys = {}
+        # Senders that have the private key, and how many of their
+        # children still have to use it.
+        installed = set()
+        remaining = {name: len(cs) for name, cs in children.iteritems()}
+        lock = threading.Lock()
+
+        copy_from_deployer = threading.Semaphore(max_concurrent_copy)
+
+        def upload(m, name, contents):
+            tmp = "{0}/{1}-{2}".format(self.tempdir, name, m.name)
+            with os.fdopen(os.open(tmp, os.O_CREAT | os.O_WRONLY, 0600), "w") as f:
+                f.write(contents)
+            try:
+                with open(tmp) as f:
+                    m.run_command("umask 077 && mkdir -p {0} && cat > {0}/{1}".format(key_dir, name), stdin=f)
+            finally:
+                os.remove(tmp)
+
+        def install_key(m):
+            (private_key, public_keys[m.name]) = nixops.util.create_key_pair(
+                key_name="NixOps closure copy key of {0}".format(m.name))
+            with lock: installed.add(m.name)
+            upload(m, "key", private_key)
+            # The sender checks the identity of its children against
+            # the host keys that NixOps knows.
+            upload(m, "known_hosts", "".join(
+                "{0} {1}\n".format(m.address_to(c) if c.ssh_port == 22 else "[{0}]:{1}".format(m.address_to(c), c.ssh_port),
+                                   c.public_host_key)
+                for c in children[m.name]))
+
+        def remove_key(m):
+            m.run_command("rm -rf {0}".format(key_dir))
+            with lock: installed.discard(m.name)
+
+        def child_done(p):
+            with lock:
+                remaining[p.name] -= 1
+                last = remaining[p.name] == 0
+            if last: remove_key(p)
 
         def worker(m):
-            if not should_do(m, include, exclude): return
+            paths = subtree_paths(m)
+            p = parent[m.name]
+            if p:
+                m.logger.log("copying closure from ‘{0}’...".format(p.name))
+                public_key = public_keys[p.name]
+                try:
+                    m.run_command("umask 077 && mkdir -p /root/.ssh && echo '{0}' >> /root/.ssh/authorized_keys"
+                                  .format('from="{0}",restrict,command="nix-store --serve --write" {1}'
+                                          .format(m.address_to(p), public_key)))
+                    m.copy_closure_from(p, paths, key_dir + "/key", key_dir + "/known_hosts")
+                finally:
+                    try:
+                        m.run_command("sed -i '\\|{0}|d' /root/.ssh/authorized_keys"
+                                      .format(public_key.split()[1]))
+                    finally:
+                        child_done(p)
+            else:
+                with copy_from_deployer:
+                    m.logger.log("copying closure...")
+                    m.copy_closure_to(*paths)
+            if children[m.name]: install_key(m)
+
+        graph = nixops.parallel.TaskGraph(machines, lambda m: filter(None, [parent[m.name]]))
+        try:
+            graph.run(-1, worker)
+        finally:
+            # Remove the keys of senders whose children didn't all run.
+            nixops.parallel.run_tasks(nr_workers=-1, worker_fun=remove_key,
+                                      tasks=[m for m in machines if m.name in installed])
+
+
+    def build_and_copy(self, include, exclude, max_concurrent_build, max_concurrent_copy, repair=False):
+        """Build the configuration of each machine separately and copy
+        its closure to the machine as soon as it has been built.
+        Return the path of the machine configurations, like
+        build_configs()."""
+
+        self.logger.log("building machine configurations...")
+
+        selected = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        names = [m.name for m in selected]
 
+        phys_expr = self._prepare_build(selected)
+
+        digest = None if repair else self._configs_digest(phys_expr, names)
+        if self._configs_up_to_date(digest):
+            self.logger.log("machine configurations are up to date")
+            self.copy_closures(self.configs_path, include=include, exclude=exclude,
+                               max_concurrent_copy=max_concurrent_copy)
+            return self.configs_path
+
+        # Instantiate all configurations in a single evaluation.
+        try:
+            drvs = json.loads(subprocess.check_output(
+                ["nix-instantiate", "--eval-only", "--strict", "--json", "--read-write-mode"]
+                + self._eval_flags(self.nix_exprs + [phys_expr]) +
+                ["--arg", "names", py2nix(names, inline=True), "-A", "toplevelDrvs"],
+                stderr=self.logger.log_file))
+        except subprocess.CalledProcessError:
+            raise Exception("unable to evaluate the machine configurations")
+
+        # Each configuration is registered as a GC root in
+        # ‘toplevels’, which then serves as the configurations path
+        # for _copy_closure().
+        toplevels_dir = self.tempdir + "/toplevels"
+        if not os.path.exists(toplevels_dir): os.makedirs(toplevels_dir)
+
+        def build(m):
+            start = time.time()
+            m.logger.log("building configuration...")
             try:
-                # Set the system profile to the new configuration.
-                daemon_var = '' if m.state == m.RESCUE else 'env NIX_REMOTE=daemon '
-                setprof = daemon_var + 'nix-env -p /nix/var/nix/profiles/system --set "{0}"'
-                if always_activate or self.definitions[m.name].always_activate:
-                    m.run_command(setprof.format(m.new_toplevel))
-                else:
-                    # Only activate if the profile has changed.
-                    new_profile_cmd = '; '.join([
-                        'old_gen="$(readlink -f /nix/var/nix/profiles/system)"',
-                        'new_gen="$(readlink -f "{0}")"',
-                        '[ "x$old_gen" != "x$new_gen" ] || exit 111',
-                        setprof
-                    ]).format(m.new_toplevel)
-
-                    ret = m.run_command(new_profile_cmd, check=False)
-                    if ret == 111:
-                        m.log("configuration already up to date")
-                        return
-                    elif ret != 0:
-                        raise Exception("unable to set new system profile")
-
-                m.send_keys()
-
-                if force_reboot or m.state == m.RESCUE:
-                    switch_method = "boot"
-                elif dry_activate:
-                    switch_method = "dry-activate"
-                else:
-                    switch_method = "switch"
-
-                # Run the switch script.  This will also update the
-                # GRUB boot loader.
-                res = m.switch_to_configuration(switch_method, sync)
-
-                if dry_activate: return
-
-                if res != 0 and res != 100:
-                    raise Exception("unable to activate new configuration")
-
-                if res == 100 or force_reboot or m.state == m.RESCUE:
-                    if not allow_reboot and not force_reboot:
-                        raise Exception("the new configuration requires a "
-                                        "reboot to take effect (hint: use "
-                                        "‘--allow-reboot’)".format(m.name))
-                    m.reboot_sync()
-                    res = 0
-                    # FIXME: should check which systemd services
-                    # failed to start after the reboot.
-
-                if res == 0:
-                    m.success("activation finished successfully")
-
-                # Record that we switched this machine to the new
-                # configuration.
-                m.cur_configs_path = configs_path
-                m.cur_toplevel = m.new_toplevel
-
-            except Exception as e:
-                # This thread shouldn't throw an exception because
-                # that will cause NixOps to exit and interrupt
-                # activation on the other machines.
-                m.logger.error(traceback.format_exc())
-                return m.name
-            return None
+                subprocess.check_output(
+                    ["nix-store", "-r", drvs[m.name],
+                     "--add-root", toplevels_dir + "/" + m.name, "--indirect"]
+                    + self.extra_nix_flags
+                    + (["--repair"] if repair else []),
+                    stderr=self.logger.log_file)
+            except subprocess.CalledProcessError:
+                raise Exception("unable to build the configuration of machine ‘{0}’".format(m.name))
+            m.logger.log("configuration built in {0:.1f}s".format(time.time() - start))
+            return m
+
+        def copy(m):
+            self._copy_closure(m, toplevels_dir)
+
+        nixops.parallel.run_pipeline(
+            tasks=selected, stages=[(max_concurrent_build, build), (max_concurrent_copy, copy)])
+        self.logger.log(ansi_success("{0}> closures copied successfully".format(self.name), outfile=self.logger._log_file))
 
-        res = nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
+        toplevels = {name: os.path.realpath(toplevels_dir + "/" + name) for name in names}
+        try:
+            configs_path = subprocess.check_output(
+                ["nix-build"]
+                + self._eval_flags(self.nix_exprs) +
+                ["--arg", "toplevels", py2nix(toplevels, inline=True),
+                 "-A", "linkMachines", "-o", self.tempdir + "/configs"],
+                stderr=self.logger.log_file).rstrip()
+        except subprocess.CalledProcessError:
+            raise Exception("unable to build all machine configurations")
+
+        self._update_profile(configs_path)
+        self.configs_digest = digest
+
+        return configs_path
+
+
+    def _activate_config(self, m, configs_path, allow_reboot, force_reboot,
+                         sync, always_activate, dry_activate):
+        """Activate the new configuration on machine ‘m’.  Return the
+        name of the machine if that failed, and None otherwise."""
+
+        try:
+            # Set the system profile to the new configuration.
+            daemon_var = '' if m.state == m.RESCUE else 'env NIX_REMOTE=daemon '
+            setprof = daemon_var + 'nix-env -p /nix/var/nix/profiles/system --set "{0}"'
+            if always_activate or self.definitions[m.name].always_activate:
+                m.run_command(setprof.format(m.new_toplevel))
+            else:
+                # Only activate if the profile has changed.
+                new_profile_cmd = '; '.join([
+                    'old_gen="$(readlink -f /nix/var/nix/profiles/system)"',
+                    'new_gen="$(readlink -f "{0}")"',
+                    '[ "x$old_gen" != "x$new_gen" ] || exit 111',
+                    setprof
+                ]).format(m.new_toplevel)
+
+                ret = m.run_command(new_profile_cmd, check=False)
+                if ret == 111:
+                    m.log("configuration already up to date")
+                    return
+                elif ret != 0:
+                    raise Exception("unable to set new system profile")
+
+            m.send_keys()
+
+            if force_reboot or m.state == m.RESCUE:
+                switch_method = "boot"
+            elif dry_activate:
+                switch_method = "dry-activate"
+            else:
+                switch_method = "switch"
+
+            # Run the switch script.  This will also update the
+            # GRUB boot loader.
+            res = m.switch_to_configuration(switch_method, sync)
+
+            if dry_activate: return
+
+            if res != 0 and res != 100:
+                raise Exception("unable to activate new configuration")
+
+            if res == 100 or force_reboot or m.state == m.RESCUE:
+                if not allow_reboot and not force_reboot:
+                    raise Exception("the new configuration requires a "
+                                    "reboot to take effect (hint: use "
+                                    "‘--allow-reboot’)".format(m.name))
+                m.reboot_sync()
+                res = 0
+                # FIXME: should check which systemd services
+                # failed to start after the reboot.
+
+            if res == 0:
+                m.success("activation finished successfully")
+
+            # Record that we switched this machine to the new
+            # configuration.
+            m.cur_configs_path = configs_path
+            m.cur_toplevel = m.new_toplevel
+
+        except Exception as e:
+            # This thread shouldn't throw an exception because
+            # that will cause NixOps to exit and interrupt
+            # activation on the other machines.
+            m.logger.error(traceback.format_exc())
+            return m.name
+        return None
+
+
+    def _report_activation(self, res):
         failed = [x for x in res if x != None]
         if failed != []:
             raise Exception("activation of {0} of {1} machines failed (namely on {2})"
                             .format(len(failed), len(res), ", ".join(["‘{0}’".format(x) for x in failed])))
 
 
+    def activate_configs(self, configs_path, include, exclude, allow_reboot,
+                         force_reboot, check, sync, always_activate, dry_activate):
+        """Activate the new configuration on a machine."""
+
+        def worker(m):
+            if not should_do(m, include, exclude): return
+            return self._activate_config(m, configs_path, allow_reboot, force_reboot,
+                                         sync, always_activate, dry_activate)
+
+        res = nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
+        self._report_activation(res)
+
+
+    def copy_and_activate(self, configs_path, include, exclude, max_concurrent_copy,
+                          max_concurrent_activate, allow_reboot, force_reboot,
+                          sync, always_activate, dry_activate):
+        """Copy the closure of each machine configuration to the
+        corresponding machine and activate it, starting the activation
+        of each machine as soon as its closure has been copied."""
+
+        def activate(m):
+            return self._activate_config(m, configs_path, allow_reboot, force_reboot,
+                                         sync, always_activate, dry_activate)
+
+        machines = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        missing = self._probe_closures(machines, configs_path)
+
+        def copy(m):
+            self._copy_closure(m, configs_path, missing[m.name])
+            return m
+
+        res = nixops.parallel.run_pipeline(
+            tasks=machines, stages=[(max_concurrent_copy, copy), (max_concurrent_activate, activate)])
+        self._report_activation(res)
+
+
     def _get_free_resource_index(self):
         index = 0
         for r in self.resources.itervalues():
@@ -832,8 +1560,9 @@ class Deployment(object):
             self.logger.warn("restore finished; please note that you might need to run ‘nixops deploy’ to fix configuration issues regarding changed IP addresses")
 
 
-    def evaluate_active(self, include=[], exclude=[], kill_obsolete=False):
-        self.evaluate()
+    def evaluate_active(self, include=[], exclude=[], kill_obsolete=False, max_concurrent_destroy=20):
+        # With --include, only evaluate the included machines.
+        self.evaluate(names=include or None)
 
         # Create state objects for all defined resources.
         with self._db:
@@ -849,6 +1578,8 @@ class Deployment(object):
         # delete obsolete resources from ‘self.resources’ because they
         # contain important state that we don't want to forget about.)
         for m in self.resources.values():
+            # A partial evaluation says nothing about the others.
+            if include and m.name not in include: continue
             if m.name in self.definitions:
                 if m.obsolete:
                     self.logger.log("resource ‘{0}’ is no longer obsolete".format(m.name))
@@ -861,16 +1592,32 @@ class Deployment(object):
                     to_destroy.append(m.name)
 
         if to_destroy:
-            self._destroy_resources(include=to_destroy)
+            self._destroy_resources(include=to_destroy, max_concurrent=max_concurrent_destroy)
 
 
+    def _log_critical_path(self, graph, what):
+        """Show the chain of dependent resources that took longest."""
+        path = graph.critical_path()
+        if len(path) < 2: return
+        self.logger.log("critical path of {0}: {1}".format(
+            what, " → ".join("{0} ({1:.1f}s)".format(r.name, t) for (r, t) in path)))
+
     def _deploy(self, dry_run=False, build_only=False, create_only=False, copy_only=False, evaluate_only=False,
                 include=[], exclude=[], check=False, kill_obsolete=False,
                 allow_reboot=False, allow_recreate=False, force_reboot=False,
-                max_concurrent_copy=5, sync=True, always_activate=False, repair=False, dry_activate=False):
+                max_concurrent_copy=5, sync=True, always_activate=False, repair=False, dry_activate=False,
+                barrier=False, max_concurrent_activate=-1, max_concurrent_create=20,
+                max_concurrent_build=None, copy_fanout=None):
         """Perform the deployment defined by the deployment specification."""
 
-        self.evaluate_active(include, exclude, kill_obsolete)
+        start = time.time()
+
+        # Only the Nix evaluation itself, which is memoized for
+        # evaluate_active(), runs under the shared lock.
+        self._evaluate_info(names=include or None)
+        self._upgrade_deployment_lock()
+
+        self.evaluate_active(include, exclude, kill_obsolete, max_concurrent_destroy=max_concurrent_create)
 
         if evaluate_only:
             return
@@ -885,11 +1632,7 @@ class Deployment(object):
 
         self.logger.update_log_prefixes()
 
-        # Start or update the active resources.  Non-machine resources
-        # are created first, because machines may depend on them
-        # (e.g. EC2 machines depend on EC2 key pairs or EBS volumes).
-        # FIXME: would be nice to have a more fine-grained topological
-        # sort.
+        # Start or update the active resources.
         if not dry_run and not build_only:
 
             for r in self.active_resources.itervalues():
@@ -897,81 +1640,111 @@ class Deployment(object):
                 if r.get_type() != defn.get_type():
                     raise Exception("the type of resource ‘{0}’ changed from ‘{1}’ to ‘{2}’, which is currently unsupported"
                                     .format(r.name, r.get_type(), defn.get_type()))
-                r._created_event = threading.Event()
-                r._errored = False
 
             def worker(r):
-                try:
-                    if not should_do(r, include, exclude): return
-
-                    # Sleep until all dependencies of this resource have
-                    # been created.
-                    deps = r.create_after(self.active_resources.itervalues(), self.definitions[r.name])
-                    for dep in deps:
-                        dep._created_event.wait()
-                        # !!! Should we print a message here?
-                        if dep._errored:
-                            r._errored = True
-                            return
-
-                    # Now create the resource itself.
-                    if not r.creation_time:
-                        r.creation_time = int(time.time())
-                    r.create(self.definitions[r.name], check=check, allow_reboot=allow_reboot, allow_recreate=allow_recreate)
-
-                    if is_machine(r):
-                        # The first time the machine is created,
-                        # record the state version. We get it from
-                        # /etc/os-release, rather than from the
-                        # configuration's state.systemVersion
-                        # attribute, because the machine may have been
-                        # booted from an older NixOS image.
-                        if not r.state_version:
-                            os_release = r.run_command("cat /etc/os-release", capture_stdout=True)
-                            match = re.search('VERSION_ID="([0-9]+\.[0-9]+).*"', os_release)
-                            if match:
-                                r.state_version = match.group(1)
-                                r.log("setting state version to {0}".format(r.state_version))
-                            else:
-                                r.warn("cannot determine NixOS version")
-
-                        r.wait_for_ssh(check=check)
-                        r.generate_vpn_key(check=check)
-
-                except:
-                    r._errored = True
-                    raise
-                finally:
-                    r._created_event.set()
-
-            nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active_resources.itervalues(), worker_fun=worker)
+                if not should_do(r, include, exclude): return
+
+                if not r.creation_time:
+                    r.creation_time = int(time.time())
+                r.create(self.definitions[r.name], check=check, allow_reboot=allow_reboot, allow_recreate=allow_recreate)
+
+                if is_machine(r):
+                    # The first time the machine is created,
+                    # record the state version. We get it from
+                    # /etc/os-release, rather than from the
+                    # configuration's state.systemVersion
+                    # attribute, because the machine may have been
+                    # booted from an older NixOS image.
+                    if not r.state_version:
+                        os_release = r.run_command("cat /etc/os-release", capture_stdout=True)
+                        match = re.search('VERSION_ID="([0-9]+\.[0-9]+).*"', os_release)
+                        if match:
+                            r.state_version = match.group(1)
+                            r.log("setting state version to {0}".format(r.state_version))
+                        else:
+                            r.warn("cannot determine NixOS version")
+
+                    r.wait_for_ssh(check=check)
+                    r.generate_vpn_key(check=check)
+
+            # Create each resource once the resources it depends on
+            # (e.g. the key pairs or EBS volumes of an EC2 machine)
+            # have been created.
+            graph = nixops.parallel.TaskGraph(
+                self.active_resources.values(),
+                lambda r: r.create_after(self.active_resources.itervalues(), self.definitions[r.name]))
+            try:
+                graph.run(max_concurrent_create, worker)
+            finally:
+                self._log_critical_path(graph, "creation")
+            self._db.flush()
 
         if create_only: return
 
+        if dry_run or build_only:
+            # Building doesn't change the deployment; build_configs()
+            # takes the exclusive lock again to record the result.
+            self._downgrade_deployment_lock()
+
         # Build the machine configurations.
         if dry_run:
             self.build_configs(dry_run=dry_run, repair=repair, include=include, exclude=exclude)
             return
 
+        if max_concurrent_build and copy_fanout:
+            raise Exception("streamed builds cannot be combined with copying closures between machines")
+
+        if max_concurrent_build and not build_only:
+            # Copy the closure of each machine as soon as it has been
+            # built, then activate them all.
+            self.configs_path = self.build_and_copy(include=include, exclude=exclude,
+                                                    max_concurrent_build=max_concurrent_build,
+                                                    max_concurrent_copy=max_concurrent_copy, repair=repair)
+            self._db.flush()
+
+            if copy_only: return
+
+            self.activate_configs(self.configs_path, include=include,
+                                  exclude=exclude, allow_reboot=allow_reboot,
+                                  force_reboot=force_reboot, check=check,
+                                  sync=sync, always_activate=always_activate, dry_activate=dry_activate)
+            self._db.flush()
+            self._finish_deploy(include, exclude, start, "streamed", dry_activate)
+            return
+
         # Record configs_path in the state so that the ‘info’ command
         # can show whether machines have an outdated configuration.
         self.configs_path = self.build_configs(repair=repair, include=include, exclude=exclude)
 
         if build_only: return
 
-        # Copy the closures of the machine configurations to the
-        # target machines.
-        self.copy_closures(self.configs_path, include=include, exclude=exclude,
-                           max_concurrent_copy=max_concurrent_copy)
-
-        if copy_only: return
-
-        # Active the configurations.
-        self.activate_configs(self.configs_path, include=include,
-                              exclude=exclude, allow_reboot=allow_reboot,
-                              force_reboot=force_reboot, check=check,
-                              sync=sync, always_activate=always_activate, dry_activate=dry_activate)
-
+        if barrier or copy_only or copy_fanout:
+            # Copy the closures of the machine configurations to the
+            # target machines.
+            self.copy_closures(self.configs_path, include=include, exclude=exclude,
+                               max_concurrent_copy=max_concurrent_copy, copy_fanout=copy_fanout)
+            self._db.flush()
+
+            if copy_only: return
+
+            # Active the configurations.
+            self.activate_configs(self.configs_path, include=include,
+                                  exclude=exclude, allow_reboot=allow_reboot,
+                                  force_reboot=force_reboot, check=check,
+                                  sync=sync, always_activate=always_activate, dry_activate=dry_activate)
+        else:
+            # Activate each machine as soon as its closure has been
+            # copied, rather than waiting for all copies to finish.
+            self.copy_and_activate(self.configs_path, include=include, exclude=exclude,
+                                   max_concurrent_copy=max_concurrent_copy,
+                                   max_concurrent_activate=max_concurrent_activate,
+                                   allow_reboot=allow_reboot, force_reboot=force_reboot,
+                                   sync=sync, always_activate=always_activate, dry_activate=dry_activate)
+        self._db.flush()
+
+        self._finish_deploy(include, exclude, start, "barrier" if barrier or copy_fanout else "pipelined", dry_activate)
+
+    def _finish_deploy(self, include, exclude, start, mode, dry_activate):
         if dry_activate: return
 
         # Trigger cleanup of resources, e.g. disks that need to be detached etc. Needs to be
@@ -983,11 +1756,20 @@ class Deployment(object):
             r.after_activation(self.definitions[r.name])
 
         nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active_resources.itervalues(), worker_fun=cleanup_worker)
+        self.logger.log("deployment took {0:.1f}s ({1} mode)".format(time.time() - start, mode))
         self.logger.log(ansi_success("{0}> deployment finished successfully".format(self.name), outfile=self.logger._log_file))
 
-    def deploy(self, **kwargs):
-        with self._get_deployment_lock():
-            self._deploy(**kwargs)
+    def deploy(self, group_commit_interval=None, **kwargs):
+        # Evaluation and building only need a shared lock; _deploy()
+        # takes the exclusive lock before changing the deployment.
+        with self._get_deployment_lock(exclusive=False):
+            if group_commit_interval is None:
+                self._deploy(**kwargs)
+            else:
+                # Batch the state file writes of the worker threads;
+                # _deploy() flushes them at every phase boundary.
+                with self._db.group_commit(group_commit_interval):
+                    self._deploy(**kwargs)
 
 
     def _rollback(self, generation, include=[], exclude=[], check=False,
@@ -1001,6 +1783,7 @@ class Deployment(object):
             raise Exception("nix-env --switch-generation failed")
 
         self.configs_path = os.path.realpath(profile)
+        self.configs_digest = None
         assert os.path.isdir(self.configs_path)
 
         names = set()
@@ -1034,43 +1817,32 @@ class Deployment(object):
             self._rollback(**kwargs)
 
 
-    def _destroy_resources(self, include=[], exclude=[], wipe=False):
+    def _destroy_resources(self, include=[], exclude=[], wipe=False, max_concurrent=20):
 
+        # A resource is destroyed after the resources that must be
+        # destroyed before it (e.g. an EBS volume after the machine it
+        # is attached to).
+        wait_for = {}
         for r in self.resources.itervalues():
-            r._destroyed_event = threading.Event()
-            r._errored = False
             for rev_dep in r.destroy_before(self.resources.itervalues()):
-                try:
-                    rev_dep._wait_for.append(r)
-                except AttributeError:
-                    rev_dep._wait_for = [ r ]
+                wait_for.setdefault(rev_dep.name, []).append(r)
 
         def worker(m):
-            try:
-                if not should_do(m, include, exclude): return
-                try:
-                    for dep in m._wait_for:
-                        dep._destroyed_event.wait()
-                        # !!! Should we print a message here?
-                        if dep._errored:
-                            m._errored = True
-                            return
-                except AttributeError:
-                    pass
-                if m.destroy(wipe=wipe): self.delete_resource(m)
-            except:
-                m._errored = True
-                raise
-            finally:
-                m._destroyed_event.set()
+            if not should_do(m, include, exclude): return
+            if m.destroy(wipe=wipe): self.delete_resource(m)
 
-        nixops.parallel.run_tasks(nr_workers=-1, tasks=self.resources.values(), worker_fun=worker)
+        graph = nixops.parallel.TaskGraph(self.resources.values(), lambda r: wait_for.get(r.name, []))
+        try:
+            graph.run(max_concurrent, worker)
+        finally:
+            self._log_critical_path(graph, "destruction")
 
-    def destroy_resources(self, include=[], exclude=[], wipe=False):
-        """Destroy all active and obsolete resources."""
+    def destroy_resources(self, include=[], exclude=[], wipe=False, max_concurrent=20):
+        """Destroy all active and obsolete resources, at most
+        ‘max_concurrent’ at the same time."""
 
         with self._get_deployment_lock():
-            self._destroy_resources(include, exclude, wipe)
+            self._destroy_resources(include, exclude, wipe, max_concurrent)
 
         # Remove the destroyed machines from the rollback profile.
         # This way, a subsequent "nix-env --delete-generations old" or
@@ -1170,13 +1942,45 @@ def is_machine(r):
 def is_machine_defn(r):
     return isinstance(r, nixops.backends.MachineDefinition)
 
+def _option_path(option_name):
+    """Split an option name like ‘fileSystems."/".device’ into its
+    attribute path."""
+    if not re.match(r'^(?:"[^"]*"|[^".]+)(?:\.(?:"[^"]*"|[^".]+))*$', option_name):
+        raise Exception("invalid option name ‘{0}’".format(option_name))
+    return [x[1:-1] if x.startswith('"') else x for x in re.findall(r'"[^"]*"|[^".]+', option_name)]
+
+
+def _copy_tree(machines, fanout):
+    """Arrange ‘machines’ into trees along which their closures are
+    copied: the roots receive their closures from the deployer, and
+    the other machines from their parent.  There is a tree for each
+    copy group (see MachineState.copy_group()), in which each machine
+    has at most ‘fanout’ children.  Machines whose host key isn't known
+    are always roots, since their peers couldn't check their identity.
+    Return a dictionary mapping the name of each machine to its
+    parent, or None for the roots."""
+    parent = {}
+    groups = defaultdict(list)
+    for m in sorted(machines, key=lambda m: m.name):
+        group = m.copy_group() if m.public_host_key else None
+        if group is None:
+            parent[m.name] = None
+        else:
+            groups[group].append(m)
+    for members in groups.itervalues():
+        for i, m in enumerate(members):
+            p = members[(i - 1) // fanout] if i > 0 else None
+            parent[m.name] = p if p and p.address_to(m) and m.address_to(p) else None
+    return parent
+
 
 def _subclasses(cls):
     sub = cls.__subclasses__()
     return [cls] if not sub else [g for s in sub for g in _subclasses(s)]
 
 def _create_definition(xml, config, type_name):
-    """Create a resource definition object from the given XML representation of the machine's attributes."""
+    """Create a resource definition object from the given XML and JSON
+    representations of the machine's attributes."""
 
     for cls in _subclasses(nixops.resources.ResourceDefinition):
         if type_name == cls.get_resource_type():
@@ -1188,15 +1992,22 @@ def _create_definition(xml, config, type_name):
 
     raise nixops.deployment.UnknownBackend("unknown resource type ‘{0}’".format(type_name))
 
-def _create_state(depl, type, name, id):
-    """Create a resource state object of the desired type."""
+def _state_class(type):
+    """Return the resource state class of the given type."""
 
     for cls in _subclasses(nixops.resources.ResourceState):
         if type == cls.get_type():
-            return cls(depl, name, id)
+            return cls
 
     raise nixops.deployment.UnknownBackend("unknown resource type ‘{0}’".format(type))
 
+def is_machine_type(type):
+    return issubclass(_state_class(type), nixops.backends.MachineState)
+
+def _create_state(depl, type, name, id):
+    """Create a resource state object of the desired type."""
+    return _state_class(type)(depl, name, id)
+
 
 # Automatically load all resource types.
 def _load_modules_from(dir):
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+# Cache of the output of nix-instantiate for deployment evaluations
+# (with the NixOS version suffix added, see Deployment._run_evaluation()),
+# keyed on a hash of everything the evaluation depends on: the
+# command line (which includes the network expressions, the arguments
+# and the Nix search path), the contents of every file reachable from
+# the network expressions through path literals and ‘<...>’ lookups,
+# the revision of Nixpkgs and the environment variables read with
+# builtins.getEnv.  Evaluations that depend on anything else (such as
+# builtins.fetchTarball, or files accessed through paths computed from
+# strings) are not cached.
+
+import os
+import re
+import errno
+import hashlib
+import subprocess
+import tempfile
+
+# Bump this whenever the cache key computation or the cached data
+# changes.
+_version = "3"
+
+_path_re = re.compile(r"(?<![\w.+\-/~])((?:\.\.?|~|[\w+\-][\w.+\-]*)?(?:/[\w.+\-]+)+)")
+_lookup_path_re = re.compile(r"<([\w.+\-]+)((?:/[\w.+\-]+)*)>")
+_get_env_re = re.compile(r"\bgetEnv\b")
+_get_env_literal_re = re.compile(r"\bgetEnv\s+\"([\w.\-]*)\"")
+_impure_re = re.compile(r"\b(?:builtins\s*\.\s*(?:fetchurl|fetchTarball|fetchGit|fetchMercurial|currentTime|exec)"
+                        r"|__currentTime|fetchTarball|fetchGit|fetchMercurial)\b")
+# Builtins that access the file named by their argument, which the
+# key only covers if it's a path literal.  Since string literals have
+# been blanked out, an argument that doesn't start like a path (such
+# as ‘"/etc/secret"’ or ‘(toString x)’) can't be tracked.
+_file_access_re = re.compile(r"\b(?:readFile|readDir|pathExists|toPath|hashFile|filterSource|scopedImport|import)\b"
+                             r"(?!\s*(?:\.\.?/|~/|/|<))")
+_builtins_path_re = re.compile(r"\bbuiltins\s*\.\s*path\b")
+
+# Maximum number of files looked at when computing a key.
+_max_files = 20000
+
+
+class Uncacheable(Exception):
+    """Raised if an evaluation has inputs that the cache can't track."""
+    pass
+
+
+def strip_strings_and_comments(s):
+    """Return the Nix source ‘s’ without its comments and with the
+    literal parts of strings blanked out, keeping antiquotations."""
+    out = []
+    modes = [['code', 0]]
+    i = 0
+    n = len(s)
+    while i < n:
+        mode = modes[-1]
+        if mode[0] == 'code':
+            if s[i] == '#':
+                j = s.find('\n', i)
+                i = n if j == -1 else j
+                continue
+            if s.startswith('/*', i):
+                j = s.find('*/', i + 2)
+                i = n if j == -1 else j + 2
+                out.append(' ')
+                continue
+            if s[i] == '"':
+                modes.append(['"'])
+                out.append(' ')
+                i += 1
+                continue
+            if s.startswith("''", i):
+                modes.append(["''"])
+                out.append(' ')
+                i += 2
+                continue
+            if s[i] == '{':
+                mode[1] += 1
+            elif s[i] == '}':
+                if mode[1] == 0 and len(modes) > 1:
+                    # End of an antiquotation.
+                    modes.pop()
+                    out.append(' ')
+                    i += 1
+                    continue
+                mode[1] -= 1
+            out.append(s[i])
+            i += 1
+        elif mode[0] == '"':
+            if s[i] == '\\':
+                i += 2
+            elif s[i] == '"':
+                modes.pop()
+                out.append(' ')
+                i += 1
+            elif s.startswith('${', i):
+                modes.append(['code', 0])
+                out.append(' ')
+                i += 2
+            else:
+                i += 1
+        else:
+            if s.startswith("'''", i) or s.startswith("''$", i):
+                i += 3
+            elif s.startswith("''\\", i):
+                i += 4
+            elif s.startswith("''", i):
+                modes.pop()
+                out.append(' ')
+                i += 2
+            elif s.startswith('${', i):
+                modes.append(['code', 0])
+                out.append(' ')
+                i += 2
+            else:
+                i += 1
+    return ''.join(out)
+
+
+def _is_store_path(path):
+    return path.startswith("/nix/store/")
+
+
+class _KeyBuilder(object):
+    """Collect the inputs of an evaluation into a hash."""
+
+    def __init__(self, nix_path_flags):
+        self._nix_path_flags = nix_path_flags
+        self._hash = hashlib.sha256()
+        self._seen = set()
+        self._roots = {}
+        self._tracked = set()
+        # Roots whose expressions only access the files named by the
+        # network expressions, which are part of the key anyway.
+        self._trusted = set()
+        self._nr_files = 0
+
+    def add(self, *items):
+        for x in items:
+            x = x.encode("utf-8") if isinstance(x, unicode) else str(x)
+            self._hash.update("{0}:{1};".format(len(x), x))
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def _count_file(self):
+        self._nr_files += 1
+        if self._nr_files > _max_files:
+            raise Uncacheable("too many input files")
+
+    def _find_root(self, name):
+        """Resolve the ‘<name>’ lookup path and record its identity."""
+        if name in self._roots: return self._roots[name]
+        try:
+            path = subprocess.check_output(
+                ["nix-instantiate", "--find-file", name] + self._nix_path_flags,
+                stderr=open(os.devnull, "w")).rstrip("\n")
+        except (OSError, subprocess.CalledProcessError):
+            raise Uncacheable("cannot resolve ‘<{0}>’".format(name))
+        path = os.path.realpath(path)
+        self._roots[name] = path
+        self.add("root", name, path)
+
+        if _is_store_path(path):
+            pass
+        elif os.path.isdir(os.path.join(path, ".git")):
+            # A clean Git checkout is identified by its revision.
+            try:
+                rev = subprocess.check_output(["git", "-C", path, "rev-parse", "HEAD"]).strip()
+                dirty = subprocess.check_output(["git", "-C", path, "status", "--porcelain", "--untracked-files=no"])
+            except (OSError, subprocess.CalledProcessError):
+                raise Uncacheable("cannot determine the revision of ‘{0}’".format(path))
+            if dirty: raise Uncacheable("‘{0}’ has uncommitted changes".format(path))
+            self.add("rev", rev)
+            self._tracked.add(path)
+        return path
+
+    def _in_root(self, path, roots):
+        return any(path == r or path.startswith(r + "/") for r in roots)
+
+    def _in_tracked_root(self, path):
+        return _is_store_path(path) or self._in_root(path, self._tracked)
+
+    def add_path(self, path):
+        """Record the contents of ‘path’ and, if it's a Nix expression,
+        of everything it refers to."""
+        path = os.path.normpath(path)
+        if path in self._seen: return
+        self._seen.add(path)
+
+        if self._in_tracked_root(os.path.realpath(path)):
+            self.add("path", path, os.path.realpath(path))
+            return
+
+        self._count_file()
+        if os.path.isdir(path):
+            self._add_dir(path)
+        elif os.path.isfile(path):
+            with open(path) as f: contents = f.read()
+            self.add("file", path, hashlib.sha256(contents).hexdigest())
+            if path.endswith(".nix"): self._scan(path, contents)
+        else:
+            # Record missing files too, since their creation may
+            # change the result.
+            self.add("missing", path)
+
+    def _add_dir(self, path):
+        """Record the contents of the directory ‘path’ without reading
+        its files: by the Git tree of its last commit plus the state of
+        the files that differ from it, if it's in a Git checkout, and
+        otherwise by the size and modification time of every file."""
+        try:
+            with open(os.devnull, "w") as devnull:
+                tree = subprocess.check_output(["git", "-C", path, "rev-parse", "HEAD:./"], stderr=devnull).strip()
+                top = subprocess.check_output(["git", "-C", path, "rev-parse", "--show-toplevel"], stderr=devnull).strip()
+                status = subprocess.check_output(
+                    ["git", "-C", path, "status", "--porcelain", "-z", "--ignored", "--untracked-files=all", "--", "."],
+                    stderr=devnull)
+        except (OSError, subprocess.CalledProcessError):
+            tree = None
+
+        if tree:
+            self.add("tree", path, tree)
+            entries = status.split("\0")
+            i = 0
+            while i < len(entries):
+                entry = entries[i]
+                i += 1
+                if not entry: continue
+                # Renames are followed by the original name.
+                if entry[0] in "RC": i += 1
+                self._count_file()
+                self._add_stat(os.path.join(top, entry[3:]))
+        else:
+            self.add("dir", path)
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    self._count_file()
+                    self._add_stat(os.path.join(dirpath, name))
+
+    def _add_stat(self, path):
+        try:
+            st = os.lstat(path)
+            self.add("stat", path, st.st_size, st.st_mtime, st.st_ino)
+        except OSError:
+            self.add("missing", path)
+
+    def _scan(self, path, contents):
+        code = strip_strings_and_comments(contents)
+
+        if _impure_re.search(code):
+            raise Uncacheable("‘{0}’ uses impure builtins".format(path))
+
+        if not self._in_root(os.path.realpath(path), self._trusted) and \
+           (_file_access_re.search(code) or _builtins_path_re.search(code)):
+            raise Uncacheable("‘{0}’ accesses a file whose name isn't a path literal".format(path))
+
+        env_vars = _get_env_literal_re.findall(contents)
+        if len(_get_env_re.findall(code)) > len(env_vars):
+            raise Uncacheable("‘{0}’ reads an environment variable with a computed name".format(path))
+        for var in env_vars:
+            self.add("env", var, os.environ.get(var, ""))
+
+        for (name, rest) in _lookup_path_re.findall(code):
+            self.add_path(self._find_root(name) + rest)
+
+        base = os.path.dirname(path)
+        for p in _path_re.findall(_lookup_path_re.sub(" ", code)):
+            if p.startswith("~/"):
+                p = os.path.expanduser(p)
+            elif not p.startswith("/"):
+                p = os.path.join(base, p)
+            self.add_path(p)
+
+
+def compute_key(flags, nix_exprs, entry_point, nix_path_flags):
+    """Return the cache key of evaluating ‘entry_point’ with the
+    nix-instantiate command line ‘flags’, or None if the evaluation
+    can't be cached."""
+    key = _KeyBuilder(nix_path_flags)
+    key.add(_version, os.environ.get("NIX_PATH", ""), *flags)
+    try:
+        # The entry point (NixOps' own expressions) imports the network
+        # expressions by name.
+        m = _lookup_path_re.match(entry_point)
+        if m: key._trusted.add(key._find_root(m.group(1)))
+        for x in nix_exprs + [entry_point]:
+            m = _lookup_path_re.match(x)
+            if m:
+                key.add_path(key._find_root(m.group(1)) + m.group(2))
+            else:
+                key.add_path(os.path.abspath(x))
+    except Uncacheable:
+        return None
+    return key.hexdigest()
+
+
+class EvalCache(object):
+    """A directory of cached evaluation results, bounded in size by
+    evicting the least recently used entries."""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    @classmethod
+    def default(cls):
+        path = os.environ.get("HOME", "") + "/.nixops/eval-cache"
+        max_size = int(os.environ.get("NIXOPS_EVAL_CACHE_SIZE", 256)) * 1024 * 1024
+        return cls(path, max_size)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        """Return the cached output for ‘key’, or None."""
+        try:
+            with open(self._file(key)) as f: out = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT: raise
+            return None
+        # Record the use for LRU eviction.
+        os.utime(self._file(key), None)
+        return out
+
+    def put(self, key, out):
+        if not os.path.exists(self.path): os.makedirs(self.path, 0700)
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f: f.write(out)
+        os.rename(tmp, self._file(key))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"): continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(e[1] for e in entries)
+        for (mtime, size, name) in sorted(entries):
+            if total <= self.max_size: break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
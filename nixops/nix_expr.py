@@ -1,10 +1,9 @@
 import re
-import string
 
 from textwrap import dedent
 
-__all__ = ['py2nix', 'nix2py', 'nixmerge', 'expand_dict',
-           'RawValue', 'Function']
+__all__ = ['py2nix', 'py2nix_to_file', 'nix2py', 'nixmerge', 'expand_dict',
+           'NixMergeBuilder', 'RawValue', 'Function']
 
 
 class RawValue(object):
@@ -20,6 +19,9 @@ class RawValue(object):
     def indent(self, level=0, inline=False, maxwidth=80):
         return "  " * level + self.value
 
+    def write(self, out, level=0, inline=False, maxwidth=80):
+        out("  " * level + self.value)
+
     def __repr__(self):
         return self.value
 
@@ -40,6 +42,9 @@ class MultiLineRawValue(RawValue):
     def indent(self, level=0, inline=False, maxwidth=80):
         return '\n'.join(["  " * level + value for value in self.values])
 
+    def write(self, out, level=0, inline=False, maxwidth=80):
+        out(self.indent(level))
+
 
 class Function(object):
     def __init__(self, head, body):
@@ -76,37 +81,53 @@ class Container(object):
         self.suffix = suffix
         self.inline_variant = inline_variant
 
+        # The layout of a container only depends on these two values of
+        # its children, so compute them once here rather than walking
+        # the subtree on every call.
+        self._inlineable = all([child.is_inlineable() for child in children])
+        if self._inlineable:
+            self._min_length = (len(prefix) + len(suffix) + 1 + len(children) +
+                                sum([child.get_min_length() for child in children]))
+        else:
+            self._min_length = None
+
     def get_min_length(self):
         """
         Return the minimum length of this container and all sub-containers.
         """
-        return (len(self.prefix) + len(self.suffix) + 1 + len(self.children) +
-                sum([child.get_min_length() for child in self.children]))
+        return self._min_length
 
     def is_inlineable(self):
-        return all([child.is_inlineable() for child in self.children])
+        return self._inlineable
 
     def indent(self, level=0, inline=False, maxwidth=80):
-        if not self.is_inlineable():
+        out = []
+        self.write(out.append, level, inline, maxwidth)
+        return ''.join(out)
+
+    def write(self, out, level=0, inline=False, maxwidth=80):
+        """
+        Pass the pieces of the formatted container to the function 'out'.
+        """
+        if not self._inlineable:
             inline = False
-        elif level * 2 + self.get_min_length() < maxwidth:
+        elif level * 2 + self._min_length < maxwidth:
             inline = True
         ind = "  " * level
         if inline and self.inline_variant is not None:
-            return self.inline_variant.indent(level=level, inline=True,
-                                              maxwidth=maxwidth)
+            self.inline_variant.write(out, level, True, maxwidth)
         elif inline:
-            sep = ' '
-            lines = ' '.join([child.indent(level=0, inline=True)
-                              for child in self.children])
-            suffix_ind = ""
+            out(ind + self.prefix + ' ')
+            for n, child in enumerate(self.children):
+                if n: out(' ')
+                child.write(out, 0, True, maxwidth)
+            out(' ' + self.suffix)
         else:
-            sep = '\n'
-            lines = '\n'.join([child.indent(level + 1, inline=inline,
-                                            maxwidth=maxwidth)
-                               for child in self.children])
-            suffix_ind = ind
-        return ind + self.prefix + sep + lines + sep + suffix_ind + self.suffix
+            out(ind + self.prefix + '\n')
+            for n, child in enumerate(self.children):
+                if n: out('\n')
+                child.write(out, level + 1, False, maxwidth)
+            out('\n' + ind + self.suffix)
 
 
 def enclose_node(node, prefix="", suffix=""):
@@ -131,6 +152,9 @@ def _fold_string(value, rules):
     return reduce(folder, rules, value)
 
 
+_identifier_re = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+
+
 def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
     """
     Return the given value as a Nix expression string.
@@ -141,6 +165,24 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
     if you want to break on every occasion possible. If 'inline' is set to
     True, squash everything into a single line.
     """
+    out = []
+    _layout(value).write(out.append, initial_indentation, inline, maxwidth)
+    return ''.join(out)
+
+
+def py2nix_to_file(value, f, initial_indentation=0, maxwidth=80,
+                   inline=False):
+    """
+    Write the given value as a Nix expression to the file object 'f'. The
+    arguments are the same as for py2nix().
+    """
+    _layout(value).write(f.write, initial_indentation, inline, maxwidth)
+
+
+def _layout(value):
+    """
+    Return the tree of containers and raw values representing the given value.
+    """
     def _enc_int(node):
         if node < 0:
             return RawValue("builtins.sub 0 " + str(-node))
@@ -188,8 +230,7 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
         elif len(key) == 0:
             raise KeyError("key name has zero length")
 
-        if all(char in string.letters + string.digits + '_'
-               for char in key) and not key[0].isdigit():
+        if _identifier_re.match(key):
             return key
         else:
             return _enc_str(key, for_attribute=True)
@@ -208,7 +249,8 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
                 child_key, child_value = child_value.items()[0]
                 encoded_key += "." + _enc_key(child_key)
 
-            contents = _enc(child_value)
+            # expand_dict() has already expanded nested attrsets.
+            contents = _enc(child_value, expanded=True)
             prefix = "{0} = ".format(encoded_key)
             suffix = ";"
 
@@ -222,7 +264,7 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
     def _enc_call(node):
         return Container("(", [_enc(node.fun), _enc(node.arg)], ")")
 
-    def _enc(node, inlist=False):
+    def _enc(node, inlist=False, expanded=False):
         if isinstance(node, RawValue):
             if inlist and (isinstance(node, MultiLineRawValue) or
                            any(char.isspace() for char in node.value)):
@@ -242,7 +284,7 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
         elif isinstance(node, list):
             return _enc_list(node)
         elif isinstance(node, dict):
-            return _enc_attrset(expand_dict(node))
+            return _enc_attrset(node if expanded else expand_dict(node))
         elif isinstance(node, Function):
             if inlist:
                 return enclose_node(_enc_function(node), "(", ")")
@@ -256,8 +298,7 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
         else:
             raise ValueError("unable to encode {0}".format(repr(node)))
 
-    return _enc(value).indent(initial_indentation, maxwidth=maxwidth,
-                              inline=inline)
+    return _enc(value)
 
 
 def expand_dict(unexpanded):
@@ -272,51 +313,108 @@ def expand_dict(unexpanded):
     ...               'a': {('d', 'e'): 'f'}})
     {'a': {'b': 'c', 'd': {'e': 'f'}}}
     """
-    paths, strings = [], {}
-    for key, val in unexpanded.iteritems():
-        if isinstance(key, tuple):
-            if len(key) == 0:
-                raise KeyError("invalid key {0}".format(repr(key)))
-
-            newkey = key[0]
-            if len(key) > 1:
-                newval = {key[1:]: val}
-            else:
-                newval = val
-            paths.append({newkey: newval})
-        else:
-            strings[key] = val
+    builder = NixMergeBuilder(expand=True)
+    builder.add(unexpanded)
+    return builder.value
 
-    return {key: (expand_dict(val) if isinstance(val, dict) else val)
-            for key, val in reduce(nixmerge, paths + [strings]).iteritems()}
 
-
-def nixmerge(expr1, expr2):
+class NixMergeBuilder(object):
     """
-    Merge both expressions into one, merging dictionary keys and appending list
-    elements if they otherwise would clash.
+    Merge expressions one by one into a single expression, with the same
+    result as reducing them with nixmerge(). The dictionaries and lists of the
+    result are built in place, so merging n expressions takes time linear in
+    their total size. The expressions that are added are never modified.
+
+    If 'expand' is set to True, tuple keys are expanded as by expand_dict().
     """
-    def _merge_dicts(d1, d2):
+    def __init__(self, expand=False):
+        self.expand = expand
+        self.value = {}
+        # The dictionaries and lists created by the builder, which are the
+        # only ones it may modify, and the sets of elements of those lists.
+        self._dicts = set([id(self.value)])
+        self._lists = {}
+
+    def add(self, expr):
+        """
+        Merge the given expression into the value.
+        """
+        self.value = self._merge(self.value, expr)
+
+    def _own_dict(self, d):
+        if id(d) in self._dicts:
+            return d
         out = {}
-        for key in set(d1.keys()).union(d2.keys()):
-            if key in d1 and key in d2:
-                out[key] = _merge(d1[key], d2[key])
-            elif key in d1:
-                out[key] = d1[key]
-            else:
-                out[key] = d2[key]
+        self._dicts.add(id(out))
+        if self.expand:
+            return self._merge_dict(out, d)
+        out.update(d)
         return out
 
-    def _merge(e1, e2):
+    def _own_list(self, l):
+        if id(l) in self._lists:
+            return l
+        out, seen = [], set()
+        for x in l:
+            if x not in seen:
+                seen.add(x)
+                out.append(x)
+        self._lists[id(out)] = seen
+        return out
+
+    def _merge_dict(self, d1, d2):
+        items = d2.items()
+        if self.expand:
+            # Like expand_dict() always did, merge the attribute paths
+            # before the plain keys.
+            items = ([(k, v) for (k, v) in items if isinstance(k, tuple)] +
+                     [(k, v) for (k, v) in items if not isinstance(k, tuple)])
+        for key, value in items:
+            target = d1
+            if self.expand and isinstance(key, tuple):
+                if len(key) == 0:
+                    raise KeyError("invalid key {0}".format(repr(key)))
+                for k in key[:-1]:
+                    child = target.get(k)
+                    if child is None:
+                        child = {}
+                        self._dicts.add(id(child))
+                    elif not isinstance(child, dict):
+                        err = "unable to merge {0} with {1}".format(type(child), dict)
+                        raise ValueError(err)
+                    target[k] = child = self._own_dict(child)
+                    target = child
+                key = key[-1]
+            if key in target:
+                target[key] = self._merge(target[key], value)
+            elif self.expand and isinstance(value, dict):
+                target[key] = self._own_dict(value)
+            else:
+                target[key] = value
+        return d1
+
+    def _merge(self, e1, e2):
         if isinstance(e1, dict) and isinstance(e2, dict):
-            return _merge_dicts(e1, e2)
+            return self._merge_dict(self._own_dict(e1), e2)
         elif isinstance(e1, list) and isinstance(e2, list):
-            return list(set(e1).union(e2))
+            out = self._own_list(e1)
+            seen = self._lists[id(out)]
+            for x in e2:
+                if x not in seen:
+                    seen.add(x)
+                    out.append(x)
+            return out
         else:
             err = "unable to merge {0} with {1}".format(type(e1), type(e2))
             raise ValueError(err)
 
-    return _merge(expr1, expr2)
+
+def nixmerge(expr1, expr2):
+    """
+    Merge both expressions into one, merging dictionary keys and appending list
+    elements if they otherwise would clash.
+    """
+    return NixMergeBuilder()._merge(expr1, expr2)
 
 
 def nix2py(source):
@@ -3,6 +3,7 @@ import sys
 import Queue
 import random
 import traceback
+import time
 
 class MultipleExceptions(Exception):
     def __init__(self, exceptions=[]):
@@ -74,3 +75,233 @@ def run_tasks(nr_workers, tasks, worker_fun):
         raise MultipleExceptions(exceptions)
 
     return results
+
+
+def run_pipeline(tasks, stages):
+    """Pass each task through 'stages', a list of (nr_workers,
+    worker_fun) pairs, feeding the result of each stage to the next.
+    A task enters the next stage as soon as it has left the previous
+    one, rather than when all tasks have; each stage runs at most
+    nr_workers tasks at a time.  A task for which a stage throws an
+    exception doesn't go further, but the others do.  Return the
+    results of the last stage."""
+    tasks = list(tasks)
+    if len(tasks) == 0: return []
+
+    # The queue of each stage holds its tasks wrapped in a tuple, so
+    # that None can tell its threads to stop.
+    queues = [Queue.Queue() for s in stages]
+    result_queue = Queue.Queue()
+
+    def thread_fun(n, worker_fun):
+        while True:
+            t = queues[n].get()
+            if t is None: break
+            try:
+                res = worker_fun(t[0])
+            except Exception as e:
+                result_queue.put((None, sys.exc_info()))
+                continue
+            if n + 1 < len(stages):
+                queues[n + 1].put((res,))
+            else:
+                result_queue.put((res, None))
+
+    for (nr_workers, worker_fun) in stages:
+        if nr_workers != -1 and nr_workers < 1:
+            raise Exception("number of worker threads must be at least 1")
+
+    threads = []
+    for n, (nr_workers, worker_fun) in enumerate(stages):
+        if nr_workers == -1: nr_workers = len(tasks)
+        for i in range(min(nr_workers, len(tasks))):
+            thr = threading.Thread(target=thread_fun, args=(n, worker_fun))
+            thr.daemon = True
+            thr.start()
+            threads.append((n, thr))
+
+    for t in tasks: queues[0].put((t,))
+
+    results = []
+    exceptions = []
+    done = 0
+    while done < len(tasks):
+        try:
+            # Use a timeout to allow keyboard interrupts to be
+            # processed.  The actual timeout value doesn't matter.
+            (res, excinfo) = result_queue.get(True, 1000)
+        except Queue.Empty:
+            continue
+        done += 1
+        if excinfo:
+            exceptions.append(excinfo)
+        else:
+            results.append(res)
+
+    for (n, thr) in threads: queues[n].put(None)
+    for (n, thr) in threads: thr.join()
+
+    if len(exceptions) == 1:
+        excinfo = exceptions[0]
+        raise excinfo[0], excinfo[1], excinfo[2]
+
+    if len(exceptions) > 1:
+        raise MultipleExceptions(exceptions)
+
+    return results
+
+
+class CycleError(Exception):
+    def __init__(self, tasks):
+        self.tasks = tasks
+
+    def __str__(self):
+        return "dependency cycle between " + ", ".join(
+            ["'{0}'".format(getattr(t, "name", t)) for t in self.tasks])
+
+
+class TaskGraph(object):
+    """A set of tasks, some of which must wait for others to finish.
+    'dependencies' is a function returning the tasks that a task
+    depends on; dependencies that are not in 'tasks' are ignored.
+    Tasks must be hashable."""
+
+    def __init__(self, tasks, dependencies):
+        self.tasks = list(tasks)
+        index = {t: n for n, t in enumerate(self.tasks)}
+        self._deps = [sorted(set(index[d] for d in dependencies(t) if d in index))
+                      for t in self.tasks]
+        self._rdeps = [[] for t in self.tasks]
+        for n, deps in enumerate(self._deps):
+            for d in deps: self._rdeps[d].append(n)
+        self._times = None
+
+    def order(self):
+        """Return the tasks in an order in which each task comes after
+        its dependencies, or raise CycleError."""
+        remaining = [len(deps) for deps in self._deps]
+        ready = [n for n, r in enumerate(remaining) if r == 0]
+        order = []
+        while ready:
+            n = ready.pop(0)
+            order.append(n)
+            for m in self._rdeps[n]:
+                remaining[m] -= 1
+                if remaining[m] == 0: ready.append(m)
+        if len(order) < len(self.tasks):
+            raise CycleError([t for n, t in enumerate(self.tasks) if remaining[n] > 0])
+        return [self.tasks[n] for n in order]
+
+    def run(self, nr_workers, worker_fun):
+        """Run 'worker_fun' on each task, in at most 'nr_workers'
+        threads (or as many as there are tasks ready to run if -1).  A
+        task is only started once all its dependencies have finished;
+        if one of them failed, the task is skipped, and so are the
+        tasks depending on it.  Threads are only started for tasks
+        that are ready to run.  Return the results of the tasks that
+        ran, or raise their exceptions like run_tasks()."""
+        self.order()
+        nr_tasks = len(self.tasks)
+        if nr_tasks == 0: return []
+        if nr_workers == -1: nr_workers = nr_tasks
+        if nr_workers < 1: raise Exception("number of worker threads must be at least 1")
+
+        work_queue = Queue.Queue()
+        result_queue = Queue.Queue()
+
+        def thread_fun():
+            while True:
+                n = work_queue.get()
+                if n is None: break
+                start = time.time()
+                try:
+                    result_queue.put((n, worker_fun(self.tasks[n]), None, start, time.time()))
+                except Exception as e:
+                    result_queue.put((n, None, sys.exc_info(), start, time.time()))
+
+        remaining = [len(deps) for deps in self._deps]
+        failed = [False] * nr_tasks
+        self._times = [None] * nr_tasks
+        ready = [n for n, r in enumerate(remaining) if r == 0]
+        threads = []
+        results = []
+        exceptions = []
+        running = 0
+        finished = 0
+
+        def finish(n):
+            """Release the tasks that depend on task n; return the
+            number of tasks that finished as a result, including the
+            skipped dependents of a failed task."""
+            count = 0
+            stack = [n]
+            while stack:
+                n = stack.pop()
+                count += 1
+                for m in self._rdeps[n]:
+                    if failed[n]: failed[m] = True
+                    remaining[m] -= 1
+                    if remaining[m] == 0:
+                        if failed[m]:
+                            now = time.time()
+                            self._times[m] = (now, now)
+                            stack.append(m)
+                        else:
+                            ready.append(m)
+            return count
+
+        try:
+            while finished < nr_tasks:
+                while ready and running < nr_workers:
+                    work_queue.put(ready.pop(0))
+                    running += 1
+                    if len(threads) < running:
+                        thr = threading.Thread(target=thread_fun)
+                        thr.daemon = True
+                        thr.start()
+                        threads.append(thr)
+                try:
+                    # Use a timeout to allow keyboard interrupts to be
+                    # processed.  The actual timeout value doesn't matter.
+                    (n, res, excinfo, start, end) = result_queue.get(True, 1000)
+                except Queue.Empty:
+                    continue
+                running -= 1
+                self._times[n] = (start, end)
+                if excinfo:
+                    exceptions.append(excinfo)
+                    failed[n] = True
+                else:
+                    results.append(res)
+                finished += finish(n)
+        finally:
+            for thr in threads: work_queue.put(None)
+
+        for thr in threads:
+            thr.join()
+
+        if len(exceptions) == 1:
+            excinfo = exceptions[0]
+            raise excinfo[0], excinfo[1], excinfo[2]
+
+        if len(exceptions) > 1:
+            raise MultipleExceptions(exceptions)
+
+        return results
+
+    def critical_path(self):
+        """Return the chain of tasks that determined how long the last
+        call to run() took, as a list of (task, seconds) pairs: the
+        last task to finish, preceded by the dependency that finished
+        last before it started, and so on."""
+        times = self._times or []
+        finished = [n for n, t in enumerate(times) if t]
+        if not finished: return []
+        n = max(finished, key=lambda n: times[n][1])
+        path = []
+        while n is not None:
+            (start, end) = times[n]
+            path.insert(0, (self.tasks[n], end - start))
+            deps = [d for d in self._deps[n] if times[d]]
+            n = max(deps, key=lambda d: times[d][1]) if deps else None
+        return path
@@ -59,19 +59,22 @@ class ResourceState(object):
         self.depl = depl
         self.name = name
         self.id = id
+        self._json_cache = nixops.util.JsonCache()
         self.logger = depl.logger.get_logger_for(name)
         self.logger.register_index(self.index)
 
     def _set_attrs(self, attrs):
         """Update machine attributes in the state file."""
-        with self.depl._db:
-            c = self.depl._db.cursor()
-            for n, v in attrs.iteritems():
-                if v == None:
-                    c.execute("delete from ResourceAttrs where machine = ? and name = ?", (self.id, n))
-                else:
-                    c.execute("insert or replace into ResourceAttrs(machine, name, value) values (?, ?, ?)",
-                              (self.id, n, v))
+        statements = []
+        for n, v in attrs.iteritems():
+            if v == None:
+                statements.append(("delete from ResourceAttrs where machine = ? and name = ?", (self.id, n)))
+                self._attrs.pop(n, None)
+            else:
+                statements.append(("insert or replace into ResourceAttrs(machine, name, value) values (?, ?, ?)",
+                                   (self.id, n, v)))
+                self._attrs[n] = nixops.util.text_value(v)
+        self.depl._db.write(statements)
 
     def _set_attr(self, name, value):
         """Update one machine attribute in the state file."""
@@ -79,27 +82,24 @@ class ResourceState(object):
 
     def _del_attr(self, name):
         """Delete a machine attribute from the state file."""
-        with self.depl._db:
-            self.depl._db.execute("delete from ResourceAttrs where machine = ? and name = ?", (self.id, name))
+        self.depl._db.write([("delete from ResourceAttrs where machine = ? and name = ?", (self.id, name))])
+        self._attrs.pop(name, None)
+
+    @property
+    def _attrs(self):
+        """The cached attributes of this resource (see Deployment._load_attrs)."""
+        return self.depl._resource_attrs[self.id]
 
     def _get_attr(self, name, default=nixops.util.undefined):
-        """Get a machine attribute from the state file."""
-        with self.depl._db:
-            c = self.depl._db.cursor()
-            c.execute("select value from ResourceAttrs where machine = ? and name = ?", (self.id, name))
-            row = c.fetchone()
-            if row != None: return row[0]
-            return nixops.util.undefined
+        """Get a machine attribute from the attribute cache."""
+        self.depl.attr_cache_hits += 1
+        return self._attrs.get(name, nixops.util.undefined)
 
     def export(self):
         """Export the resource to move between databases"""
-        with self.depl._db:
-            c = self.depl._db.cursor()
-            c.execute("select name, value from ResourceAttrs where machine = ?", (self.id,))
-            rows = c.fetchall()
-            res = {row[0]: row[1] for row in rows}
-            res['type'] = self.get_type()
-            return res
+        res = dict(self._attrs)
+        res['type'] = self.get_type()
+        return res
 
     def import_(self, attrs):
         """Import the resource from another database"""
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import nixops.deployment
+import collections
+import contextlib
 import os
 import os.path
 from pysqlite2 import dbapi2 as sqlite3
@@ -18,6 +20,14 @@ class Connection(sqlite3.Connection):
         self.db_file = db_file
         self.nesting = 0
         self.lock = threading.RLock()
+        self.read_only = False
+        self._warned_read_only = False
+
+        # Group commit state (see group_commit()).
+        self.commits = 0
+        self._queue = None
+        self._queue_lock = threading.Lock()
+        self._owner = None
 
     # Implement Python's context management protocol so that "with db"
     # automatically commits or rolls back.  The difference with the
@@ -26,7 +36,11 @@ class Connection(sqlite3.Connection):
     def __enter__(self):
         self.lock.acquire()
         if self.nesting == 0:
+            # Queued writes must hit the database before anything
+            # done inside this transaction.
+            self.flush()
             self.must_rollback = False
+            self._owner = threading.current_thread()
         self.nesting = self.nesting + 1
         sqlite3.Connection.__enter__(self)
 
@@ -36,6 +50,7 @@ class Connection(sqlite3.Connection):
         self.nesting = self.nesting - 1
         assert self.nesting >= 0
         if self.nesting == 0:
+            self._owner = None
             if self.must_rollback:
                 try:
                     self.rollback()
@@ -45,6 +60,99 @@ class Connection(sqlite3.Connection):
                 sqlite3.Connection.__exit__(self, exception_type, exception_value, exception_traceback)
         self.lock.release()
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the block in a single SQLite transaction.  (A plain ‘with
+        db’ doesn't start one, since the connection is in autocommit
+        mode.)  Nested uses join the outermost transaction."""
+        with self:
+            if self.nesting > 1:
+                yield
+                return
+            self.execute("begin")
+            try:
+                yield
+            except:
+                self.execute("rollback")
+                raise
+            self.execute("commit")
+            self.commits += 1
+
+    def _execute_batch(self, statements):
+        with self.transaction():
+            for (sql, params) in statements: self.execute(sql, params)
+
+    def write(self, statements):
+        """Execute a list of (sql, params) write statements in one
+        transaction.  In group commit mode, the statements are queued
+        and committed together with those of other threads at the next
+        flush, unless the calling thread is inside a ‘with db’ block.
+        On a read-only connection, the statements are discarded, with a
+        warning the first time."""
+        if self.read_only:
+            if not self._warned_read_only:
+                self._warned_read_only = True
+                sys.stderr.write("warning: not saving changes to read-only state file ‘{0}’\n".format(self.db_file))
+            return
+        with self._queue_lock:
+            if self._queue is not None and self._owner is not threading.current_thread():
+                self._queue.extend(statements)
+                return
+        self._execute_batch(statements)
+
+    def flush(self):
+        """Commit all queued writes in a single transaction."""
+        with self.lock:
+            with self._queue_lock:
+                if not self._queue: return
+                statements = self._queue
+                self._queue = []
+            self._execute_batch(statements)
+
+    @contextlib.contextmanager
+    def group_commit(self, interval=0.1):
+        """Queue writes issued via write() and commit them in batches
+        every ‘interval’ seconds, and on flush() or exit of the block.
+        A crash can lose the writes of at most the last interval."""
+        assert self._queue is None
+        self._queue = []
+        stop = threading.Event()
+
+        def flusher():
+            while not stop.wait(interval):
+                self.flush()
+
+        thr = threading.Thread(target=flusher)
+        thr.daemon = True
+        thr.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thr.join()
+            self.flush()
+            with self._queue_lock:
+                self._queue = None
+
+
+class _Reader(object):
+    """The read-only connection of one thread (see
+    StateFile._read_cursor()).  It is closed when the thread exits and
+    its thread-local storage goes away, so that thread pools don't
+    leave connections behind."""
+
+    def __init__(self, db_file, dbs, lock):
+        self.db = sqlite3.connect(db_file, timeout=60, check_same_thread=False, isolation_level=None)
+        self._dbs = dbs
+        self._lock = lock
+        with lock: dbs.append(self.db)
+
+    def __del__(self):
+        with self._lock:
+            if self.db not in self._dbs: return
+            self._dbs.remove(self.db)
+        self.db.close()
+
 
 def get_default_state_file():
     home = os.environ.get("HOME", "") + "/.nixops"
@@ -60,19 +168,42 @@ def get_default_state_file():
     return os.environ.get("NIXOPS_STATE", os.environ.get("CHARON_STATE", home + "/deployments.nixops"))
 
 
+DeploymentSummary = collections.namedtuple('DeploymentSummary', ['uuid', 'name', 'description', 'resources'])
+ResourceSummary = collections.namedtuple('ResourceSummary', ['name', 'type', 'state'])
+
+
 class StateFile(object):
     """NixOps state file."""
 
-    current_schema = 3
+    current_schema = 4
 
-    def __init__(self, db_file):
+    def __init__(self, db_file, read_only=False):
+        """Open the state file.  If ‘read_only’ is set, the schema is
+        neither created nor upgraded and the database is never written
+        to, so the state file can be queried without contending with
+        concurrent deployments.  Attribute changes made through a
+        read-only state file are visible only to the current process."""
         self.db_file = db_file
 
         if os.path.splitext(db_file)[1] not in ['.nixops', '.charon']:
             raise Exception("state file ‘{0}’ should have extension ‘.nixops’".format(db_file))
+
+        # A new state file needs its schema, so it can't start out
+        # read-only.
+        if read_only and not os.path.exists(db_file): read_only = False
+        self.read_only = read_only
+
         db = sqlite3.connect(db_file, timeout=60, check_same_thread=False, factory=Connection, isolation_level=None) # FIXME
         db.db_file = db_file
 
+        if read_only:
+            db.read_only = True
+            db.execute("pragma query_only = 1")
+            self._check_schema(db.cursor())
+            self._db = db
+            self._init_readers()
+            return
+
         db.execute("pragma journal_mode = wal")
         db.execute("pragma foreign_keys = 1")
 
@@ -96,22 +227,90 @@ class StateFile(object):
             elif version < self.current_schema:
                 if version <= 1: self._upgrade_1_to_2(c)
                 if version <= 2: self._upgrade_2_to_3(c)
+                if version <= 3: self._upgrade_3_to_4(c)
                 c.execute("update SchemaVersion set version = ?", (self.current_schema,))
             else:
                 raise Exception("this NixOps version is too old to deal with schema version {0}".format(version))
 
         self._db = db
+        self._init_readers()
+
+    def _init_readers(self):
+        # Per-thread connections for read-only queries (see
+        # _read_cursor()).
+        self._readers = threading.local()
+        self._reader_dbs = []
+        self._reader_lock = threading.Lock()
+
+    def _check_schema(self, c):
+        """Check that a state file opened read-only can be used as is.
+        Schema version 3 only lacks indexes, so it's good enough for
+        querying."""
+        version = 0
+        if self._table_exists(c, 'SchemaVersion'):
+            c.execute("select version from SchemaVersion")
+            version = c.fetchone()[0]
+        elif self._table_exists(c, 'Deployments'):
+            version = 1
+        if version > self.current_schema:
+            raise Exception("this NixOps version is too old to deal with schema version {0}".format(version))
+        if version < 3:
+            raise Exception("state file ‘{0}’ needs a schema upgrade, which can't be done in read-only mode".format(self.db_file))
 
     def close(self):
+        with self._reader_lock:
+            for r in self._reader_dbs: r.close()
+            del self._reader_dbs[:]
         self._db.close()
 
+    def _read_cursor(self):
+        """Return a cursor for read-only queries.  Each thread gets its
+        own connection, so that in WAL mode readers neither wait for
+        each other nor for the writer connection's lock.  A thread
+        inside a ‘with db’ block reads through the writer connection so
+        that it sees its own uncommitted changes."""
+        db = self._db
+        if db._owner is threading.current_thread():
+            return db.cursor()
+        # Readers only see committed data, so commit queued writes first.
+        with db._queue_lock: queued = bool(db._queue)
+        if queued: db.flush()
+        r = getattr(self._readers, 'reader', None)
+        if r is None:
+            r = _Reader(self.db_file, self._reader_dbs, self._reader_lock)
+            self._readers.reader = r
+        return r.db.cursor()
+
     def query_deployments(self):
         """Return the UUIDs of all deployments in the database."""
-        c = self._db.cursor()
+        c = self._read_cursor()
         c.execute("select uuid from Deployments")
         res = c.fetchall()
         return [x[0] for x in res]
 
+    def get_deployment_summaries(self):
+        """Return a DeploymentSummary for every deployment in the
+        database, without creating Deployment or resource state
+        objects."""
+        c = self._read_cursor()
+        c.execute(
+            """select d.uuid, dn.value, dd.value, r.name, r.type, rs.value
+               from Deployments d
+               left join DeploymentAttrs dn on dn.deployment = d.uuid and dn.name = 'name'
+               left join DeploymentAttrs dd on dd.deployment = d.uuid and dd.name = 'description'
+               left join Resources r on r.deployment = d.uuid
+               left join ResourceAttrs rs on rs.machine = r.id and rs.name = 'state'
+               order by d.uuid""")
+        res = []
+        for (uuid, name, description, r_name, r_type, r_state) in c.fetchall():
+            if not res or res[-1].uuid != uuid:
+                res.append(DeploymentSummary(
+                    uuid, name, description or nixops.deployment.Deployment.default_description, []))
+            if r_name is not None:
+                res[-1].resources.append(ResourceSummary(
+                    r_name, r_type, int(r_state) if r_state is not None else None))
+        return res
+
     def get_all_deployments(self):
         """Return Deployment objects for every deployment in the database."""
         uuids = self.query_deployments()
@@ -124,11 +323,11 @@ class StateFile(object):
         return res
 
     def _find_deployment(self, uuid=None):
-        c = self._db.cursor()
+        c = self._read_cursor()
         if not uuid:
             c.execute("select uuid from Deployments")
         else:
-            c.execute("select uuid from Deployments d where uuid = ? or exists (select 1 from DeploymentAttrs where deployment = d.uuid and name = 'name' and value = ?)", (uuid, uuid))
+            c.execute("select uuid from Deployments where uuid = ? union select deployment from DeploymentAttrs where name = 'name' and value = ?", (uuid, uuid))
         res = c.fetchall()
         if len(res) == 0:
             if uuid:
@@ -161,6 +360,63 @@ class StateFile(object):
             self._db.execute("insert into Deployments(uuid) values (?)", (uuid,))
         return nixops.deployment.Deployment(self, uuid, sys.stderr)
 
+    def export_records(self, uuids):
+        """Yield the state of the given deployments as a sequence of
+        records: one per deployment, followed by one per resource of
+        that deployment.  Rows are read incrementally, so memory use
+        doesn't depend on the size of the state file."""
+        c = self._read_cursor()
+        for uuid in uuids:
+            # Leave out the evaluation results that older versions kept
+            # in the state file.
+            c.execute("select name, value from DeploymentAttrs where deployment = ? and name != 'evaluatedInfo'", (uuid,))
+            yield {'deployment': uuid, 'attrs': dict(c.fetchall())}
+
+            c.execute("select r.id, r.name, r.type, a.name, a.value from Resources r "
+                      "left join ResourceAttrs a on a.machine = r.id "
+                      "where r.deployment = ? order by r.id", (uuid,))
+            rec = None
+            for (id, name, type, attr, value) in c:
+                if rec is None or rec['id'] != id:
+                    if rec: yield rec['record']
+                    rec = {'id': id, 'record': {'deployment': uuid, 'resource': name, 'attrs': {'type': type}}}
+                if attr is not None:
+                    rec['record']['attrs'][attr] = value
+            if rec: yield rec['record']
+
+    def import_records(self, records):
+        """Add the deployments described by a sequence of records (see
+        export_records()) to the state file in a single transaction.
+        Return the UUIDs of the imported deployments."""
+        uuids = []
+        current = None
+        with self._db.transaction():
+            c = self._db.cursor()
+            for rec in records:
+                uuid = rec['deployment']
+                if 'resource' not in rec:
+                    c.execute("select 1 from Deployments where uuid = ?", (uuid,))
+                    if c.fetchone():
+                        raise Exception("state file already contains a deployment with UUID ‘{0}’".format(uuid))
+                    c.execute("insert into Deployments(uuid) values (?)", (uuid,))
+                    c.executemany("insert into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
+                                  [(uuid, k, v) for k, v in rec['attrs'].iteritems()])
+                    uuids.append(uuid)
+                    current = uuid
+                else:
+                    if uuid != current:
+                        raise Exception("resource ‘{0}’ precedes its deployment ‘{1}’".format(rec['resource'], uuid))
+                    attrs = rec['attrs']
+                    if 'type' not in attrs: raise Exception("imported resource lacks a type")
+                    # Fail now rather than when the deployment is opened.
+                    nixops.deployment._state_class(attrs['type'])
+                    c.execute("insert into Resources(deployment, name, type) values (?, ?, ?)",
+                              (uuid, rec['resource'], attrs['type']))
+                    id = c.lastrowid
+                    c.executemany("insert into ResourceAttrs(machine, name, value) values (?, ?, ?)",
+                                  [(id, k, v) for k, v in attrs.iteritems() if k != 'type'])
+        return uuids
+
     def _table_exists(self, c, table):
         c.execute("select 1 from sqlite_master where name = ? and type='table'", (table,));
         return c.fetchone() != None
@@ -208,6 +464,15 @@ class StateFile(object):
                  foreign key(machine) references Resources(id) on delete cascade
                );''')
 
+        self._create_indexes(c)
+
+    def _create_indexes(self, c):
+        # Covering index for looking up deployments by name.
+        c.execute("create index if not exists DeploymentAttrsByValue on DeploymentAttrs(name, value, deployment)")
+        # For loading the resources of a deployment, and for cascading
+        # deletes of deployments.
+        c.execute("create index if not exists ResourcesByDeployment on Resources(deployment, name)")
+
     def _upgrade_1_to_2(self, c):
         sys.stderr.write("updating database schema from version 1 to 2...\n")
         self._create_schemaversion(c)
@@ -217,4 +482,8 @@ class StateFile(object):
         c.execute("alter table Machines rename to Resources")
         c.execute("alter table MachineAttrs rename to ResourceAttrs")
 
+    def _upgrade_3_to_4(self, c):
+        sys.stderr.write("updating database schema from version 3 to 4...\n")
+        self._create_indexes(c)
+
 
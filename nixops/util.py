@@ -15,7 +15,9 @@ import tempfile
 import subprocess
 import logging
 import atexit
+import cPickle
 from StringIO import StringIO
+from xml.etree import ElementTree
 
 devnull = open(os.devnull, 'rw')
 
@@ -208,6 +210,40 @@ def abs_nix_path(x):
 
 undefined = object()
 
+def text_value(x):
+    """Return ‘x’ as SQLite would hand it back from a ‘text’ column."""
+    if isinstance(x, bool): return unicode(int(x))
+    if isinstance(x, (int, long, float)): return unicode(x)
+    return x
+
+
+class JsonCache(object):
+    """Cache of the decoded values of the JSON attributes of a
+    deployment or resource, keyed by attribute name.  An entry is only
+    used while the attribute still has the encoded value it was
+    created from, so writes invalidate it.  Every lookup returns a
+    fresh copy (unpickling is much cheaper than json.loads()), so
+    callers may modify the result."""
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, name, s):
+        e = self._entries.get(name)
+        if e is None or e[0] is not s:
+            e = (s, cPickle.dumps(json.loads(s), cPickle.HIGHEST_PROTOCOL))
+            self._entries[name] = e
+        return cPickle.loads(e[1])
+
+    def put(self, name, x):
+        """Return the encoded value of ‘x’, remembering its decoded value.
+        That is the value decoded from the state file rather than ‘x’,
+        which may e.g. contain tuples or non-string keys."""
+        s = json.dumps(x)
+        self._entries[name] = (s, cPickle.dumps(json.loads(s), cPickle.HIGHEST_PROTOCOL))
+        return s
+
+
 def attr_property(name, default, type=str):
     """Define a property that corresponds to a value in the NixOps state file."""
     def get(self):
@@ -219,15 +255,30 @@ def attr_property(name, default, type=str):
         elif type is str: return s
         elif type is int: return int(s)
         elif type is bool: return True if s == "1" else False
-        elif type is 'json': return json.loads(s)
+        elif type is 'json': return self._json_cache.get(name, s)
         else: assert False
     def set(self, x):
         if x == default: self._del_attr(name)
-        elif type is 'json': self._set_attr(name, json.dumps(x))
+        elif type is 'json': self._set_attr(name, self._json_cache.put(name, x))
         else: self._set_attr(name, x)
     return property(get, set)
 
 
+def update_json_attr(obj, name, key, value, default={}):
+    """Set key ‘key’ of the JSON object in attribute ‘name’ of ‘obj’ to
+    ‘value’, or delete it if ‘value’ is None, without decoding the
+    attribute again."""
+    s = obj._get_attr(name)
+    x = copy.deepcopy(default) if s == undefined else obj._json_cache.get(name, s)
+    if value == None:
+        if key not in x: return
+        del x[key]
+    else:
+        x[key] = value
+    if x == default: obj._del_attr(name)
+    else: obj._set_attr(name, obj._json_cache.put(name, x))
+
+
 def create_key_pair(key_name="NixOps auto-generated key", type="ed25519"):
     key_dir = tempfile.mkdtemp(prefix="nixops-key-tmp")
     res = subprocess.call(["ssh-keygen", "-t", type, "-f", key_dir + "/key", "-N", '', "-C", key_name],
@@ -349,6 +400,67 @@ def xml_expr_to_python(node):
     raise Exception("cannot convert XML output of nix-instantiate to Python: Unknown tag "+node.tag)
 
 
+def python_to_xml_expr(x):
+    """Return the element that ‘nix-instantiate --xml’ prints for the
+    value that ‘nix-instantiate --json’ prints as ‘x’.  This is the
+    inverse of xml_expr_to_python()."""
+    if isinstance(x, dict):
+        node = ElementTree.Element("attrs")
+        for name in sorted(x.iterkeys()):
+            attr = ElementTree.SubElement(node, "attr", name=name)
+            attr.append(python_to_xml_expr(x[name]))
+        return node
+
+    elif isinstance(x, list):
+        node = ElementTree.Element("list")
+        for elem in x:
+            node.append(python_to_xml_expr(elem))
+        return node
+
+    elif isinstance(x, basestring):
+        return ElementTree.Element("string", value=x)
+
+    elif isinstance(x, bool):
+        return ElementTree.Element("bool", value="true" if x else "false")
+
+    elif isinstance(x, (int, long)):
+        return ElementTree.Element("int", value=str(x))
+
+    elif isinstance(x, float):
+        return ElementTree.Element("float", value=repr(x))
+
+    elif x is None:
+        return ElementTree.Element("null")
+
+    raise Exception("cannot convert {0} to the XML output of nix-instantiate".format(type(x).__name__))
+
+
+class LazyXmlAttr(object):
+    """Stand-in for the ‘<attr name="...">’ element describing a
+    resource in the XML output of nix-instantiate, for resource
+    definition classes that still parse XML.  The element is only
+    synthesized from the resource's JSON value when it's first used
+    beyond asking for its name."""
+
+    def __init__(self, name, value):
+        self._name = name
+        self._value = value
+        self._elem = None
+
+    def _element(self):
+        if self._elem is None:
+            self._elem = ElementTree.Element("attr", name=self._name)
+            self._elem.append(python_to_xml_expr(self._value))
+        return self._elem
+
+    def get(self, key, default=None):
+        if key == "name": return self._name
+        return self._element().get(key, default)
+
+    def __getattr__(self, name):
+        return getattr(self._element(), name)
+
+
 def parse_nixos_version(s):
     """Split a NixOS version string into a list of components."""
     return s.split(".")
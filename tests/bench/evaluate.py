@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Compare the XML and JSON ways of turning the output of
+‘nix-instantiate -A info’ into resource definitions, on synthetic
+networks of the given sizes.  Nix itself is not run.
+
+Usage: python -m tests.bench.evaluate [NR-MACHINES...]
+"""
+
+import sys
+import json
+import time
+from xml.etree import ElementTree
+import nixops.deployment
+import nixops.util
+
+
+def machine_info(n):
+    return {
+        "targetEnv": "none", "targetHost": "10.0.{0}.{1}".format(n / 256, n % 256),
+        "targetPort": 22, "publicIPv4": None, "nixosRelease": "17.03",
+        "encryptedLinksTo": [], "storeKeysOnMachine": False, "alwaysActivate": True,
+        "owners": ["ops@example.org"], "hasFastConnection": False,
+        "keys": {"key-{0}".format(k): {"text": "secret", "user": "root", "group": "root", "permissions": "0600"}
+                 for k in range(5)},
+        "route53": {"accessKeyId": "", "hostName": "", "ttl": 300, "usePublicDNSName": False},
+        "azure": {}, "ec2": {}, "digitalOcean": {}, "gce": {}, "hetzner": {},
+        "container": {}, "virtualbox": {}, "libvirtd": {},
+    }
+
+
+def network_info(nr_machines):
+    return {
+        "network": {"description": "benchmark"},
+        "machines": {"machine-{0}".format(n): machine_info(n) for n in range(nr_machines)},
+        "resources": {"sshKeyPairs": {"key-{0}".format(n): {"name": "key-{0}".format(n)}
+                                      for n in range(nr_machines / 10)}},
+    }
+
+
+def from_xml(xml):
+    """The former XML code path of Deployment.evaluate()."""
+    tree = ElementTree.fromstring(xml)
+    config = nixops.util.xml_expr_to_python(tree.find("*"))
+    defs = {}
+    for x in tree.findall("attrs/attr[@name='machines']/attrs/attr"):
+        name = x.get("name")
+        cfg = config["machines"][name]
+        defs[name] = nixops.deployment._create_definition(x, cfg, cfg["targetEnv"])
+    for x in tree.findall("attrs/attr[@name='resources']/attrs/attr"):
+        for y in x.findall("attrs/attr"):
+            name = y.get("name")
+            defs[name] = nixops.deployment._create_definition(y, config["resources"][x.get("name")][name], x.get("name"))
+    return defs
+
+
+class FakeDeployment(object):
+    default_description = "Unnamed NixOps network"
+    _set_definitions = nixops.deployment.Deployment._set_definitions.__func__
+
+
+def from_json(out):
+    depl = FakeDeployment()
+    depl._set_definitions(json.loads(out))
+    return depl.definitions
+
+
+def timed(f, repeat=3):
+    start = time.time()
+    for n in range(repeat): f()
+    return (time.time() - start) / repeat * 1000
+
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or [100, 1000, 5000]
+    print "{0:>10} {1:>10} {2:>10} {3:>10} {4:>10}".format("machines", "XML (MB)", "XML (ms)", "JSON (MB)", "JSON (ms)")
+    for n in sizes:
+        info = network_info(n)
+        xml = '<?xml version="1.0" encoding="utf-8"?>\n<expr>' + \
+            ElementTree.tostring(nixops.util.python_to_xml_expr(info)) + '</expr>'
+        out = json.dumps(info)
+        assert sorted(from_xml(xml)) == sorted(from_json(out))
+        print "{0:>10} {1:>10.1f} {2:>10.1f} {3:>10.1f} {4:>10.1f}".format(
+            n, len(xml) / 1e6, timed(lambda: from_xml(xml)), len(out) / 1e6, timed(lambda: from_json(out)))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Time deployment lookup by name and UUID prefix, and loading of a
+deployment's resources, as the number of deployments in the state file
+grows.
+
+Usage: python -m tests.bench.find_deployment [NR-DEPLOYMENTS...]
+"""
+
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+import nixops.statefile
+
+
+def populate(sf, nr_deployments, nr_resources=10, nr_attrs=20):
+    db = sf._db
+    with db:
+        db.execute("begin")
+        for n in range(nr_deployments):
+            u = str(uuid.uuid4())
+            db.execute("insert into Deployments(uuid) values (?)", (u,))
+            db.executemany("insert into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
+                           [(u, "name", "depl-{0}".format(n)), (u, "description", "deployment {0}".format(n))])
+            for m in range(nr_resources):
+                c = db.cursor()
+                c.execute("insert into Resources(deployment, name, type) values (?, ?, ?)",
+                          (u, "machine-{0}".format(m), "none"))
+                db.executemany("insert into ResourceAttrs(machine, name, value) values (?, ?, ?)",
+                               [(c.lastrowid, "attr{0}".format(a), "value") for a in range(nr_attrs)])
+        db.execute("commit")
+
+
+def timed(f, repeat=20):
+    start = time.time()
+    for n in range(repeat): f()
+    return (time.time() - start) / repeat * 1000
+
+
+def run(nr_deployments, indexes):
+    tmpdir = tempfile.mkdtemp(prefix="nixops-bench")
+    try:
+        sf = nixops.statefile.StateFile(tmpdir + "/bench.nixops")
+        if not indexes:
+            sf._db.execute("drop index DeploymentAttrsByValue")
+            sf._db.execute("drop index ResourcesByDeployment")
+        populate(sf, nr_deployments)
+        name = "depl-{0}".format(nr_deployments / 2)
+        u = sf.open_deployment(name).uuid
+        res = (timed(lambda: sf._find_deployment(name)),
+               timed(lambda: sf._find_deployment(u[:8])),
+               timed(lambda: sf.open_deployment(u)))
+        sf.close()
+        return res
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or [10, 100, 1000, 5000]
+    print "{0:>12} {1:>8} {2:>10} {3:>10} {4:>10}".format("deployments", "indexes", "name (ms)", "prefix (ms)", "open (ms)")
+    for n in sizes:
+        for indexes in [False, True]:
+            (by_name, by_prefix, load) = run(n, indexes)
+            print "{0:>12} {1:>8} {2:>10.2f} {3:>10.2f} {4:>10.2f}".format(n, "yes" if indexes else "no", by_name, by_prefix, load)
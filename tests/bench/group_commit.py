@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Compare per-write commits with group commit for attribute updates
+issued by parallel workers.
+
+Usage: python -m tests.bench.group_commit [NR-RESOURCES]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import nixops.statefile
+import nixops.parallel
+
+
+def run(nr_resources, interval):
+    tmpdir = tempfile.mkdtemp(prefix="nixops-bench")
+    try:
+        sf = nixops.statefile.StateFile(tmpdir + "/bench.nixops")
+        depl = sf.create_deployment()
+        with sf._db:
+            resources = [depl._create_resource("machine-{0}".format(n), "none")
+                         for n in range(nr_resources)]
+
+        def worker(r):
+            r.state = r.STARTING
+            r.index = r.id
+            r.vm_id = "vm-{0}".format(r.id)
+            r.ssh_pinged = True
+            r.state = r.UP
+
+        commits = sf._db.commits
+        start = time.time()
+        if interval is None:
+            nixops.parallel.run_tasks(nr_workers=-1, tasks=resources, worker_fun=worker)
+        else:
+            with sf._db.group_commit(interval):
+                nixops.parallel.run_tasks(nr_workers=-1, tasks=resources, worker_fun=worker)
+        elapsed = time.time() - start
+        commits = sf._db.commits - commits
+        sf.close()
+        return (commits, elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    nr_resources = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for (label, interval) in [("per-write commits", None), ("group commit (100 ms)", 0.1)]:
+        (commits, elapsed) = run(nr_resources, interval)
+        print "{0}: {1} resources, {2} commits, {3:.2f} s".format(label, nr_resources, commits, elapsed)
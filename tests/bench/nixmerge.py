@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Compare merging the given numbers of fragments of a network
+specification with NixMergeBuilder against reducing them with the
+former nixmerge(), which copied the whole result on every merge.
+
+Usage: python -m tests.bench.nixmerge [NR-FRAGMENTS...]
+"""
+
+import sys
+import time
+from nixops.nix_expr import NixMergeBuilder, expand_dict, RawValue
+
+
+def old_nixmerge(expr1, expr2):
+    """The former nixops.nix_expr.nixmerge()."""
+    def _merge_dicts(d1, d2):
+        out = {}
+        for key in set(d1.keys()).union(d2.keys()):
+            if key in d1 and key in d2:
+                out[key] = _merge(d1[key], d2[key])
+            elif key in d1:
+                out[key] = d1[key]
+            else:
+                out[key] = d2[key]
+        return out
+
+    def _merge(e1, e2):
+        if isinstance(e1, dict) and isinstance(e2, dict):
+            return _merge_dicts(e1, e2)
+        elif isinstance(e1, list) and isinstance(e2, list):
+            return list(set(e1).union(e2))
+        else:
+            err = "unable to merge {0} with {1}".format(type(e1), type(e2))
+            raise ValueError(err)
+
+    return _merge(expr1, expr2)
+
+
+def fragment(n):
+    """Return the n'th fragment: alternately a machine and a resource,
+    all of them adding to a shared list."""
+    if n % 2 == 0:
+        return {"machine-{0}".format(n): {
+            ('networking', 'privateIPv4'): "10.0.{0}.{1}".format(n / 256 % 256, n % 256),
+            ('deployment', 'targetEnv'): "ec2",
+            'imports': [RawValue("hosts0")],
+        }, ('network', 'tags'): ["tag-{0}".format(n % 100)]}
+    else:
+        return {('resources', 'ec2KeyPairs', "key-{0}".format(n)): {'region': "eu-west-1"},
+                ('network', 'tags'): ["tag-{0}".format(n % 100)]}
+
+
+def timed(f):
+    start = time.time()
+    out = f()
+    return ((time.time() - start) * 1000, out)
+
+
+def build(fragments):
+    builder = NixMergeBuilder()
+    for x in fragments: builder.add(x)
+    return builder.value
+
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 10000]
+    print "{0:>10} {1:>12} {2:>12} {3:>12}".format("fragments", "reduce (ms)", "builder (ms)", "expand (ms)")
+    for n in sizes:
+        fragments = [fragment(i) for i in range(n)]
+        (old_time, old) = timed(lambda: reduce(old_nixmerge, fragments, {}))
+        (new_time, new) = timed(lambda: build(fragments))
+        assert sorted(old) == sorted(new)
+        (expand_time, _) = timed(lambda: expand_dict(new))
+        print "{0:>10} {1:>12.1f} {2:>12.1f} {3:>12.1f}".format(n, old_time, new_time, expand_time)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""Compare the size of the physical specification generated for
+synthetic networks of the given sizes, and the time taken to generate
+it, with those of the former implementation that specialised the
+network-wide host tables for every machine.  Nix itself is not run.
+
+Usage: python -m tests.bench.physical_spec [NR-MACHINES...]
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+from collections import defaultdict
+import nixops.backends
+import nixops.statefile
+import nixops.util
+from nixops.deployment import is_machine
+from nixops.nix_expr import RawValue, Function, Call, nixmerge, py2nix
+
+
+class BenchMachineState(nixops.backends.MachineState):
+    """A machine that reaches other machines of its type through their
+    private address, like EC2 machines do."""
+
+    @classmethod
+    def get_type(cls):
+        return "bench-machine"
+
+    public_ipv4 = nixops.util.attr_property("publicIpv4", None)
+    private_ipv4 = nixops.util.attr_property("privateIpv4", None)
+    public_host_key = nixops.util.attr_property("publicHostKey", None)
+
+    def address_to(self, m):
+        if isinstance(m, BenchMachineState):
+            return m.private_ipv4
+        return nixops.backends.MachineState.address_to(self, m)
+
+
+class FakeDefinition(object):
+    def __init__(self, encrypted_links_to):
+        self.encrypted_links_to = encrypted_links_to
+        self.config = {"nixosRelease": "17.03"}
+
+
+def populate(depl, nr_machines):
+    with depl._db:
+        for n in range(nr_machines):
+            m = depl._create_resource("machine-{0}".format(n), "bench-machine")
+            m.index = n
+            m.public_ipv4 = "198.51.{0}.{1}".format(n / 256, n % 256)
+            m.private_ipv4 = "10.0.{0}.{1}".format(n / 256, n % 256)
+            m.public_host_key = "ssh-ed25519 " + "A" * 68
+            m.public_vpn_key = "ssh-rsa " + "B" * 372
+            # Every tenth machine has an encrypted link to the next one.
+            links = ["machine-{0}".format(n + 1)] if n % 10 == 0 and n + 1 < nr_machines else []
+            depl.definitions[m.name] = FakeDefinition(links)
+
+
+def old_physical_spec(self):
+    """The former Deployment.get_physical_spec()."""
+
+    active_machines = self.active
+    active_resources = self.active_resources
+
+    attrs_per_resource = {m.name: [] for m in active_resources.itervalues()}
+    authorized_keys = {m.name: [] for m in active_machines.itervalues()}
+    kernel_modules = {m.name: set() for m in active_machines.itervalues()}
+    trusted_interfaces = {m.name: set() for m in active_machines.itervalues()}
+
+    # Hostnames should be accumulated like this:
+    #
+    #   hosts[local_name][remote_ip] = [name1, name2, ...]
+    #
+    # This makes hosts deterministic and is more in accordance to the
+    # format in hosts(5), which is like this:
+    #
+    #   ip_address canonical_hostname [aliases...]
+    #
+    # This is critical for example when using host names for access
+    # control, because the canonical_hostname is returned in reverse
+    # lookups.
+    hosts = defaultdict(lambda: defaultdict(list))
+
+    def index_to_private_ip(index):
+        n = 105 + index / 256
+        assert n <= 255
+        return "192.168.{0}.{1}".format(n, index % 256)
+
+    def do_machine(m):
+        defn = self.definitions[m.name]
+        attrs_list = attrs_per_resource[m.name]
+
+        # Emit configuration to realise encrypted peer-to-peer links.
+        for m2 in active_resources.itervalues():
+            ip = m.address_to(m2)
+            if ip:
+                hosts[m.name][ip] += [m2.name, m2.name + "-unencrypted"]
+
+        # Always use the encrypted/unencrypted suffixes for aliases rather
+        # than for the canonical name!
+        hosts[m.name]["127.0.0.1"].append(m.name + "-encrypted")
+
+        for m2_name in defn.encrypted_links_to:
+
+            if m2_name not in active_machines:
+                raise Exception("‘deployment.encryptedLinksTo’ in machine ‘{0}’ refers to an unknown machine ‘{1}’"
+                                .format(m.name, m2_name))
+            m2 = active_machines[m2_name]
+
+            # Don't create two tunnels between a pair of machines.
+            if m.name in self.definitions[m2.name].encrypted_links_to and m.name >= m2.name:
+                continue
+            local_ipv4 = index_to_private_ip(m.index)
+            remote_ipv4 = index_to_private_ip(m2.index)
+            local_tunnel = 10000 + m2.index
+            remote_tunnel = 10000 + m.index
+            attrs_list.append({
+                ('networking', 'p2pTunnels', 'ssh', m2.name): {
+                    'target': '{0}-unencrypted'.format(m2.name),
+                    'targetPort': m2.ssh_port,
+                    'localTunnel': local_tunnel,
+                    'remoteTunnel': remote_tunnel,
+                    'localIPv4': local_ipv4,
+                    'remoteIPv4': remote_ipv4,
+                    'privateKey': '/root/.ssh/id_charon_vpn',
+                }
+            })
+
+            # FIXME: set up the authorized_key file such that ‘m’
+            # can do nothing more than create a tunnel.
+            authorized_keys[m2.name].append(m.public_vpn_key)
+            kernel_modules[m.name].add('tun')
+            kernel_modules[m2.name].add('tun')
+            hosts[m.name][remote_ipv4] += [m2.name, m2.name + "-encrypted"]
+            hosts[m2.name][local_ipv4] += [m.name, m.name + "-encrypted"]
+            trusted_interfaces[m.name].add('tun' + str(local_tunnel))
+            trusted_interfaces[m2.name].add('tun' + str(remote_tunnel))
+
+        private_ipv4 = m.private_ipv4
+        if private_ipv4:
+            attrs_list.append({
+                ('networking', 'privateIPv4'): private_ipv4
+            })
+        public_ipv4 = m.public_ipv4
+        if public_ipv4:
+            attrs_list.append({
+                ('networking', 'publicIPv4'): public_ipv4
+            })
+        public_vpn_key = m.public_vpn_key
+        if public_vpn_key:
+            attrs_list.append({
+                ('networking', 'vpnPublicKey'): public_vpn_key
+            })
+
+        # Set system.stateVersion if the Nixpkgs version supports it.
+        if nixops.util.parse_nixos_version(defn.config["nixosRelease"]) >= ["15", "09"]:
+            attrs_list.append({
+                ('system', 'stateVersion'): Call(RawValue("lib.mkDefault"), m.state_version or defn.config["nixosRelease"])
+            })
+
+        if self.nixos_version_suffix:
+            attrs_list.append({
+                ('system', 'nixosVersionSuffix'): self.nixos_version_suffix
+            })
+
+    for m in active_machines.itervalues():
+        do_machine(m)
+
+    def emit_resource(r):
+        config = []
+        config.extend(attrs_per_resource[r.name])
+        if is_machine(r):
+            # Sort the hosts by its canonical host names.
+            sorted_hosts = sorted(hosts[r.name].iteritems(),
+                                  key=lambda item: item[1][0])
+            # Just to remember the format:
+            #   ip_address canonical_hostname [aliases...]
+            extra_hosts = ["{0} {1}".format(ip, ' '.join(names))
+                           for ip, names in sorted_hosts]
+
+            if authorized_keys[r.name]:
+                config.append({
+                    ('users', 'extraUsers', 'root'): {
+                        ('openssh', 'authorizedKeys', 'keys'): authorized_keys[r.name]
+                    },
+                    ('services', 'openssh'): {
+                        'extraConfig': "PermitTunnel yes\n"
+                    },
+                })
+
+            config.append({
+                ('boot', 'kernelModules'): list(kernel_modules[r.name]),
+                ('networking', 'firewall'): {
+                    'trustedInterfaces': list(trusted_interfaces[r.name])
+                },
+                ('networking', 'extraHosts'): '\n'.join(extra_hosts) + "\n"
+            })
+
+
+            # Add SSH public host keys for all machines in network.
+            for m2 in active_machines.itervalues():
+                if hasattr(m2, 'public_host_key') and m2.public_host_key:
+                    # Using references to files in same tempdir for now, until NixOS has support
+                    # for adding the keys directly as string. This way at least it is compatible
+                    # with older versions of NixOS as well.
+                    # TODO: after reasonable amount of time replace with string option
+                    config.append({
+                        ('services', 'openssh', 'knownHosts', m2.name): {
+                             'hostNames': [m2.name + "-unencrypted",
+                                           m2.name + "-encrypted",
+                                           m2.name],
+                             'publicKey': m2.public_host_key,
+                        }
+                    })
+
+        merged = reduce(nixmerge, config) if len(config) > 0 else {}
+        physical = r.get_physical_spec()
+
+        if len(merged) == 0 and len(physical) == 0:
+            return {}
+        else:
+            return r.prefix_definition({
+                r.name: Function("{ config, lib, pkgs, ... }", {
+                    'config': merged,
+                    'imports': [physical],
+                })
+            })
+
+    return py2nix(reduce(nixmerge, [
+        emit_resource(r) for r in active_resources.itervalues()
+    ], {})) + "\n"
+
+
+def timed(f, repeat=3):
+    start = time.time()
+    for n in range(repeat): out = f()
+    return ((time.time() - start) / repeat * 1000, out)
+
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or [10, 100, 250]
+    print "{0:>10} {1:>10} {2:>10} {3:>10} {4:>10}".format("machines", "old (MB)", "old (ms)", "new (MB)", "new (ms)")
+    for n in sizes:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            sf = nixops.statefile.StateFile(tmpdir + "/state.nixops")
+            depl = sf.create_deployment()
+            depl.definitions = {}
+            populate(depl, n)
+            (old_time, old) = timed(lambda: old_physical_spec(depl))
+            (new_time, new) = timed(lambda: depl.get_physical_spec())
+            print "{0:>10} {1:>10.2f} {2:>10.1f} {3:>10.2f} {4:>10.1f}".format(
+                n, len(old) / 1e6, old_time, len(new) / 1e6, new_time)
+            sf.close()
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Compare the wall time of copying closures to and activating a
+simulated fleet in barrier mode (copy to all machines, then activate
+all) and in pipelined mode (activate each machine as soon as its copy
+is done), reporting the total time and the mean time until a machine
+runs its new configuration.  Copying and activation are simulated
+with sleeps: most machines take 1 time unit to copy and 2 to activate,
+every tenth machine has a closure that takes 10 units to copy, and
+every seventh machine needs a reboot that takes 20 units.
+
+Usage: python -m tests.bench.pipeline [NR-MACHINES...]
+"""
+
+import sys
+import time
+import threading
+from nixops.parallel import run_tasks, run_pipeline
+
+# Length of a time unit in seconds.
+unit = 0.01
+
+max_concurrent_copy = 5
+
+
+def copy(n):
+    time.sleep(unit * (10 if n % 10 == 0 else 1))
+    return n
+
+
+finished = {}
+lock = threading.Lock()
+
+
+def activate(n):
+    time.sleep(unit * (20 if n % 7 == 0 else 2))
+    with lock: finished[n] = time.time()
+    return n
+
+
+def barrier(machines):
+    run_tasks(nr_workers=max_concurrent_copy, tasks=machines, worker_fun=copy)
+    run_tasks(nr_workers=-1, tasks=machines, worker_fun=activate)
+
+
+def pipelined(machines):
+    run_pipeline(machines, [(max_concurrent_copy, copy), (-1, activate)])
+
+
+def timed(f):
+    finished.clear()
+    start = time.time()
+    f()
+    return (time.time() - start, sum(t - start for t in finished.itervalues()) / len(finished))
+
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or [10, 50, 200]
+    print "{0:>10} {1:>12} {2:>12} {3:>14} {4:>14}".format(
+        "machines", "barrier (s)", "mean (s)", "pipelined (s)", "mean (s)")
+    for n in sizes:
+        machines = range(n)
+        (barrier_time, barrier_mean) = timed(lambda: barrier(machines))
+        (pipelined_time, pipelined_mean) = timed(lambda: pipelined(machines))
+        print "{0:>10} {1:>12.2f} {2:>12.2f} {3:>14.2f} {4:>14.2f}".format(
+            n, barrier_time, barrier_mean, pipelined_time, pipelined_mean)
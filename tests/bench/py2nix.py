@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Compare the time py2nix takes to format the physical specification
+of a synthetic network of the given sizes, and a deeply nested value,
+with that of the former layout code, which recomputed the length and
+inlineability of each subtree at every level.  Both must produce the
+same output.
+
+Usage: python -m tests.bench.py2nix [NR-MACHINES...]
+"""
+
+import sys
+import time
+import tempfile
+import nixops.nix_expr
+from nixops.nix_expr import RawValue, Function, Call, py2nix, py2nix_to_file
+
+
+class OldContainer(object):
+    """The former nixops.nix_expr.Container."""
+
+    def __init__(self, prefix, children, suffix, inline_variant=None):
+        self.prefix = prefix
+        self.children = children
+        self.suffix = suffix
+        self.inline_variant = inline_variant
+
+    def get_min_length(self):
+        return (len(self.prefix) + len(self.suffix) + 1 + len(self.children) +
+                sum([child.get_min_length() for child in self.children]))
+
+    def is_inlineable(self):
+        return all([child.is_inlineable() for child in self.children])
+
+    def indent(self, level=0, inline=False, maxwidth=80):
+        if not self.is_inlineable():
+            inline = False
+        elif level * 2 + self.get_min_length() < maxwidth:
+            inline = True
+        ind = "  " * level
+        if inline and self.inline_variant is not None:
+            return self.inline_variant.indent(level=level, inline=True,
+                                              maxwidth=maxwidth)
+        elif inline:
+            sep = ' '
+            lines = ' '.join([child.indent(level=0, inline=True)
+                              for child in self.children])
+            suffix_ind = ""
+        else:
+            sep = '\n'
+            lines = '\n'.join([child.indent(level + 1, inline=inline,
+                                            maxwidth=maxwidth)
+                               for child in self.children])
+            suffix_ind = ind
+        return ind + self.prefix + sep + lines + sep + suffix_ind + self.suffix
+
+
+def old_py2nix(value):
+    container = nixops.nix_expr.Container
+    nixops.nix_expr.Container = OldContainer
+    try:
+        return nixops.nix_expr._layout(value).indent()
+    finally:
+        nixops.nix_expr.Container = container
+
+
+def machine_spec(n, nr_machines):
+    """Return the physical specification of the n'th machine, as
+    generated by Deployment.get_physical_spec()."""
+    peer = (n + 1) % nr_machines
+    return Function("{ config, lib, pkgs, ... }", {
+        'config': {
+            ('boot', 'kernelModules'): ["tun"],
+            ('networking', 'extraHosts'):
+                "127.0.0.1 machine-{0}-encrypted\n192.168.105.{1} machine-{1} machine-{1}-encrypted\n".format(n, peer),
+            ('networking', 'firewall', 'trustedInterfaces'): ["tun{0}".format(10000 + peer)],
+            ('networking', 'p2pTunnels', 'ssh', "machine-{0}".format(peer)): {
+                'target': "machine-{0}-unencrypted".format(peer), 'targetPort': 22,
+                'localTunnel': 10000 + peer, 'remoteTunnel': 10000 + n,
+                'localIPv4': "192.168.105.{0}".format(n % 256), 'remoteIPv4': "192.168.105.{0}".format(peer % 256),
+                'privateKey': "/root/.ssh/id_charon_vpn",
+            },
+            ('networking', 'privateIPv4'): "10.0.{0}.{1}".format(n / 256, n % 256),
+            ('networking', 'publicIPv4'): "198.51.{0}.{1}".format(n / 256, n % 256),
+            ('networking', 'vpnPublicKey'): "ssh-rsa " + "B" * 372,
+            ('system', 'stateVersion'): Call(RawValue("lib.mkDefault"), "17.03"),
+            ('users', 'extraUsers', 'root', 'openssh', 'authorizedKeys', 'keys'): ["ssh-rsa " + "B" * 372],
+        },
+        'imports': [RawValue("knownHosts"), RawValue("hosts0"), {
+            ('deployment', 'ec2', 'blockDeviceMapping', "/dev/xvd{0}".format(c)): {
+                'disk': "vol-{0:08x}".format(n), 'fsType': "ext4", 'size': 100,
+            } for c in "fghij"
+        }],
+    })
+
+
+def nested_spec(depth):
+    """Return a value nested ‘depth’ levels deep."""
+    spec = {"leaf": "x", "list": [1, 2, 3]}
+    for n in range(depth):
+        spec = {"a{0}".format(n): spec, "b{0}".format(n): RawValue("pkgs.hello")}
+    return spec
+
+
+def timed(f, repeat=3):
+    start = time.time()
+    for n in range(repeat): out = f()
+    return ((time.time() - start) / repeat * 1000, out)
+
+
+if __name__ == "__main__":
+    sizes = [int(x) for x in sys.argv[1:]] or [100, 1000]
+    print "{0:>14} {1:>10} {2:>10} {3:>10} {4:>10}".format("input", "size (MB)", "old (ms)", "new (ms)", "file (ms)")
+    for (name, spec) in [("{0} machines".format(n), {"machine-{0}".format(m): machine_spec(m, n) for m in range(n)})
+                         for n in sizes] + [("depth 200", nested_spec(200))]:
+        (old_time, old) = timed(lambda: old_py2nix(spec))
+        (new_time, new) = timed(lambda: py2nix(spec))
+        assert old == new
+        with tempfile.TemporaryFile() as f:
+            (file_time, _) = timed(lambda: py2nix_to_file(spec, f))
+        print "{0:>14} {1:>10.2f} {2:>10.1f} {3:>10.1f} {4:>10.1f}".format(
+            name, len(new) / 1e6, old_time, new_time, file_time)
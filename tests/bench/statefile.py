@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmarks for the state file layer.  Each run generates a
+synthetic state file holding one "target" deployment with the given
+number of resources, plus filler deployments with 10 resources each,
+and times the common state file operations on it.  Resources are of a
+fake type, so no backend code is involved.
+
+Usage: python -m tests.bench.statefile [--deployments N...] [--resources N...]
+           [--attrs N] [--threads N] [--output FILE]
+
+The results are printed as a table and, with --output, written as JSON
+so that runs of different releases can be compared.
+"""
+
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import nixops.resources
+import nixops.statefile
+import nixops.util
+from pysqlite2 import dbapi2 as sqlite3
+
+
+class FakeResourceState(nixops.resources.ResourceState):
+    """A resource with attributes resembling those of a cloud machine."""
+
+    @classmethod
+    def get_type(cls):
+        return "bench-fake"
+
+    vm_id = nixops.util.attr_property("vmId", None)
+    public_ipv4 = nixops.util.attr_property("publicIpv4", None)
+    private_ipv4 = nixops.util.attr_property("privateIpv4", None)
+    ssh_pinged = nixops.util.attr_property("sshPinged", False, bool)
+    block_device_mapping = nixops.util.attr_property("blockDeviceMapping", {}, 'json')
+
+
+def resource_attrs(n, nr_attrs):
+    """Return the attributes of the n'th synthetic resource."""
+    attrs = {
+        "state": nixops.resources.ResourceState.UP,
+        "index": n,
+        "creationTime": 1400000000 + n,
+        "vmId": "i-{0:08x}".format(n),
+        "publicIpv4": "198.51.{0}.{1}".format(n / 256 % 256, n % 256),
+        "privateIpv4": "10.0.{0}.{1}".format(n / 256 % 256, n % 256),
+        "sshPinged": 1,
+        "blockDeviceMapping": json.dumps(
+            {"/dev/xvd{0}".format(c): {"volumeId": "vol-{0:08x}".format(n), "size": 10, "deleteOnTermination": True}
+             for c in "fg"}),
+        "publicHostKey": "ssh-ed25519 " + "A" * 68,
+    }
+    for a in range(len(attrs), nr_attrs):
+        attrs["extra{0}".format(a)] = "value-{0}-{1}".format(n, a)
+    return attrs
+
+
+def populate(sf, nr_deployments, nr_resources, nr_attrs):
+    """Fill the state file; return the UUID of the target deployment."""
+    db = sf._db
+    target = None
+    with db.transaction():
+        for d in range(nr_deployments):
+            u = str(uuid.uuid4())
+            if target is None: target = u
+            db.execute("insert into Deployments(uuid) values (?)", (u,))
+            db.executemany("insert into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
+                           [(u, "name", "depl-{0}".format(d)),
+                            (u, "description", "synthetic deployment {0}".format(d)),
+                            (u, "nixExprs", json.dumps(["/etc/nixops/network.nix"])),
+                            (u, "configsPath", "/nix/store/" + "0" * 32 + "-nixops-machines")])
+            for n in range(nr_resources if u == target else 10):
+                c = db.cursor()
+                c.execute("insert into Resources(deployment, name, type) values (?, ?, ?)",
+                          (u, "machine-{0}".format(n), FakeResourceState.get_type()))
+                db.executemany("insert into ResourceAttrs(machine, name, value) values (?, ?, ?)",
+                               [(c.lastrowid, k, v) for k, v in resource_attrs(n, nr_attrs).iteritems()])
+    return target
+
+
+def timed(f, repeat=1):
+    """Return the mean wall-clock time of f() in milliseconds."""
+    start = time.time()
+    for n in range(repeat): f()
+    return (time.time() - start) / repeat * 1000
+
+
+def attr_storm(depl, nr_threads, nr_ops):
+    """Have nr_threads threads read and write attributes of random
+    resources; return the number of operations per second."""
+    resources = depl.resources.values()
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        for n in range(nr_ops):
+            r = rnd.choice(resources)
+            if n % 4 == 0:
+                r.public_ipv4 = "203.0.113.{0}".format(n % 256)
+            else:
+                r.vm_id, r.ssh_pinged, r.block_device_mapping
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(nr_threads)]
+    start = time.time()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return nr_threads * nr_ops / (time.time() - start)
+
+
+def run(nr_deployments, nr_resources, nr_attrs, nr_threads):
+    tmpdir = tempfile.mkdtemp(prefix="nixops-bench")
+    try:
+        sf = nixops.statefile.StateFile(tmpdir + "/bench.nixops")
+        target = populate(sf, nr_deployments, nr_resources, nr_attrs)
+        res = {"deployments": nr_deployments, "resources": nr_resources,
+               "attrs": nr_attrs, "threads": nr_threads}
+
+        res["open_deployment_ms"] = timed(lambda: sf.open_deployment(target), repeat=5)
+        res["get_all_deployments_ms"] = timed(sf.get_all_deployments)
+
+        depl = sf.open_deployment(target)
+        exported = [None]
+        def export(): exported[0] = depl.export()
+        res["export_ms"] = timed(export)
+
+        new = sf.create_deployment()
+        res["import_ms"] = timed(lambda: new.import_(exported[0]))
+        for r in new.resources.values(): new.delete_resource(r)
+        new.delete()
+
+        clones = []
+        res["clone_ms"] = timed(lambda: clones.append(depl.clone()))
+        for c in clones: c.delete()
+
+        victims = depl.resources.values()[:min(100, nr_resources / 2)]
+        res["delete_resource_ms"] = timed(lambda: depl.delete_resource(victims.pop()), repeat=len(victims))
+
+        res["attr_storm_ops_per_s"] = attr_storm(sf.open_deployment(target), nr_threads, 1000)
+
+        sf.close()
+        return res
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+columns = ["deployments", "resources", "open_deployment_ms", "get_all_deployments_ms", "export_ms",
+           "import_ms", "clone_ms", "delete_resource_ms", "attr_storm_ops_per_s"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the NixOps state file layer.")
+    parser.add_argument("--deployments", type=int, nargs="+", default=[1, 100, 1000],
+                        help="numbers of deployments in the state file")
+    parser.add_argument("--resources", type=int, nargs="+", default=[10, 1000],
+                        help="numbers of resources in the target deployment")
+    parser.add_argument("--attrs", type=int, default=20, help="attributes per resource")
+    parser.add_argument("--threads", type=int, default=16, help="threads in the attribute storm")
+    parser.add_argument("--output", metavar="FILE", help="write the results as JSON to FILE")
+    args = parser.parse_args()
+
+    results = []
+    print " ".join("{0:>14}".format(c[:14]) for c in columns)
+    for d in args.deployments:
+        for r in args.resources:
+            res = run(d, r, args.attrs, args.threads)
+            results.append(res)
+            print " ".join("{0:>14.2f}".format(res[c]) if isinstance(res[c], float) else "{0:>14}".format(res[c])
+                           for c in columns)
+            sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "sqlite": sqlite3.sqlite_version,
+                       "time": int(time.time()),
+                       "results": results}, f, indent=2, sort_keys=True)
+            f.write("\n")
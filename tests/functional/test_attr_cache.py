@@ -0,0 +1,84 @@
+from nose import tools
+import nixops.util
+
+from tests.functional import DatabaseUsingTest
+
+class TestAttrCache(DatabaseUsingTest):
+    def setup(self):
+        super(TestAttrCache, self).setup()
+        self.depl = self.sf.create_deployment()
+        with self.depl._db:
+            self.m = self.depl._create_resource("machine", "none")
+
+    def teardown(self):
+        self.depl.delete_resource(self.m)
+        self.depl.delete()
+        super(TestAttrCache, self).teardown()
+
+    def test_reads_are_cached(self):
+        self.depl.name = "cached"
+        self.m.index = 3
+        self.m.obsolete = True
+        self.m.keys = {"foo": {"text": "bar"}}
+
+        depl = self.sf.open_deployment(self.depl.uuid)
+        m = depl.resources["machine"]
+        hits = depl.attr_cache_hits
+        tools.assert_equal(depl.name, "cached")
+        tools.assert_equal(m.index, 3)
+        tools.assert_true(m.obsolete)
+        tools.assert_equal(m.keys, {"foo": {"text": "bar"}})
+        tools.assert_equal(depl.attr_cache_hits, hits + 4)
+
+    def test_writes_go_through(self):
+        self.m.obsolete = True
+        tools.assert_true(self.m.obsolete)
+        self.m.obsolete = False
+        tools.assert_false(self.m.obsolete)
+        self.m.index = 7
+        tools.assert_equal(self.sf.open_deployment(self.depl.uuid).resources["machine"].index, 7)
+
+    def test_clone_sees_copied_attrs(self):
+        self.depl.nix_exprs = ["/foo.nix"]
+        clone = self.depl.clone()
+        tools.assert_equal(clone.nix_exprs, ["/foo.nix"])
+        clone.delete()
+
+    def test_json_values_are_copies(self):
+        self.m.keys = {"foo": {"text": "bar"}}
+        keys = self.m.keys
+        keys["foo"]["text"] = "changed"
+        tools.assert_equal(self.m.keys, {"foo": {"text": "bar"}})
+
+    def test_json_values_as_stored(self):
+        self.m.keys = {1: ("a", 2)}
+        tools.assert_equal(self.m.keys, {u"1": [u"a", 2]})
+        depl = self.sf.open_deployment(self.depl.uuid)
+        tools.assert_equal(depl.resources["machine"].keys, self.m.keys)
+
+    def test_update_json_attr(self):
+        nixops.util.update_json_attr(self.m, "keys", "foo", {"text": "bar"})
+        nixops.util.update_json_attr(self.m, "keys", "baz", {"text": "qux"})
+        tools.assert_equal(self.m.keys, {"foo": {"text": "bar"}, "baz": {"text": "qux"}})
+        nixops.util.update_json_attr(self.m, "keys", "foo", None)
+        nixops.util.update_json_attr(self.m, "keys", "baz", None)
+        tools.assert_equal(self.m._get_attr("keys"), nixops.util.undefined)
+        depl = self.sf.open_deployment(self.depl.uuid)
+        tools.assert_equal(depl.resources["machine"].keys, {})
+
+    def test_reloaded_when_locking(self):
+        depl = self.sf.open_deployment(self.depl.uuid)
+        m = depl.resources["machine"]
+        self.depl.name = "changed"
+        self.m.index = 5
+        with self.depl._db:
+            other = self.depl._create_resource("other", "none")
+        try:
+            tools.assert_equal(depl.name, None)
+            with depl._get_deployment_lock():
+                tools.assert_equal(depl.name, "changed")
+                tools.assert_equal(m.index, 5)
+                tools.assert_true(depl.resources["machine"] is m)
+                tools.assert_equal(sorted(depl.resources), ["machine", "other"])
+        finally:
+            self.depl.delete_resource(other)
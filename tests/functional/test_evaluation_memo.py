@@ -0,0 +1,169 @@
+import json
+import os
+import shutil
+import tempfile
+
+from nose import tools
+
+import nixops.deployment
+import nixops.eval_cache
+from tests.functional import DatabaseUsingTest
+
+class TestEvaluationMemo(DatabaseUsingTest):
+    def setup(self):
+        super(TestEvaluationMemo, self).setup()
+        self.depl = self.sf.create_deployment()
+        self.depl.nix_exprs = ["/etc/nixops/network.nix"]
+        self.evaluation = {
+            "info": {"network": {"description": "memoized"}, "machines": {}, "resources": {}},
+            "arguments": {"foo": ["/etc/nixops/network.nix"]},
+            "nixpkgs": {"path": "/nix/store/nixpkgs"},
+        }
+        self.depl._evaluation = (self.depl._evaluation_flags(), self.evaluation)
+
+    def teardown(self):
+        self.depl.delete()
+        super(TestEvaluationMemo, self).teardown()
+
+    def test_evaluate_uses_memo(self):
+        self.depl.evaluate()
+        tools.assert_equal(self.depl.description, "memoized")
+        tools.assert_equal(self.depl.definitions, {})
+
+    def test_arguments_use_memo(self):
+        tools.assert_equal(self.depl.evaluate_args(), self.evaluation["arguments"])
+
+    def test_memo_depends_on_arguments(self):
+        self.depl.set_argstr("foo", "bar")
+        tools.assert_equal(self.depl._memoized_evaluation(), None)
+
+def machine_info(host):
+    return {"targetEnv": "none", "targetHost": host, "targetPort": 22, "publicIPv4": None,
+            "encryptedLinksTo": [], "storeKeysOnMachine": False, "alwaysActivate": True,
+            "owners": [], "hasFastConnection": False, "keys": {}}
+
+class TestPartialEvaluation(DatabaseUsingTest):
+    def setup(self):
+        super(TestPartialEvaluation, self).setup()
+        self.depl = self.sf.create_deployment()
+        self.depl.nix_exprs = ["/etc/nixops/network.nix"]
+        full = {"network": {}, "machines": {"a": machine_info("a1"), "b": machine_info("b1"), "c": machine_info("c1")},
+                "resources": {"sshKeyPairs": {"k": {}}}}
+        self.depl._evaluation = (self.depl._evaluation_flags(), {"info": full})
+        self.depl.evaluate()
+
+    def teardown(self):
+        self.depl.delete()
+        super(TestPartialEvaluation, self).teardown()
+
+    def test_merges_previous_definitions(self):
+        partial = {"network": {}, "machines": {"a": machine_info("a2")}, "resources": {"sshKeyPairs": {}}}
+        self.depl._evaluation = (self.depl._evaluation_flags(["a", "c"]), {"info": partial})
+        self.depl.evaluate(names=["a", "c"])
+        tools.assert_equal(sorted(self.depl.definitions), ["a", "b", "k"])
+        tools.assert_equal(self.depl.definitions["a"]._target_host, "a2")
+        tools.assert_equal(self.depl.definitions["b"]._target_host, "b1")
+
+    def test_stale_after_modify(self):
+        self.depl.nix_exprs = ["/etc/nixops/other.nix"]
+        full = {"network": {}, "machines": {"a": machine_info("a3")}, "resources": {"sshKeyPairs": {}}}
+        self.depl._evaluation = (self.depl._evaluation_flags(), {"info": full})
+        self.depl.evaluate(names=["a"])
+        tools.assert_equal(sorted(self.depl.definitions), ["a"])
+
+    def test_partial_keeps_others_active(self):
+        self.depl.evaluate_active()
+        self.depl.nix_exprs = ["/etc/nixops/other.nix"]
+        full = {"network": {}, "machines": {"a": machine_info("a3")}, "resources": {"sshKeyPairs": {}}}
+        self.depl._evaluation = (self.depl._evaluation_flags(), {"info": full})
+        try:
+            self.depl.evaluate_active(include=["a"])
+            tools.assert_equal(sorted(self.depl.active), ["a", "b", "c"])
+        finally:
+            for m in self.depl.resources.values(): self.depl.delete_resource(m)
+
+    def test_not_in_state_file(self):
+        tools.assert_true(os.path.exists(self.depl._evaluated_info_path()))
+        tools.assert_false("evaluatedInfo" in self.depl._attrs)
+        tools.assert_false("evaluatedInfo" in self.depl.export())
+
+class TestShards(DatabaseUsingTest):
+    def setup(self):
+        super(TestShards, self).setup()
+        self.depl = self.sf.create_deployment()
+
+    def teardown(self):
+        self.depl.delete()
+        super(TestShards, self).teardown()
+
+    def test_shards(self):
+        self.depl.eval_shards = 2
+        tools.assert_equal(self.depl._shards(["c", "a", "b"]), [["a", "c"], ["b"]])
+        tools.assert_equal(self.depl._shards(["a"]), [["a"]])
+
+    def test_machine_names_use_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        compute_key = nixops.eval_cache.compute_key
+        try:
+            nixops.eval_cache.compute_key = lambda *args: "key"
+            self.depl.eval_cache = nixops.eval_cache.EvalCache(tmpdir, 1024)
+            self.depl.eval_cache.put("key", '["a", "b"]')
+            tools.assert_equal(self.depl._machine_names(), ["a", "b"])
+        finally:
+            nixops.eval_cache.compute_key = compute_key
+            shutil.rmtree(tmpdir)
+
+    def test_version_suffix_is_cached(self):
+        tmpdir = tempfile.mkdtemp()
+        compute_key = nixops.eval_cache.compute_key
+        check_output = nixops.deployment.subprocess.check_output
+        script = tmpdir + "/nixpkgs/nixos/modules/installer/tools/get-version-suffix"
+        os.makedirs(os.path.dirname(script))
+        os.mkdir(tmpdir + "/nixpkgs/nixos/.git")
+        with open(script, "w") as f: f.write("echo run >> {0}/runs; echo .git.abc\n".format(tmpdir))
+        evaluation = {"nixpkgs": {"path": tmpdir + "/nixpkgs"}}
+
+        def fake_check_output(args, **kwargs):
+            if args[0] == "nix-instantiate": return json.dumps(evaluation)
+            return check_output(args, **kwargs)
+
+        try:
+            nixops.eval_cache.compute_key = lambda *args: "key"
+            nixops.deployment.subprocess.check_output = fake_check_output
+            self.depl.eval_cache = nixops.eval_cache.EvalCache(tmpdir + "/cache", 1024 * 1024)
+            for i in range(2):
+                depl = self.sf.open_deployment(self.depl.uuid)
+                depl.eval_cache = self.depl.eval_cache
+                tools.assert_equal(depl._run_evaluation([])["nixpkgs"]["versionSuffix"], ".git.abc")
+            with open(tmpdir + "/runs") as f: tools.assert_equal(f.read(), "run\n")
+        finally:
+            nixops.eval_cache.compute_key = compute_key
+            nixops.deployment.subprocess.check_output = check_output
+            shutil.rmtree(tmpdir)
+
+class TestConfigsDigest(DatabaseUsingTest):
+    def setup(self):
+        super(TestConfigsDigest, self).setup()
+        self.depl = self.sf.create_deployment()
+        self.phys_expr = self.depl.tempdir + "/physical.nix"
+        with open(self.phys_expr, "w") as f: f.write("{}")
+        self.compute_key = nixops.eval_cache.compute_key
+
+    def teardown(self):
+        nixops.eval_cache.compute_key = self.compute_key
+        self.depl.delete()
+        super(TestConfigsDigest, self).teardown()
+
+    def test_incomplete_key(self):
+        nixops.eval_cache.compute_key = lambda *args: None
+        digest = self.depl._configs_digest(self.phys_expr, ["a"])
+        tools.assert_equal(digest, None)
+        self.depl.configs_digest = None
+        self.depl.configs_path = "/nix/store/configs"
+        tools.assert_false(self.depl._configs_up_to_date(digest))
+
+    def test_complete_key(self):
+        nixops.eval_cache.compute_key = lambda *args: "key"
+        digest = self.depl._configs_digest(self.phys_expr, ["a"])
+        tools.assert_not_equal(digest, None)
+        tools.assert_not_equal(digest, self.depl._configs_digest(self.phys_expr, ["a", "b"]))
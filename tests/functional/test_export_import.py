@@ -0,0 +1,38 @@
+from nose import tools
+
+import nixops.deployment
+
+from tests.functional import DatabaseUsingTest
+
+class TestExportImport(DatabaseUsingTest):
+    def test_records_round_trip(self):
+        depl = self.sf.create_deployment()
+        depl.name = "exported"
+        with depl._db:
+            m = depl._create_resource("machine", "none")
+        m.state = m.UP
+        m.keys = {"foo": {"text": "bar"}}
+
+        records = list(self.sf.export_records([depl.uuid]))
+        tools.assert_equal(len(records), 2)
+        tools.assert_equal(records[0]['attrs'], {'name': 'exported'})
+        tools.assert_equal(records[1]['resource'], 'machine')
+
+        depl.delete_resource(m)
+        depl.delete()
+
+        tools.assert_equal(self.sf.import_records(iter(records)), [depl.uuid])
+        depl2 = self.sf.open_deployment(depl.uuid)
+        tools.assert_equal(depl2.name, "exported")
+        m2 = depl2.resources["machine"]
+        tools.assert_equal(m2.state, m2.UP)
+        tools.assert_equal(m2.keys, {"foo": {"text": "bar"}})
+        tools.assert_raises(Exception, self.sf.import_records, iter(records))
+        depl2.delete_resource(m2)
+        depl2.delete()
+
+    def test_unknown_type(self):
+        records = [{'deployment': 'unknown-type', 'attrs': {}},
+                   {'deployment': 'unknown-type', 'resource': 'x', 'attrs': {'type': 'no-such-type'}}]
+        tools.assert_raises(nixops.deployment.UnknownBackend, self.sf.import_records, iter(records))
+        tools.assert_equal(self.sf._find_deployment('unknown-type'), None)
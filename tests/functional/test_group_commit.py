@@ -0,0 +1,42 @@
+import threading
+from nose import tools
+
+import nixops.statefile
+from tests import db_file
+from tests.functional import DatabaseUsingTest
+
+class TestGroupCommit(DatabaseUsingTest):
+    def setup(self):
+        super(TestGroupCommit, self).setup()
+        self.depl = self.sf.create_deployment()
+
+    def teardown(self):
+        self.depl.delete()
+        super(TestGroupCommit, self).teardown()
+
+    def stored_name(self):
+        sf = nixops.statefile.StateFile(db_file)
+        try:
+            return sf.open_deployment(self.depl.uuid).name
+        finally:
+            sf.close()
+
+    def test_writes_are_batched(self):
+        commits = self.sf._db.commits
+        with self.sf._db.group_commit(interval=3600):
+            def set_name():
+                self.depl.name = "batched"
+            thr = threading.Thread(target=set_name)
+            thr.start()
+            thr.join()
+            tools.assert_equal(self.depl.name, "batched")
+            tools.assert_equal(self.stored_name(), None)
+            self.sf._db.flush()
+            tools.assert_equal(self.stored_name(), "batched")
+        tools.assert_equal(self.sf._db.commits, commits + 1)
+
+    def test_writes_inside_transaction_are_immediate(self):
+        with self.sf._db.group_commit(interval=3600):
+            with self.sf._db:
+                self.depl.name = "immediate"
+            tools.assert_equal(self.stored_name(), "immediate")
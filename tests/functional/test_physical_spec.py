@@ -0,0 +1,50 @@
+from nose import tools
+
+from tests.functional import DatabaseUsingTest
+
+class FakeDefinition(object):
+    encrypted_links_to = []
+    config = {"nixosRelease": "17.03"}
+
+class TestPhysicalSpec(DatabaseUsingTest):
+    def setup(self):
+        super(TestPhysicalSpec, self).setup()
+        self.depl = self.sf.create_deployment()
+        self.depl.definitions = {}
+        with self.depl._db:
+            for n in range(3):
+                m = self.depl._create_resource("machine{0}".format(n), "none")
+                m.index = n
+                m.public_ipv4 = "198.51.100.{0}".format(n)
+                self.depl.definitions[m.name] = FakeDefinition()
+
+    def teardown(self):
+        for m in self.depl.resources.values():
+            self.depl.delete_resource(m)
+        self.depl.delete()
+        super(TestPhysicalSpec, self).teardown()
+
+    def test_hosts_are_shared(self):
+        spec = self.depl.get_physical_spec()
+        tools.assert_true(spec.startswith("let\n  hosts0 = "))
+        tools.assert_false("hosts1" in spec)
+        for n in range(3):
+            tools.assert_equal(spec.count("198.51.100.{0} machine{0} machine{0}-unencrypted\n".format(n)), 1)
+            tools.assert_equal(spec.count("127.0.0.1 machine{0}-encrypted".format(n)), 1)
+        tools.assert_equal(spec.count("imports = [ hosts0 {} ];"), 3)
+
+    def test_deterministic(self):
+        other = self.sf.create_deployment()
+        other.definitions = {}
+        try:
+            with other._db:
+                for n in reversed(range(3)):
+                    m = other._create_resource("machine{0}".format(n), "none")
+                    m.index = n
+                    m.public_ipv4 = "198.51.100.{0}".format(n)
+                    other.definitions[m.name] = FakeDefinition()
+            tools.assert_equal(other.get_physical_spec(), self.depl.get_physical_spec())
+        finally:
+            for m in other.resources.values():
+                other.delete_resource(m)
+            other.delete()
@@ -1,3 +1,4 @@
+import threading
 from nose import tools
 
 from tests.functional import DatabaseUsingTest
@@ -10,3 +11,36 @@ class TestQueryDeployments(DatabaseUsingTest):
         uuids = self.sf.query_deployments()
         for depl in depls:
             tools.assert_true(any([ depl.uuid == uuid for uuid in uuids ]))
+
+    def test_summarizes_all_deployments(self):
+        depl = self.sf.create_deployment()
+        depl.name = "summarized"
+        with depl._db:
+            m = depl._create_resource("machine", "none")
+        m.state = m.UP
+        summaries = {s.uuid: s for s in self.sf.get_deployment_summaries()}
+        summary = summaries[depl.uuid]
+        tools.assert_equal(summary.name, "summarized")
+        tools.assert_equal(summary.description, depl.default_description)
+        tools.assert_equal(summary.resources, [("machine", "none", m.UP)])
+        depl.delete_resource(m)
+        depl.delete()
+
+    def test_reads_do_not_wait_for_writer(self):
+        depl = self.sf.create_deployment()
+        opened = []
+        with self.sf._db:
+            thr = threading.Thread(target=lambda: opened.append(self.sf.open_deployment(depl.uuid)))
+            thr.start()
+            thr.join(10)
+            tools.assert_false(thr.is_alive())
+        tools.assert_equal(opened[0].uuid, depl.uuid)
+        depl.delete()
+
+    def test_readers_of_finished_threads_are_closed(self):
+        before = len(self.sf._reader_dbs)
+        for i in range(20):
+            thr = threading.Thread(target=self.sf.query_deployments)
+            thr.start()
+            thr.join()
+        tools.assert_true(len(self.sf._reader_dbs) <= before + 1)
@@ -0,0 +1,47 @@
+import sys
+from StringIO import StringIO
+
+from nose import tools
+
+import nixops.statefile
+from tests import db_file
+from tests.functional import DatabaseUsingTest
+
+class TestReadOnly(DatabaseUsingTest):
+    def setup(self):
+        DatabaseUsingTest.setup(self)
+        self.depl = self.sf.create_deployment()
+        self.depl.name = "read-only"
+        self.ro = nixops.statefile.StateFile(db_file, read_only=True)
+
+    def teardown(self):
+        self.ro.close()
+        self.depl.delete()
+        DatabaseUsingTest.teardown(self)
+
+    def test_reads_state(self):
+        depl = self.ro.open_deployment(self.depl.uuid)
+        tools.assert_equal(depl.name, "read-only")
+        tools.assert_true(self.depl.uuid in self.ro.query_deployments())
+
+    def test_does_not_write_state(self):
+        depl = self.ro.open_deployment(self.depl.uuid)
+        depl.name = "changed"
+        tools.assert_equal(depl.name, "changed")
+        tools.assert_equal(self.sf.open_deployment(self.depl.uuid).name, "read-only")
+
+    def test_warns_once_about_discarded_writes(self):
+        depl = self.ro.open_deployment(self.depl.uuid)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            depl.name = "changed"
+            depl.description = "changed"
+            tools.assert_equal(sys.stderr.getvalue().count("not saving changes"), 1)
+        finally:
+            sys.stderr = stderr
+
+    @tools.raises(Exception)
+    def test_rejects_direct_writes(self):
+        with self.ro._db:
+            self.ro._db.execute("delete from Deployments")
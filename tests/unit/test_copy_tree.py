@@ -0,0 +1,36 @@
+import unittest
+
+from nixops.deployment import _copy_tree
+
+class FakeMachine(object):
+    def __init__(self, name, group, public_host_key="ssh-ed25519 AAAA"):
+        self.name = name
+        self.group = group
+        self.public_host_key = public_host_key
+
+    def copy_group(self):
+        return self.group
+
+    def address_to(self, m):
+        return "10.0.0.1" if m.group == self.group else None
+
+class CopyTreeTest(unittest.TestCase):
+    def test_fanout(self):
+        machines = [FakeMachine("m{0}".format(n), "net") for n in range(7)]
+        parent = _copy_tree(machines, 2)
+        self.assertEquals(parent["m0"], None)
+        self.assertEquals({n: p.name for n, p in parent.items() if p},
+                          {"m1": "m0", "m2": "m0", "m3": "m1", "m4": "m1", "m5": "m2", "m6": "m2"})
+
+    def test_groups(self):
+        machines = [FakeMachine("a", "x"), FakeMachine("b", "y"), FakeMachine("c", "x"),
+                    FakeMachine("d", None), FakeMachine("e", None)]
+        parent = _copy_tree(machines, 3)
+        self.assertEquals({n: p.name if p else None for n, p in parent.items()},
+                          {"a": None, "b": None, "c": "a", "d": None, "e": None})
+
+    def test_unknown_host_key(self):
+        machines = [FakeMachine("a", "x"), FakeMachine("b", "x", None), FakeMachine("c", "x")]
+        parent = _copy_tree(machines, 3)
+        self.assertEquals({n: p.name if p else None for n, p in parent.items()},
+                          {"a": None, "b": None, "c": "a"})
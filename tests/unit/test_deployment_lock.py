@@ -0,0 +1,69 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from StringIO import StringIO
+
+from nixops.deployment import DeploymentLock
+from nixops.logger import Logger
+
+class DeploymentLockTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "lock")
+        self.logfile = StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_lock(self):
+        return DeploymentLock(self.path, Logger(self.logfile))
+
+    def test_shared_locks_do_not_wait(self):
+        a = self.make_lock()
+        b = self.make_lock()
+        with a.hold(exclusive=False):
+            with b.hold(exclusive=False):
+                pass
+        self.assertEquals(b.wait_time, 0.0)
+        self.assertEquals(self.logfile.getvalue(), "")
+
+    def test_exclusive_lock_waits_for_shared(self):
+        a = self.make_lock()
+        b = self.make_lock()
+        held = threading.Event()
+
+        def reader():
+            with a.hold(exclusive=False):
+                held.set()
+                time.sleep(0.2)
+
+        thr = threading.Thread(target=reader)
+        thr.start()
+        held.wait()
+        with b.hold():
+            pass
+        thr.join()
+        self.assertTrue(b.wait_time > 0.1)
+        self.assertTrue("waiting for exclusive deployment lock" in self.logfile.getvalue())
+
+    def test_nested_exclusive_hold_upgrades(self):
+        a = self.make_lock()
+        with a.hold(exclusive=False):
+            with a.hold():
+                with open(self.path) as f:
+                    self.assertRaises(IOError, fcntl.flock, f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        with open(self.path) as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_downgrade_admits_readers(self):
+        a = self.make_lock()
+        with a.hold():
+            a.downgrade()
+            with open(self.path) as f:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                self.assertRaises(IOError, fcntl.flock, f, fcntl.LOCK_EX | fcntl.LOCK_NB)
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from nixops.eval_cache import EvalCache, compute_key, strip_strings_and_comments
+
+class StripStringsTest(unittest.TestCase):
+    def test_comments(self):
+        self.assertEquals(strip_strings_and_comments("a # ./x.nix\nb /* ./y.nix */ c").split(), ["a", "b", "c"])
+
+    def test_strings(self):
+        code = strip_strings_and_comments('{ a = "./x.nix ${./y.nix}"; b = \'\'./z.nix ${import ./w.nix}\'\'; }')
+        self.assertFalse("x.nix" in code)
+        self.assertFalse("z.nix" in code)
+        self.assertTrue("./y.nix" in code)
+        self.assertTrue("import ./w.nix" in code)
+
+class ComputeKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.write("network.nix", '{ machine = import ./machine.nix; }')
+        self.write("machine.nix", '{ deployment.targetEnv = "none"; }')
+        self.write("entry.nix", 'import ./network.nix')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, contents):
+        with open(os.path.join(self.tmpdir, name), "w") as f: f.write(contents)
+
+    def key(self, flags=[]):
+        return compute_key(flags, [os.path.join(self.tmpdir, "network.nix")],
+                           os.path.join(self.tmpdir, "entry.nix"), [])
+
+    def test_stable(self):
+        self.assertNotEquals(self.key(), None)
+        self.assertEquals(self.key(), self.key())
+
+    def test_flags(self):
+        self.assertNotEquals(self.key(), self.key(["--arg", "x", "1"]))
+
+    def test_imported_file_changes(self):
+        key = self.key()
+        self.write("machine.nix", '{ deployment.targetEnv = "ec2"; }')
+        self.assertNotEquals(self.key(), key)
+
+    def test_environment(self):
+        self.write("machine.nix", '{ deployment.targetHost = builtins.getEnv "NIXOPS_TEST_HOST"; }')
+        os.environ["NIXOPS_TEST_HOST"] = "a"
+        key = self.key()
+        os.environ["NIXOPS_TEST_HOST"] = "b"
+        self.assertNotEquals(self.key(), key)
+        del os.environ["NIXOPS_TEST_HOST"]
+
+    def test_impure(self):
+        self.write("machine.nix", 'import (builtins.fetchTarball "https://example.org/x.tar.gz")')
+        self.assertEquals(self.key(), None)
+
+    def test_file_access_through_strings(self):
+        for code in ['builtins.readFile "/etc/secret"', 'import "/etc/x.nix"',
+                     'builtins.pathExists (toString ./x)', 'builtins.path { path = "/etc"; }']:
+            self.write("machine.nix", code)
+            self.assertEquals(self.key(), None)
+        self.write("machine.nix", 'builtins.readFile ./secret + import ./other.nix')
+        self.assertNotEquals(self.key(), None)
+
+    def test_directory(self):
+        os.mkdir(os.path.join(self.tmpdir, "dir"))
+        self.write("dir/a", "1")
+        self.write("machine.nix", '{ src = ./dir; }')
+        key = self.key()
+        self.assertEquals(self.key(), key)
+        self.write("dir/a", "12")
+        self.assertNotEquals(self.key(), key)
+
+class EvalCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_put(self):
+        cache = EvalCache(self.tmpdir, 1024)
+        self.assertEquals(cache.get("a"), None)
+        cache.put("a", "{}")
+        self.assertEquals(cache.get("a"), "{}")
+
+    def test_evicts_least_recently_used(self):
+        cache = EvalCache(self.tmpdir, 250)
+        for key in ["a", "b"]:
+            cache.put(key, "x" * 100)
+            os.utime(cache._file(key), (time.time() - 100, time.time() - 100))
+        cache.get("a")
+        cache.put("c", "x" * 100)
+        self.assertEquals(cache.get("b"), None)
+        self.assertNotEquals(cache.get("a"), None)
+        self.assertNotEquals(cache.get("c"), None)
@@ -1,8 +1,10 @@
 import unittest
 
+from StringIO import StringIO
 from textwrap import dedent
 
-from nixops.nix_expr import py2nix, nix2py, nixmerge
+from nixops.nix_expr import py2nix, py2nix_to_file, nix2py, nixmerge
+from nixops.nix_expr import NixMergeBuilder
 from nixops.nix_expr import RawValue, Function, Call
 
 __all__ = ['Py2NixTest', 'Nix2PyTest', 'NixMergeTest']
@@ -15,6 +17,9 @@ class Py2NixTestBase(unittest.TestCase):
             result, expected,
             "Expected:\n{0}\nGot:\n{1}".format(expected, result)
         )
+        f = StringIO()
+        py2nix_to_file(nix_expr, f, maxwidth=maxwidth, inline=inline)
+        self.assertEqual(f.getvalue(), expected)
 
     def test_numeric(self):
         self.assert_nix(123, "123")
@@ -295,7 +300,7 @@ class NixMergeTest(unittest.TestCase):
             [7, 6, 5],
             ["abc", "def"],
             ["ghi", "abc"],
-        ], [1, 2, 3, 4, 5, 6, 7, "abc", "ghi", "def"])
+        ], [1, 2, 3, 4, 5, 6, 7, "abc", "def", "ghi"])
 
     def test_merge_dict(self):
         self.assert_merge([
@@ -317,6 +322,16 @@ class NixMergeTest(unittest.TestCase):
             'e': 'f',
         })
 
+    def test_builder(self):
+        sources = [{'a': {'b': [3, 1]}}, {'a': {'b': [2, 1], 'c': 'd'}}, {'e': 'f'}]
+        builder = NixMergeBuilder()
+        for source in sources:
+            builder.add(source)
+        self.assertEqual(builder.value, {'a': {'b': [3, 1, 2], 'c': 'd'}, 'e': 'f'})
+        self.assertEqual(builder.value, reduce(nixmerge, sources))
+        self.assertEqual(sources[0], {'a': {'b': [3, 1]}})
+        self.assertEqual(sources[1], {'a': {'b': [2, 1], 'c': 'd'}})
+
     def test_unhashable(self):
         self.assertRaises(TypeError, nixmerge, [[1]], [[2]])
         self.assertRaises(TypeError, nixmerge, [{'x': 1}], [{'y': 2}])
@@ -0,0 +1,14 @@
+import unittest
+
+from nixops.deployment import _option_path
+
+class OptionPathTest(unittest.TestCase):
+    def test_plain(self):
+        self.assertEquals(_option_path("services.openssh.enable"), ["services", "openssh", "enable"])
+
+    def test_quoted(self):
+        self.assertEquals(_option_path('fileSystems."/boot".device'), ["fileSystems", "/boot", "device"])
+
+    def test_invalid(self):
+        self.assertRaises(Exception, _option_path, "services..enable")
+        self.assertRaises(Exception, _option_path, 'fileSystems."/')
@@ -0,0 +1,97 @@
+import time
+import threading
+import unittest
+
+from nixops.parallel import CycleError, MultipleExceptions, TaskGraph, run_pipeline
+
+class RunPipelineTest(unittest.TestCase):
+    def test_results(self):
+        res = run_pipeline(range(10), [(2, lambda x: x + 1), (3, lambda x: x * 2)])
+        self.assertEquals(sorted(res), [2 * (x + 1) for x in range(10)])
+
+    def test_no_barrier(self):
+        # Task 0 must finish the second stage while task 1 is still
+        # in the first.
+        done = threading.Event()
+
+        def first(x):
+            if x == 1: self.assertTrue(done.wait(10))
+            return x
+
+        def second(x):
+            if x == 0: done.set()
+            return x
+
+        self.assertEquals(sorted(run_pipeline([0, 1], [(2, first), (1, second)])), [0, 1])
+
+    def test_failures(self):
+        def first(x):
+            if x % 2: raise Exception("odd")
+            return x
+        seen = []
+        self.assertRaises(MultipleExceptions, run_pipeline, range(4), [(1, first), (1, seen.append)])
+        self.assertEquals(sorted(seen), [0, 2])
+
+
+class TaskGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.deps = {"a": [], "b": ["a"], "c": ["a"], "d": ["b", "c"], "e": []}
+        self.graph = TaskGraph(sorted(self.deps), lambda t: self.deps[t])
+
+    def test_order(self):
+        order = self.graph.order()
+        for t in order:
+            for d in self.deps[t]: self.assertTrue(order.index(d) < order.index(t))
+
+    def test_cycle(self):
+        self.deps["a"] = ["d"]
+        graph = TaskGraph(sorted(self.deps), lambda t: self.deps[t])
+        started = []
+        self.assertRaises(CycleError, graph.run, 2, started.append)
+        self.assertEquals(started, [])
+
+    def test_run(self):
+        lock = threading.Lock()
+        done = set()
+        running = [0, 0]
+
+        def worker(t):
+            with lock:
+                for d in self.deps[t]: self.assertTrue(d in done)
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+                done.add(t)
+            return t
+
+        self.assertEquals(sorted(self.graph.run(2, worker)), sorted(self.deps))
+        self.assertTrue(running[1] <= 2)
+
+    def test_failures(self):
+        ran = []
+
+        def worker(t):
+            ran.append(t)
+            if t in ("b", "e"): raise Exception(t)
+
+        self.assertRaises(MultipleExceptions, self.graph.run, -1, worker)
+        # d depends on the failed b, so it is skipped.
+        self.assertEquals(sorted(ran), ["a", "b", "c", "e"])
+
+    def test_critical_path(self):
+        self.graph.run(-1, lambda t: time.sleep(0.05 if t == "c" else 0))
+        self.assertEquals([t for (t, d) in self.graph.critical_path()], ["a", "c", "d"])
+
+    def test_long_failed_chain(self):
+        tasks = range(5000)
+        graph = TaskGraph(tasks, lambda t: [t - 1] if t > 0 else [])
+        ran = []
+
+        def worker(t):
+            ran.append(t)
+            raise Exception("fail")
+
+        self.assertRaises(Exception, graph.run, 4, worker)
+        self.assertEquals(ran, [0])
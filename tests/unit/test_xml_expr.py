@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from nixops.util import LazyXmlAttr, python_to_xml_expr, xml_expr_to_python
+
+class PythonToXmlExprTest(unittest.TestCase):
+    def test_roundtrip(self):
+        value = {"a": [1, True, None, "x"], "b": {"c": False, "d": []}, "e": u"‘y’"}
+        self.assertEquals(xml_expr_to_python(python_to_xml_expr(value)), value)
+
+    def test_find(self):
+        node = python_to_xml_expr({"targetPort": 22, "owners": ["a", "b"]})
+        self.assertEquals(node.find("attr[@name='targetPort']/int").get("value"), "22")
+        self.assertEquals([e.get("value") for e in node.findall("attr[@name='owners']/list/string")], ["a", "b"])
+
+class LazyXmlAttrTest(unittest.TestCase):
+    def test_name_does_not_build_element(self):
+        x = LazyXmlAttr("machine", {"targetPort": 22})
+        self.assertEquals(x.get("name"), "machine")
+        self.assertEquals(x._elem, None)
+
+    def test_find(self):
+        x = LazyXmlAttr("machine", {"targetPort": 22})
+        self.assertEquals(x.find("attrs/attr[@name='targetPort']/int").get("value"), "22")
+        self.assertEquals(x.find("attrs/attr[@name='missing']"), None)